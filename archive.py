@@ -0,0 +1,409 @@
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+from transfer import IncompleteTransfer, open_media_stream
+
+TAR = "tar"
+ZIP = "zip"
+ARCHIVE_FORMATS = (TAR, ZIP)
+INDEX_SUFFIX = ".idx"
+# Members without a Content-Length are buffered before they go into a tar archive,
+# in memory up to this size and in a temporary file beyond it.
+SPOOL_MEMORY = 8 * 1024 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+# An archive takes one member at a time, so this many transfers of an account are in
+# flight while its media goes into archives; more would only wait for the lock.
+MAX_TRANSFERS = 1
+
+_PHASE_DIRS = {"story": "stories", "post": "posts"}
+
+# Archives that are open in this process, so every download of an account (e.g. the
+# story and post polls of a watcher) appends through the same writer.
+_open_writers = {}
+_open_writers_lock = threading.Lock()
+
+
+class ArchiveError(Exception):
+    """Raised when an archive cannot be opened for appending."""
+
+
+def index_path(archive_path):
+    return archive_path + INDEX_SUFFIX
+
+
+def load_index(archive_path):
+    """
+    Reads the member index of an archive.
+
+    The index has one line per member, "<name>\\t<data offset>\\t<size>\\t<mtime>",
+    in the order the members were appended. A torn last line (the process died while
+    writing it) is ignored.
+
+    Returns:
+        list: (name, data offset, size, mtime) tuples.
+    """
+    entries = []
+    try:
+        with open(index_path(archive_path), 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if not line.endswith("\n") or len(fields) != 4:
+                    break
+                try:
+                    entries.append((fields[0], int(fields[1]), int(fields[2]), float(fields[3])))
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def read_member(archive_path, name):
+    """
+    Reads one member of an archive by seeking straight to its data, without scanning
+    the archive. Members are stored uncompressed, so this works for tar and zip alike.
+
+    Returns:
+        bytes: The member's content.
+
+    Raises:
+        KeyError: If the index has no member of that name.
+    """
+    found = None
+    for entry in load_index(archive_path):
+        if entry[0] == name:
+            found = entry  # A member written again later supersedes the earlier copy.
+    if found is None:
+        raise KeyError(name)
+    _, offset, size, _ = found
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class _Member:
+    """Where the member being appended starts, for rolling it back."""
+
+    def __init__(self, start):
+        self.start = start
+        self.data_offset = None
+
+
+class ArchiveWriter:
+    """
+    Appends media to one archive file, streaming every member from the network
+    straight into place.
+
+    Members are stored uncompressed (media files are compressed already) and listed
+    in a sidecar index (<archive>.idx) with the offset and size of their data, which
+    makes any member readable with a single seek (see read_member). Memory use is one
+    chunk per transfer; nothing is staged on disk, except for the rare tar member
+    whose size the server does not announce.
+
+    A member that fails half-way (cancelled, connection lost for good, over the size
+    limit) is cut off the archive again, so the archive only ever holds complete
+    members. Tar archives also survive the process dying: the index is written after
+    each member, and reopening an archive truncates whatever follows the last indexed
+    member. Zip archives get their central directory when they are closed, so a zip
+    left behind by a crash cannot be appended to; open_archive() then continues in a
+    new part, and the index of the damaged part still locates its members.
+
+    Appending is serialized with the writer's lock: the members of one archive are
+    written one at a time.
+    """
+
+    def __init__(self, path, archive_format):
+        """
+        Args:
+            path (str): The archive file. Created if it does not exist.
+            archive_format (str): "tar" or "zip".
+
+        Raises:
+            ArchiveError: If an existing zip archive cannot be appended to.
+        """
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format {archive_format!r}, use {' or '.join(ARCHIVE_FORMATS)}")
+        self.path = path
+        self.format = archive_format
+        self.lock = threading.RLock()
+        self.members = len(load_index(path))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if archive_format == TAR:
+            self._open_tar()
+        else:
+            self._open_zip()
+        self._index = open(index_path(path), 'a', encoding='utf-8')
+        # A line torn by a crash would swallow the next member's line.
+        self._index.truncate(_index_size(load_index(path)))
+
+    def _open_tar(self):
+        entries = load_index(self.path)
+        if not entries and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            entries = self._rebuild_tar_index()
+        end = 0
+        if entries:
+            _, offset, size, _ = entries[-1]
+            end = offset + _padded(size)
+        self._file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        # Drops the end-of-archive blocks of the last session and any member cut off by a crash.
+        self._file.truncate(end)
+        self._file.seek(end)
+
+    def _rebuild_tar_index(self):
+        """Recreates a lost index from the archive's own headers."""
+        entries = []
+        try:
+            with tarfile.open(self.path, 'r:') as tar:
+                for info in tar:
+                    if info.isfile():
+                        entries.append((info.name, info.offset_data, info.size, info.mtime))
+        except (tarfile.TarError, OSError):
+            pass  # Keeps the members read up to the damaged one.
+        entries = [entry for entry in entries if entry[1] + entry[2] <= os.path.getsize(self.path)]
+        with open(index_path(self.path), 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(_index_line(*entry))
+        self.members = len(entries)
+        return entries
+
+    def _open_zip(self):
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        # zipfile would start a second archive behind a damaged one instead of failing.
+        if exists and not zipfile.is_zipfile(self.path):
+            raise ArchiveError(f"Cannot append to {self.path}: no zip central directory (interrupted?)")
+        try:
+            self._zip = zipfile.ZipFile(self.path, 'a' if exists else 'w', zipfile.ZIP_STORED, allowZip64=True)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"Cannot append to {self.path}: {e}")
+        self._file = self._zip.fp
+
+    def add(self, name, size, chunks, mtime=None):
+        """
+        Appends one member.
+
+        Args:
+            name (str): The member name, e.g. "posts/<media id>.jpg".
+            size (int): The announced size in bytes, or None if unknown.
+            chunks (iterable): The member's content, e.g. from transfer.open_media_stream.
+            mtime (float): Optional, the member's modification time; defaults to now.
+
+        Returns:
+            int: The member's size in bytes.
+        """
+        mtime = time.time() if mtime is None else mtime
+        with self.lock:
+            member = _Member(self._file.tell() if self.format == TAR else self._zip.start_dir)
+            try:
+                if self.format == TAR:
+                    size = self._add_tar(member, name, size, chunks, mtime)
+                else:
+                    size = self._add_zip(member, name, size, chunks, mtime)
+            except BaseException:
+                self._rollback(member, name)
+                raise
+            self._index.write(_index_line(name, member.data_offset, size, mtime))
+            self._index.flush()
+            self.members += 1
+            return size
+
+    def _add_tar(self, member, name, size, chunks, mtime):
+        spool = None
+        try:
+            if size is None:
+                # A tar header carries the size, so the content has to be complete first.
+                spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY, dir=os.path.dirname(self.path))
+                for chunk in chunks:
+                    spool.write(chunk)
+                size = spool.tell()
+                spool.seek(0)
+                chunks = iter(lambda: spool.read(COPY_CHUNK_SIZE), b"")
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            header = info.tobuf(tarfile.PAX_FORMAT, encoding="utf-8")
+            self._file.write(header)
+            member.data_offset = member.start + len(header)
+            written = 0
+            for chunk in chunks:
+                written += len(chunk)
+                if written > size:
+                    break
+                self._file.write(chunk)
+            if written != size:
+                raise IncompleteTransfer(f"Expected {size} bytes for {name}, got {written}")
+            self._file.write(b"\0" * (_padded(size) - size))
+            self._file.flush()
+        finally:
+            if spool is not None:
+                spool.close()
+        return size
+
+    def _add_zip(self, member, name, size, chunks, mtime):
+        info = zipfile.ZipInfo(name, date_time=time.localtime(max(mtime, 315532800))[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = 0o644 << 16
+        if size is not None:
+            info.file_size = size
+        with self._zip.open(info, 'w', force_zip64=size is None) as dest:
+            member.data_offset = self._file.tell()
+            written = 0
+            for chunk in chunks:
+                written += len(chunk)
+                if size is not None and written > size:
+                    break
+                dest.write(chunk)
+            if size is not None and written != size:
+                raise IncompleteTransfer(f"Expected {size} bytes for {name}, got {written}")
+        self._file.flush()
+        return info.file_size
+
+    def _rollback(self, member, name):
+        if self.format == ZIP:
+            # Closing the member's stream registered it; take it out of the directory again.
+            if self._zip.filelist and self._zip.filelist[-1].header_offset == member.start:
+                info = self._zip.filelist.pop()
+                if self._zip.NameToInfo.get(name) is info:
+                    del self._zip.NameToInfo[name]
+            self._zip.start_dir = member.start
+        self._file.seek(member.start)
+        self._file.truncate()
+
+    def close(self):
+        """Finishes the archive: end-of-archive blocks for tar, the central directory for zip."""
+        with self.lock:
+            if self.format == TAR:
+                self._file.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+                self._file.close()
+            else:
+                self._zip.close()
+            self._index.close()
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def _index_line(name, offset, size, mtime):
+    return f"{name}\t{offset}\t{size}\t{mtime:.0f}\n"
+
+
+def _index_size(entries):
+    return sum(len(_index_line(*entry).encode('utf-8')) for entry in entries)
+
+
+def _acquire_writer(path, archive_format):
+    with _open_writers_lock:
+        entry = _open_writers.get(path)
+        if entry is None:
+            entry = _open_writers[path] = [ArchiveWriter(path, archive_format), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def _release_writer(writer):
+    with _open_writers_lock:
+        entry = _open_writers[writer.path]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _open_writers[writer.path]
+            writer.close()
+
+
+def open_archive(user_dir, username, day, archive_format):
+    """
+    Opens the archive of an account for a day, <user_dir>/<username>-<day>.<format>,
+    or the first part of it (<username>-<day>.<n>.zip) that can still be appended to.
+    Every call must be paired with close_archive().
+    """
+    part = 0
+    while True:
+        suffix = f".{part}" if part else ""
+        path = os.path.join(user_dir, f"{username}-{day}{suffix}.{archive_format}")
+        try:
+            return _acquire_writer(path, archive_format)
+        except ArchiveError:
+            part += 1
+
+
+def close_archive(writer):
+    _release_writer(writer)
+
+
+class ArchiveSet:
+    """
+    The archives one download_media call writes into: one per day, in the account's
+    directory (<download_path>/<username>/<username>-<YYYY-MM-DD>.<format>).
+    Archives are opened on the first media of the day and closed by close().
+    """
+
+    def __init__(self, download_path, username, archive_format):
+        """
+        Args:
+            download_path (str): The root download directory.
+            username (str): The Instagram username.
+            archive_format (str): "tar" or "zip".
+        """
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format {archive_format!r}, use {' or '.join(ARCHIVE_FORMATS)}")
+        self.user_dir = os.path.join(os.path.abspath(download_path), username)
+        self.username = username
+        self.format = archive_format
+        self._writers = {}
+        self._lock = threading.Lock()
+
+    def writer(self):
+        """Returns the writer of today's archive."""
+        day = time.strftime("%Y-%m-%d")
+        with self._lock:
+            writer = self._writers.get(day)
+            if writer is None:
+                writer = self._writers[day] = open_archive(self.user_dir, self.username, day, self.format)
+            return writer
+
+    def fetch(self, session, kind, entry, cancel_event=None, on_bytes=None, max_bytes=None):
+        """
+        Streams one media entry into today's archive.
+
+        Returns:
+            tuple: (size in bytes, location), where location is "<archive path>#<member name>",
+            the path recorded in the manifest.
+        """
+        writer = self.writer()
+        name = f"{_PHASE_DIRS.get(kind, kind)}/{entry['id']}{entry['ext']}"
+        # The writer's lock is taken before the request, so a transfer waiting for its
+        # turn does not hold a response open.
+        with writer.lock:
+            size, chunks = open_media_stream(session, entry['url'], cancel_event, max_bytes=max_bytes)
+            if on_bytes is not None:
+                chunks = _counted(chunks, on_bytes)
+            size = writer.add(name, size, chunks, entry.get('taken_at'))
+        return size, f"{writer.path}#{name}"
+
+    def add_bytes(self, kind, name, data, mtime=None):
+        """
+        Adds a small in-memory file, e.g. a metadata sidecar, to today's archive.
+
+        Returns:
+            str: "<archive path>#<member name>".
+        """
+        writer = self.writer()
+        name = f"{_PHASE_DIRS.get(kind, kind)}/{name}"
+        writer.add(name, len(data), [data], mtime)
+        return f"{writer.path}#{name}"
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                close_archive(writer)
+            self._writers.clear()
+
+
+def _counted(chunks, on_bytes):
+    for chunk in chunks:
+        on_bytes(len(chunk))
+        yield chunk
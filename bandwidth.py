@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from collections import deque
+
+from filters import FilterError, parse_size
+
+STORY = "story"
+RECENT = "recent"
+BACKFILL = "backfill"
+PRIORITIES = (STORY, RECENT, BACKFILL)
+
+# Share of the bandwidth each class gets while several are transferring.
+DEFAULT_WEIGHTS = {STORY: 8, RECENT: 3, BACKFILL: 1}
+# Posts younger than this count as recent, older ones as backfill.
+RECENT_WINDOW = 7 * 24 * 3600
+# Seconds of traffic the bucket can save up, which bounds bursts after idle time.
+BURST_SECONDS = 0.25
+# Longest wait between checks of cancel_event and rate changes.
+WAIT_POLL_INTERVAL = 0.2
+# Seconds between checks of a rate control file.
+RATE_FILE_INTERVAL = 1.0
+
+
+def priority_for(kind, taken_at, now=None):
+    """Returns the priority class of a media item: stories, then recent posts, then backfill."""
+    if kind == "story":
+        return STORY
+    now = time.time() if now is None else now
+    if taken_at is not None and now - taken_at <= RECENT_WINDOW:
+        return RECENT
+    return BACKFILL
+
+
+def parse_rate(text):
+    """
+    Parses a bandwidth limit such as "5M" or "800K" (bytes per second, binary units).
+    "0", "off" and an empty value mean unlimited.
+
+    Returns:
+        int: Bytes per second, or None for unlimited.
+    """
+    text = str(text or "").strip().lower()
+    if text.endswith("/s"):
+        text = text[:-2]
+    if text in ("", "0", "off", "none", "unlimited"):
+        return None
+    try:
+        return parse_size(text) or None
+    except FilterError:
+        raise ValueError(f"Invalid bandwidth limit {text!r}, use e.g. 5M or 800K")
+
+
+class BandwidthGovernor:
+    """
+    Shared budget of bytes per second that every media transfer of a batch draws from.
+
+    Transfers report every chunk they read with consume(), which blocks while the
+    batch is over the limit; the paused reader lets TCP flow control slow the sender
+    down. While several priority classes are waiting, the bandwidth is shared by
+    weighted fair queueing: with the default weights a story transfer gets 8 bytes
+    for every 3 of a recent post and 1 of a backfill post, and a class that is
+    alone gets everything. The limit can be changed at any time with set_rate().
+    """
+
+    def __init__(self, rate=None, weights=None, clock=time.monotonic):
+        """
+        Args:
+            rate (int): Bytes per second over all transfers, or None for unlimited.
+            weights (dict): Optional, priority class -> weight (see DEFAULT_WEIGHTS).
+            clock (function): Monotonic time source.
+        """
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.clock = clock
+        self._rate = rate
+        self._tokens = 0.0
+        self._updated = clock()
+        self._changed = threading.Condition()
+        self._waiting = {priority: deque() for priority in self.weights}
+        self._virtual_time = {priority: 0.0 for priority in self.weights}
+        self._virtual_now = 0.0
+        self._bytes = {priority: 0 for priority in self.weights}
+        self._wait_seconds = {priority: 0.0 for priority in self.weights}
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        """Changes the limit (bytes per second, None for unlimited); waiting transfers pick it up at once."""
+        with self._changed:
+            self._refill()
+            self._rate = rate or None
+            self._tokens = min(self._tokens, self._burst())
+            self._changed.notify_all()
+
+    def _burst(self):
+        return self._rate * BURST_SECONDS if self._rate else 0.0
+
+    def _refill(self):
+        now = self.clock()
+        if self._rate:
+            self._tokens = min(self._burst(), self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _next_ticket(self):
+        waiting = [priority for priority, queue in self._waiting.items() if queue]
+        if not waiting:
+            return None
+        priority = min(waiting, key=lambda candidate: self._virtual_time[candidate])
+        return self._waiting[priority][0]
+
+    def consume(self, nbytes, priority=BACKFILL, cancel_event=None):
+        """
+        Takes nbytes out of the budget, waiting for this transfer's turn if needed.
+
+        Args:
+            nbytes (int): Bytes just read.
+            priority (str): The transfer's class, one of PRIORITIES.
+            cancel_event (threading.Event): Optional, stops waiting when set.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        started = self.clock()
+        with self._changed:
+            self._bytes[priority] += nbytes
+            if not self._rate:
+                return 0.0
+            queue = self._waiting[priority]
+            if not queue:
+                # A class that was idle joins at the current virtual time instead of
+                # catching up on the turns it did not need.
+                self._virtual_time[priority] = max(self._virtual_time[priority], self._virtual_now)
+            ticket = object()
+            queue.append(ticket)
+            try:
+                while True:
+                    if not self._rate:
+                        break
+                    self._refill()
+                    if self._next_ticket() is ticket and self._tokens > 0:
+                        # A chunk may overdraw the bucket; the next transfer waits for the debt.
+                        self._tokens -= nbytes
+                        self._virtual_time[priority] += nbytes / self.weights[priority]
+                        self._virtual_now = self._virtual_time[priority]
+                        break
+                    if cancel_event is not None and cancel_event.is_set():
+                        break
+                    self._changed.wait(min(WAIT_POLL_INTERVAL, max(0.001, -self._tokens / self._rate)))
+            finally:
+                queue.remove(ticket)
+                self._changed.notify_all()
+            waited = self.clock() - started
+            self._wait_seconds[priority] += waited
+            return waited
+
+    def stats(self):
+        """Returns the limit and the bytes transferred and seconds waited per priority class."""
+        with self._changed:
+            return {
+                "rate": self._rate,
+                "bytes": dict(self._bytes),
+                "wait_seconds": {priority: round(seconds, 3) for priority, seconds in self._wait_seconds.items()},
+            }
+
+
+def follow_rate_file(governor, path, stop_event, log_callback=None):
+    """
+    Applies the limit written in a control file (e.g. "5M", or "0" for unlimited)
+    whenever the file changes, until stop_event is set. Meant for a daemon thread,
+    so that the limit of a running batch can be changed from outside.
+    """
+    last_mtime = None
+    while not stop_event.is_set():
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != last_mtime:
+                last_mtime = mtime
+                with open(path, 'r') as f:
+                    rate = parse_rate(f.read())
+                if rate != governor.rate:
+                    governor.set_rate(rate)
+                    if log_callback is not None:
+                        log_callback(f"Bandwidth limit set to {format_limit(rate)}.")
+        except (OSError, ValueError) as e:
+            if log_callback is not None and not isinstance(e, FileNotFoundError):
+                log_callback(f"Could not read the bandwidth limit from {path}: {e}")
+        stop_event.wait(RATE_FILE_INTERVAL)
+
+
+def format_limit(rate):
+    return f"{rate / (1024 * 1024):.2f} MB/s" if rate else "unlimited"
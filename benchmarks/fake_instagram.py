@@ -0,0 +1,330 @@
+"""
+Local stand-in for the Instagram endpoints used by the download core.
+
+An API server answers profile lookups, paginated post feeds and story pages with
+synthetic listings, and a separate CDN server streams deterministic media bodies
+of the configured size (with Range support). The bodies are well-formed JPEG and
+MP4 framing around filler unique to each media item. Latency and 429 throttling
+can be injected to reproduce bad nights offline, and reposted or corrupt media to
+exercise the integrity checks.
+"""
+import hashlib
+import json
+import struct
+import threading
+import time
+import zlib
+from functools import lru_cache
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+@lru_cache(maxsize=256)
+def media_body(key, size, is_video, corrupt=False):
+    """
+    Returns the deterministic body of one media file: a JPEG (SOI ... EOI) or an MP4
+    (ftyp, moov and mdat boxes that add up to the file size) around filler derived
+    from key. A corrupt body lacks the JPEG end marker or has an mdat box that
+    claims more bytes than the file holds, like a truncated encode.
+    """
+    digest = hashlib.sha256(key.encode()).digest()
+    if is_video:
+        head = struct.pack(">I4s4sI", 16, b"ftyp", b"isom", 0x200) + struct.pack(">I4s8s", 16, b"moov", digest[:8])
+        mdat_size = max(size - len(head), 8)
+        head += struct.pack(">I4s", mdat_size + (4096 if corrupt else 0), b"mdat")
+        tail = b""
+    else:
+        head, tail = b"\xff\xd8\xff\xe0", b"" if corrupt else b"\xff\xd9"
+    filler_size = max(0, size - len(head) - len(tail))
+    filler = (digest * (filler_size // len(digest) + 1))[:filler_size].replace(b"\xff", b"\xfe")
+    return head + filler + tail
+
+
+class Account:
+    """Synthetic content of one fake account."""
+
+    def __init__(self, username, posts=0, stories=0, media_size=64 * 1024, carousel_every=0, video_every=0,
+                 repost_every=0, corrupt_every=0):
+        """
+        Args:
+            username (str): The account's username.
+            posts (int): Number of feed posts.
+            stories (int): Number of active stories.
+            media_size (int): Size in bytes of every media file.
+            carousel_every (int): Every n-th post is a 3-item carousel (0 disables).
+            video_every (int): Every n-th media item is a video (0 disables).
+            repost_every (int): Every n-th story has the same content as the post at the
+                same index, like a reposted story (0 disables).
+            corrupt_every (int): Every n-th media body is corrupt (0 disables).
+        """
+        self.username = username
+        self.user_id = str(zlib.crc32(username.encode()) + 10 ** 9)
+        self.posts = posts
+        self.stories = stories
+        self.media_size = media_size
+        self.carousel_every = carousel_every
+        self.video_every = video_every
+        self.repost_every = repost_every
+        self.corrupt_every = corrupt_every
+
+
+class FakeInstagram:
+    """Runs the fake API and CDN servers on background threads."""
+
+    def __init__(self, accounts, latency=0.0, media_latency=None, api_rate_limit=None, retry_after=1,
+                 page_size_cap=None, expired_sessions=(), etags=False, ignore_range=False):
+        """
+        Args:
+            accounts (list): The Account objects to serve.
+            latency (float): Seconds added to every API response.
+            media_latency (float): Seconds added before every media body; defaults to latency.
+            api_rate_limit (float): If set, API requests above this many per second get HTTP 429.
+                The limit applies to each sessionid cookie separately, like Instagram's per-account limits.
+            retry_after (int): The Retry-After value sent with 429 responses.
+            page_size_cap (int): Optional cap on the feed page size.
+            expired_sessions (iterable): sessionid cookie values answered with HTTP 401 login_required.
+            etags (bool): Send an ETag with every API response and answer a matching
+                If-None-Match with 304 Not Modified.
+            ignore_range (bool): Answer media Range requests with the whole file (200),
+                like a server without range support.
+        """
+        self.accounts = {account.username: account for account in accounts}
+        self.by_id = {account.user_id: account for account in accounts}
+        self.latency = latency
+        self.media_latency = latency if media_latency is None else media_latency
+        self.api_rate_limit = api_rate_limit
+        self.retry_after = retry_after
+        self.page_size_cap = page_size_cap
+        self.expired_sessions = set(expired_sessions)
+        self.etags = etags
+        self.ignore_range = ignore_range
+        # Media timestamps are relative to the server start, so listings stay unchanged.
+        self.epoch = int(time.time())
+        self._lock = threading.Lock()
+        self._api_buckets = {}
+        self.counts = {"api": 0, "media": 0, "throttled": 0, "media_bytes": 0, "not_modified": 0}
+        self._servers = []
+        self.api_url = None
+        self.cdn_url = None
+
+    def start(self):
+        api = self._serve(_ApiHandler)
+        cdn = self._serve(_CdnHandler)
+        self.api_url = f"http://127.0.0.1:{api.server_port}"
+        self.cdn_url = f"http://127.0.0.1:{cdn.server_port}"
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _serve(self, handler):
+        server = _QuietServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        server.fake = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self._servers.append(server)
+        return server
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def allow_api_request(self, session_id):
+        if not self.api_rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._api_buckets.get(session_id, (self.api_rate_limit, now))
+            tokens = min(self.api_rate_limit, tokens + (now - updated) * self.api_rate_limit)
+            allowed = tokens >= 1
+            self._api_buckets[session_id] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                self.counts["throttled"] += 1
+            return allowed
+
+    def media_node(self, account, media_id, taken_at, content_id=None):
+        content_id = content_id or media_id
+        is_video = bool(account.video_every) and int(content_id[-4:]) % account.video_every == 0
+        url = f"{self.cdn_url}/media/{account.username}/{media_id}{'.mp4' if is_video else '.jpg'}"
+        if content_id != media_id:
+            url += f"?content={content_id}"
+        node = {"pk": media_id, "id": f"{media_id}_{account.user_id}", "taken_at": taken_at,
+                "image_versions2": {"candidates": [{"url": url, "width": 1080, "height": 1350}]}}
+        if is_video:
+            node["video_versions"] = [{"url": url, "width": 1080, "height": 1920}]
+        return node
+
+    def profile_pic_url(self, account):
+        return f"{self.cdn_url}/media/{account.username}/{account.user_id}000001.jpg"
+
+    def feed_item(self, account, index):
+        base_id = f"{account.user_id}{index:06d}"
+        taken_at = self.epoch - index * 3600
+        if account.carousel_every and index % account.carousel_every == 0:
+            children = [self.media_node(account, f"{base_id}{child}", taken_at) for child in range(1, 4)]
+            return {"pk": f"{base_id}0", "id": f"{base_id}0_{account.user_id}", "taken_at": taken_at,
+                    "media_type": 8, "carousel_media": children}
+        item = self.media_node(account, f"{base_id}0", taken_at)
+        item["media_type"] = 2 if "video_versions" in item else 1
+        return item
+
+    def story_items(self, account):
+        now = self.epoch
+        items = []
+        for index in range(account.stories):
+            content_id = None
+            if account.repost_every and index % account.repost_every == 0 and index < account.posts:
+                if not (account.carousel_every and index % account.carousel_every == 0):
+                    content_id = f"{account.user_id}{index:06d}0"
+            item = self.media_node(account, f"9{account.user_id}{index:05d}", now - index * 600, content_id)
+            item["expiring_at"] = now - index * 600 + 86400
+            items.append(item)
+        return items
+
+
+class _QuietServer(ThreadingHTTPServer):
+    # The default backlog of 5 makes bursts of new connections wait for SYN retransmits.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections (e.g. on cancel) is expected.
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle's algorithm the body would
+    # wait for the client's delayed ACK of the headers (~40ms) on every response.
+    disable_nagle_algorithm = True
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type="application/json", status=200, headers=None):
+        if self.fake.etags and status == 200 and isinstance(self, _ApiHandler):
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get("If-None-Match") == etag:
+                self.fake.count("not_modified")
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _ApiHandler(_Handler):
+    def do_GET(self):
+        fake = self.fake
+        fake.count("api")
+        if fake.latency:
+            time.sleep(fake.latency)
+        session_id = SimpleCookie(self.headers.get("Cookie", "")).get("sessionid")
+        session_id = session_id.value if session_id else None
+        if session_id in fake.expired_sessions:
+            return self.send_body(b'{"message":"login_required","status":"fail"}', status=401)
+        if not fake.allow_api_request(session_id):
+            return self.send_body(b'{"status":"fail"}', status=429, headers={"Retry-After": str(fake.retry_after)})
+
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        parts = [part for part in url.path.split("/") if part]
+
+        if url.path.startswith("/api/v1/users/web_profile_info"):
+            account = fake.accounts.get(query.get("username"))
+            if account is None:
+                return self.send_body(b'{"data":{"user":null}}', status=404)
+            user = {"id": account.user_id, "username": account.username, "profile_pic_url": fake.profile_pic_url(account)}
+            return self.send_body(json.dumps({"data": {"user": user}}).encode())
+
+        if parts[:3] == ["api", "v1", "feed"] and len(parts) >= 5:
+            account = fake.by_id.get(parts[4])
+            if account is None:
+                return self.send_body(b'{"items":[]}', status=404)
+            count = int(query.get("count", 12))
+            if fake.page_size_cap:
+                count = min(count, fake.page_size_cap)
+            start = int(query.get("max_id") or 0)
+            end = min(start + count, account.posts)
+            items = [fake.feed_item(account, index) for index in range(start, end)]
+            more = end < account.posts
+            return self.send_body(json.dumps({"items": items, "more_available": more,
+                                              "next_max_id": str(end) if more else None}).encode())
+
+        if parts[:1] == ["stories"] and len(parts) >= 2:
+            account = fake.accounts.get(parts[1])
+            if account is None:
+                return self.send_body(b"<html></html>", "text/html", status=404)
+            reel = {"user": {"username": account.username, "profile_pic_url": fake.profile_pic_url(account)},
+                    "items": fake.story_items(account)}
+            payload = {"require": [{"xdt_api__v1__feed__reels_media": {"reels_media": [reel]}}]}
+            page = f'<html><body><script type="application/json">{json.dumps(payload)}</script></body></html>'
+            return self.send_body(page.encode(), "text/html")
+
+        self.send_body(b"{}", status=404)
+
+
+class _CdnHandler(_Handler):
+    def do_GET(self):
+        fake = self.fake
+        parts = [part for part in urlsplit(self.path).path.split("/") if part]
+        account = fake.accounts.get(parts[1]) if len(parts) == 3 and parts[0] == "media" else None
+        if account is None:
+            return self.send_body(b"", "text/plain", status=404)
+        fake.count("media")
+        if fake.media_latency:
+            time.sleep(fake.media_latency)
+
+        media_id, _, ext = parts[2].partition(".")
+        content_id = dict(parse_qsl(urlsplit(self.path).query)).get("content", media_id)
+        corrupt = bool(account.corrupt_every) and int(content_id[-4:]) % account.corrupt_every == 0
+        body = media_body(content_id, account.media_size, ext == "mp4", corrupt)
+        size = len(body)
+        start = 0
+        status = 200
+        headers = {}
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes=") and not fake.ignore_range:
+            start = int(range_header[6:].split("-")[0] or 0)
+            if start >= size:
+                return self.send_body(b"", "text/plain", status=416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4" if ext == "mp4" else "image/jpeg")
+        self.send_header("Content-Length", str(size - start))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        view = memoryview(body)[start:]
+        try:
+            for offset in range(0, len(view), 64 * 1024):
+                chunk = view[offset:offset + 64 * 1024]
+                # Counted before the write, so the count is complete once the client has the bytes.
+                fake.count("media_bytes", len(chunk))
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
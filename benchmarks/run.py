@@ -0,0 +1,297 @@
+"""
+Offline benchmark harness for the download core.
+
+Every scenario runs against a local FakeInstagram server. The download itself
+runs in a child process so that its peak RSS is measured in isolation. Results
+can be saved as baselines and later runs are compared against them.
+
+Examples (from the repository root):
+    python -m benchmarks.run
+    python -m benchmarks.run huge_account throttled --save-baseline
+    python -m benchmarks.run --compare --fail-on-regression
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.fake_instagram import Account, FakeInstagram
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+# A metric counts as regressed when it is this much worse than its baseline.
+REGRESSION_THRESHOLD = 0.10
+
+SCENARIOS = {
+    "huge_account": {
+        "description": "One account with a long post history, carousels and videos.",
+        "accounts": [{"username": "huge", "posts": 300, "stories": 20, "media_size": 128 * 1024,
+                      "carousel_every": 5, "video_every": 7}],
+        "server": {"latency": 0.01},
+        "engine": {"max_workers": 1},
+    },
+    "long_history": {
+        "description": "One account with a hundred feed pages that take 250ms each and media that take 80ms; "
+                       "measures time to first byte and peak RSS.",
+        "accounts": [{"username": "archive", "posts": 1200, "media_size": 8 * 1024}],
+        "server": {"latency": 0.25, "media_latency": 0.08},
+        "engine": {"max_workers": 1},
+        # Start the rate limiter where a long batch settles, so it measures the pipeline, not the ramp-up.
+        "limiter": {"rate": 64},
+    },
+    "many_small_accounts": {
+        "description": "A wide watch list of accounts with a few items each.",
+        "accounts": [{"username": f"small{i:03d}", "posts": 4, "stories": 2, "media_size": 32 * 1024}
+                     for i in range(100)],
+        "server": {"latency": 0.01},
+        "engine": {"max_workers": 8},
+    },
+    "throttled": {
+        "description": "The API answers 429 with Retry-After above 4 requests/s.",
+        "accounts": [{"username": f"busy{i:02d}", "posts": 30, "stories": 3, "media_size": 32 * 1024}
+                     for i in range(20)],
+        "server": {"latency": 0.005, "api_rate_limit": 4, "retry_after": 1},
+        "engine": {"max_workers": 8},
+    },
+    "cookie_pool": {
+        "description": "Four cookie sessions sharing a batch, the API limited to 4 requests/s per session.",
+        "accounts": [{"username": f"pool{i:02d}", "posts": 24, "stories": 2, "media_size": 32 * 1024}
+                     for i in range(24)],
+        "server": {"latency": 0.005, "api_rate_limit": 4, "retry_after": 1},
+        "engine": {"max_workers": 2},
+        "cookie_sets": 4,
+    },
+    "cancelled": {
+        "description": "A large batch cancelled two seconds in; measures how fast workers stop.",
+        "accounts": [{"username": f"big{i}", "posts": 300, "stories": 5, "media_size": 1024 * 1024}
+                     for i in range(4)],
+        "server": {"latency": 0.01},
+        "engine": {"max_workers": 4},
+        "cancel_after": 2.0,
+    },
+    "cancelled_stalled": {
+        "description": "A batch cancelled while media responses stall for 30s and the API is throttled with a "
+                       "30s Retry-After; measures how fast blocked workers stop.",
+        "accounts": [{"username": f"stall{i}", "posts": 40, "stories": 2, "media_size": 64 * 1024}
+                     for i in range(8)],
+        "server": {"latency": 0.01, "media_latency": 30, "api_rate_limit": 2, "retry_after": 30},
+        "engine": {"max_workers": 4},
+        "cancel_after": 2.0,
+    },
+}
+
+# Metric -> True when higher is better.
+COMPARED_METRICS = {
+    "wall_seconds": False,
+    "mb_per_s": True,
+    "files_per_s": True,
+    "latency_p50_ms": False,
+    "latency_p90_ms": False,
+    "latency_p99_ms": False,
+    "peak_rss_mb": False,
+    "first_byte_ms": False,
+    "cancel_latency_ms": False,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_child(name, api_url):
+    """Runs one scenario's download in this process and returns its measurements."""
+    import listing
+    from cancel import CancelToken
+    from cookiepool import CookiePool
+    from engine import DownloadEngine
+    from progress import ProgressTracker
+    from ratelimit import RateLimiter
+    from session import DownloadSession, PooledAdapter
+
+    scenario = SCENARIOS[name]
+    listing.INSTAGRAM_URL = api_url
+    usernames = [account["username"] for account in scenario["accounts"]]
+
+    latencies = []
+    engine = DownloadEngine(**scenario.get("engine", {}))
+    session = DownloadSession(rate_limiter=RateLimiter(**scenario.get("limiter", {})))
+    send_once = PooledAdapter._send_once
+
+    def timed_send_once(adapter, host, request, **kwargs):
+        # Time the request on the wire only, not the rate limiter's pacing around it.
+        started = time.monotonic()
+        try:
+            return send_once(adapter, host, request, **kwargs)
+        finally:
+            latencies.append(time.monotonic() - started)
+
+    PooledAdapter._send_once = timed_send_once
+    run_options = {"session": session}
+    if scenario.get("cookie_sets"):
+        run_options["cookie_pool"] = CookiePool([{"sessionid": f"bench{i}", "csrftoken": "bench"}
+                                                 for i in range(scenario["cookie_sets"])])
+    cancel_event = CancelToken()
+    cancel_latency = None
+    first_byte = []
+    tracker = run_options["tracker"] = ProgressTracker()
+    bytes_transferred = tracker.bytes_transferred
+
+    def timed_bytes_transferred(username, nbytes):
+        if not first_byte:
+            first_byte.append(time.monotonic())
+        bytes_transferred(username, nbytes)
+
+    tracker.bytes_transferred = timed_bytes_transferred
+
+    with tempfile.TemporaryDirectory(prefix=f"insta-bench-{name}-") as download_path:
+        started = time.monotonic()
+        worker = threading.Thread(target=engine.run, args=(usernames, {"csrftoken": "bench"}, download_path,
+                                                           lambda message: None, lambda value: None, cancel_event),
+                                  kwargs=run_options)
+        worker.start()
+        if scenario.get("cancel_after"):
+            worker.join(scenario["cancel_after"])
+            cancelled_at = time.monotonic()
+            cancel_event.set()
+            worker.join()
+            cancel_latency = round((time.monotonic() - cancelled_at) * 1000, 1)
+        else:
+            worker.join()
+        wall = time.monotonic() - started
+        session.close()
+
+    batch = engine.tracker.snapshot()
+    limiters = [session.rate_limiter]
+    if "cookie_pool" in run_options:
+        limiters = [pooled.rate_limiter for pooled in run_options["cookie_pool"].sessions]
+    limiter_stats = [limiter.stats() for limiter in limiters]
+    return {
+        "wall_seconds": round(wall, 3),
+        "files": batch["items_done"],
+        "bytes": batch["bytes_done"],
+        "mb_per_s": round(batch["bytes_done"] / (1024 * 1024) / wall, 3),
+        "files_per_s": round(batch["items_done"] / wall, 2),
+        "requests": len(latencies),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "latency_p90_ms": round(percentile(latencies, 0.90) * 1000, 2) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "throttled_responses": sum(stats["throttled"] for stats in limiter_stats),
+        "retries": sum(stats["retries"] for stats in limiter_stats),
+        "peak_rss_mb": peak_rss_mb(),
+        "first_byte_ms": round((first_byte[0] - started) * 1000, 1) if first_byte else None,
+        "cancel_latency_ms": cancel_latency,
+    }
+
+
+def run_scenario(name):
+    """Starts the fake server for a scenario and runs the download in a child process."""
+    scenario = SCENARIOS[name]
+    accounts = [Account(**spec) for spec in scenario["accounts"]]
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with FakeInstagram(accounts, **scenario.get("server", {})) as fake:
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", "--child", name, "--api-url", fake.api_url],
+            cwd=repo_root, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"Scenario {name} failed:\n{completed.stderr}")
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result["server"] = dict(fake.counts)
+    return result
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def compare(name, result, threshold=REGRESSION_THRESHOLD):
+    """Prints the difference to the saved baseline and returns the regressed metric names."""
+    path = baseline_path(name)
+    if not os.path.exists(path):
+        print(f"  (no baseline saved for {name})")
+        return []
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline.get(metric), result.get(metric)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change < -threshold if higher_is_better else change > threshold
+        marker = "  REGRESSION" if worse else ""
+        print(f"  {metric:<18} {old:>10} -> {new:>10} ({change:+.1%}){marker}")
+        if worse:
+            regressions.append(metric)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)}).")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baselines.")
+    parser.add_argument("--compare", action="store_true", help="Compare the results with the saved baselines.")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Relative change that counts as a regression (default: %(default)s).")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Exit with status 1 if a metric regressed against its baseline.")
+    parser.add_argument("--json", action="store_true", help="Print the results as one JSON object.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.api_url)))
+        return 0
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    results = {}
+    regressions = {}
+    for name in names:
+        if not args.json:
+            print(f"{name}: {SCENARIOS[name]['description']}")
+        result = results[name] = run_scenario(name)
+        if not args.json:
+            for metric in ("wall_seconds", "files", "mb_per_s", "files_per_s", "latency_p50_ms", "latency_p99_ms",
+                           "throttled_responses", "peak_rss_mb", "first_byte_ms",
+                           "cancel_latency_ms"):
+                if result.get(metric) is not None:
+                    print(f"  {metric:<20} {result[metric]}")
+        if args.compare:
+            regressions[name] = compare(name, result, args.threshold)
+        if args.save_baseline:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(baseline_path(name), 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.fail_on_regression and any(regressions.values()):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FILENAME = ".cache.sqlite3"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+PROFILE = "profile"
+FEED = "feed"
+FEED_PAGE = "feed_page"
+STORIES = "stories"
+ENDPOINTS = (PROFILE, FEED, FEED_PAGE, STORIES)
+
+# Seconds a cached response is used without asking the server. Usernames map to the
+# same account for a long time; the newest feed page and the story reel change when
+# the account posts, so they are kept shorter than the watcher's shortest polling
+# intervals; older feed pages hardly ever change, but the signed media URLs in them
+# expire after a day or two.
+DEFAULT_TTLS = {
+    PROFILE: 7 * 24 * 3600,
+    FEED: 10 * 60,
+    FEED_PAGE: 6 * 3600,
+    STORIES: 5 * 60,
+}
+
+# Cookies that identify the logged-in account, in order of preference.
+IDENTITY_COOKIES = ("ds_user_id", "sessionid")
+
+HIT = "hit"
+MISS = "miss"
+STALE = "stale"
+REVALIDATED = "revalidated"
+
+
+def session_identity(cookies):
+    """
+    Returns a short hash of the account a cookie session is logged in as, for cache
+    keys: what a listing returns depends on who asks (e.g. a private account's feed
+    is only visible to its followers). The cookie value itself is never stored.
+    """
+    for name in IDENTITY_COOKIES:
+        value = (cookies or {}).get(name)
+        if value:
+            return hashlib.sha256(f"{name}={value}".encode("utf-8")).hexdigest()[:16]
+    return "anonymous"
+
+
+class CachedResponse:
+    """A cached listing response; fresh tells whether it is still within its TTL."""
+
+    def __init__(self, value, etag, last_modified, fresh):
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def validators(self):
+        """Returns the headers that make a request conditional on this response."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    On-disk cache of profile lookups and listing pages.
+
+    Every response is stored with the TTL of its endpoint (see DEFAULT_TTLS). Within
+    the TTL it is used without a request. After it, the next request carries the
+    response's ETag / Last-Modified validators where the server sent them, and a
+    304 Not Modified answer renews the cached copy for another TTL instead of
+    transferring it again. The cache is bounded by max_bytes; the least recently
+    used responses are evicted first.
+
+    Callers include the session_identity of their cookies in the key, so a response
+    is only served to sessions of the account that received it; sessions of a
+    cookie pool share responses only when they are logged in as the same account.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttls=None, metrics=None, clock=time.time):
+        """
+        Args:
+            path (str): The SQLite database file. Created if it does not exist.
+            max_bytes (int): The total size of the cached responses to keep.
+            ttls (dict): Optional, endpoint -> seconds, overriding DEFAULT_TTLS.
+            metrics (MetricsRegistry): Optional, counts lookups as insta_cache_requests_total.
+            clock (function): Wall-clock time source.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.metrics = metrics
+        self.clock = clock
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._stats = {endpoint: {HIT: 0, MISS: 0, STALE: 0, REVALIDATED: 0} for endpoint in self.ttls}
+        self._evictions = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                       endpoint TEXT NOT NULL,
+                       key TEXT NOT NULL,
+                       body TEXT NOT NULL,
+                       size INTEGER NOT NULL,
+                       etag TEXT,
+                       last_modified TEXT,
+                       expires_at REAL NOT NULL,
+                       accessed_at REAL NOT NULL,
+                       PRIMARY KEY (endpoint, key)
+                   )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (accessed_at)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @classmethod
+    def for_download_path(cls, download_path, **kwargs):
+        """Opens the cache that lives in the root of a download directory."""
+        return cls(os.path.join(os.path.abspath(download_path), CACHE_FILENAME), **kwargs)
+
+    def _count(self, endpoint, result):
+        self._stats.setdefault(endpoint, {HIT: 0, MISS: 0, STALE: 0, REVALIDATED: 0})[result] += 1
+        if self.metrics is not None:
+            self.metrics.inc("insta_cache_requests_total", endpoint=endpoint, result=result)
+
+    def lookup(self, endpoint, key):
+        """
+        Returns the cached response for a key, fresh or stale, or None.
+
+        A fresh response counts as a hit; a stale one is expected to be revalidated.
+        """
+        now = self.clock()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, etag, last_modified, expires_at FROM responses WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is None:
+                self._count(endpoint, MISS)
+                return None
+            body, etag, last_modified, expires_at = row
+            fresh = now < expires_at
+            self._count(endpoint, HIT if fresh else STALE)
+            with self._conn:
+                self._conn.execute("UPDATE responses SET accessed_at = ? WHERE endpoint = ? AND key = ?",
+                                   (now, endpoint, key))
+        return CachedResponse(json.loads(body), etag, last_modified, fresh)
+
+    def store(self, endpoint, key, value, etag=None, last_modified=None):
+        """Caches a response value (anything JSON-serializable) for the endpoint's TTL."""
+        body = json.dumps(value, separators=(',', ':'))
+        size = len(body)
+        now = self.clock()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT size FROM responses WHERE endpoint = ? AND key = ?",
+                                     (endpoint, key)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (endpoint, key, body, size, etag, last_modified, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, key, body, size, etag, last_modified, now + self.ttls.get(endpoint, 0), now),
+            )
+            self._size += size - (row[0] if row else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def revalidated(self, endpoint, key):
+        """Renews a stale response the server answered with 304 Not Modified."""
+        now = self.clock()
+        with self._lock, self._conn:
+            self._count(endpoint, REVALIDATED)
+            self._conn.execute("UPDATE responses SET expires_at = ?, accessed_at = ? WHERE endpoint = ? AND key = ?",
+                               (now + self.ttls.get(endpoint, 0), now, endpoint, key))
+
+    def _evict(self):
+        """Drops least recently used responses until the cache fits in max_bytes. Needs the lock."""
+        rows = self._conn.execute("SELECT endpoint, key, size FROM responses ORDER BY accessed_at")
+        evicted = []
+        for endpoint, key, size in rows:
+            if self._size <= self.max_bytes:
+                break
+            evicted.append((endpoint, key))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE endpoint = ? AND key = ?", evicted)
+        self._evictions += len(evicted)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self._size = 0
+
+    def stats(self):
+        """
+        Returns the lookup counts per endpoint ("hit", "miss", "stale", "revalidated"),
+        their totals, the number of evictions and the cached bytes.
+        """
+        with self._lock:
+            endpoints = {endpoint: dict(counts) for endpoint, counts in self._stats.items()}
+            totals = {result: sum(counts[result] for counts in endpoints.values())
+                      for result in (HIT, MISS, STALE, REVALIDATED)}
+            return {"endpoints": endpoints, "totals": totals, "evictions": self._evictions, "bytes": self._size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,119 @@
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class CancelToken(threading.Event):
+    """
+    A cancel_event that also interrupts the blocking work registered with it.
+
+    Setting it runs every registered callback at once, e.g. shutting down the socket
+    of an in-flight request, so a thread blocked in a read returns immediately
+    instead of noticing the event only between chunks. A plain threading.Event still
+    works wherever a cancel_event is taken; it is only noticed later.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = {}
+        self._callbacks_lock = threading.Lock()
+
+    def set(self):
+        super().set()
+        with self._callbacks_lock:
+            callbacks = list(self._callbacks.values())
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass  # Interrupting is best effort; the event itself is set.
+
+    def register(self, callback):
+        """
+        Calls callback() when the token is set, or at once if it already is.
+
+        Returns:
+            object: A handle for unregister().
+        """
+        handle = object()
+        with self._callbacks_lock:
+            self._callbacks[handle] = callback
+        if self.is_set():
+            callback()
+        return handle
+
+    def unregister(self, handle):
+        with self._callbacks_lock:
+            self._callbacks.pop(handle, None)
+
+
+@contextmanager
+def cancel_scope(cancel_event):
+    """
+    Makes cancel_event the current thread's cancel event for the duration of a with
+    block, so that code without a cancel_event parameter (the HTTP session, the rate
+    limiter) can wait on it and abort its requests when it is set.
+    """
+    previous = getattr(_local, "cancel_event", None)
+    _local.cancel_event = cancel_event
+    try:
+        yield cancel_event
+    finally:
+        _local.cancel_event = previous
+
+
+def current_cancel_event():
+    """Returns the current thread's cancel event (see cancel_scope), or None."""
+    return getattr(_local, "cancel_event", None)
+
+
+def is_cancelled():
+    cancel_event = current_cancel_event()
+    return cancel_event is not None and cancel_event.is_set()
+
+
+def cancellable_sleep(seconds, cancel_event=None):
+    """
+    Sleeps, waking up early if the cancel event (default: the current one) is set.
+
+    Returns:
+        bool: True if the sleep was cut short by cancellation.
+    """
+    cancel_event = cancel_event or current_cancel_event()
+    if cancel_event is None:
+        time.sleep(seconds)
+        return False
+    return cancel_event.wait(seconds)
+
+
+def on_cancel(callback, cancel_event=None):
+    """
+    Registers callback with the cancel event (default: the current one) if it is a
+    CancelToken. Returns a handle for remove_on_cancel(), or None.
+    """
+    cancel_event = cancel_event or current_cancel_event()
+    if isinstance(cancel_event, CancelToken):
+        return cancel_event, cancel_event.register(callback)
+    return None
+
+
+def remove_on_cancel(handle):
+    if handle is not None:
+        cancel_event, token_handle = handle
+        cancel_event.unregister(token_handle)
+
+
+def abort_connection(connection):
+    """
+    Shuts down the socket of an HTTP connection, which makes a read or write that is
+    blocked on it in another thread fail at once. The connection is not reused after.
+    """
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
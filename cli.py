@@ -0,0 +1,425 @@
+"""
+Headless command-line entry point for batch downloads (cron, servers).
+
+This module never imports tkinter, and the download modules (requests,
+instacapture) are only imported once a real download starts, so --help and
+--dry-run return immediately.
+
+Examples:
+    python cli.py alice bob
+    python cli.py --users-file watchlist.txt --json
+    cat watchlist.txt | python cli.py --users-file - --no-posts
+    python cli.py --users-file watchlist.txt --enqueue /shared/jobs.sqlite3
+    python cli.py --worker /shared/jobs.sqlite3
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from bandwidth import parse_rate
+from cancel import CancelToken
+from cookies import parse_cookie_sets
+from filters import FilterError, MediaFilter
+from store import LEGACY_CONFIG_FILENAME, STATE_FILENAME, StateStore
+from userlist import read_usernames
+
+
+def load_config(path=None):
+    """
+    Reads the GUI settings from a state store or a legacy config.json file. Without
+    a path, the GUI's state store is used, or its config.json if it was never migrated.
+    """
+    if path is None:
+        path = next((candidate for candidate in (STATE_FILENAME, LEGACY_CONFIG_FILENAME)
+                     if os.path.exists(candidate)), None)
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        is_sqlite = f.read(16) == b"SQLite format 3\x00"
+    if not is_sqlite:
+        with open(path, 'r') as f:
+            return json.load(f)
+    store = StateStore(path)
+    try:
+        return store.settings()
+    finally:
+        store.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="cli.py",
+        description="Download Instagram stories and posts without the GUI.",
+    )
+    parser.add_argument("usernames", nargs="*", help="Usernames to download.")
+    parser.add_argument("-f", "--users-file", metavar="FILE",
+                        help="Read usernames from FILE, one per line ('-' for stdin).")
+    parser.add_argument("-c", "--config", metavar="FILE",
+                        help=f"GUI state store or legacy config.json to take cookies and download path from "
+                             f"(default: {STATE_FILENAME}, else {LEGACY_CONFIG_FILENAME}).")
+    parser.add_argument("--state", metavar="FILE",
+                        help="Record the outcome of every account (last sync time, status, files) in this state store.")
+    parser.add_argument("--cookies", metavar="TEXT", action="append",
+                        help="Cookies in any supported format, or @FILE to read them from a file. Repeat it, or "
+                             "separate sets with a '---' line, to spread the batch over several accounts.")
+    parser.add_argument("-o", "--output", metavar="DIR", help="Download directory (default: from the config file).")
+    parser.add_argument("--no-stories", action="store_true", help="Do not download stories.")
+    parser.add_argument("--no-posts", action="store_true", help="Do not download posts.")
+    parser.add_argument("--types", metavar="LIST",
+                        help="Only download these media types, comma-separated: image, video, reel, carousel.")
+    parser.add_argument("--after", metavar="DATE", help="Only download media posted on or after DATE (YYYY-MM-DD).")
+    parser.add_argument("--before", metavar="DATE", help="Only download media posted before DATE (YYYY-MM-DD).")
+    parser.add_argument("--max-size", metavar="SIZE", help="Skip media files larger than SIZE (e.g. 800K, 20MB).")
+    parser.add_argument("--max-resolution", metavar="PIXELS",
+                        help="Download the largest rendition whose longer side is at most PIXELS (e.g. 1080), "
+                             "skipping media that has none.")
+    parser.add_argument("--max-items", metavar="N",
+                        help="Only download the newest N matching stories and N matching posts per account.")
+    parser.add_argument("--preview", action="store_true",
+                        help="Fetch the listings and print the media that would be downloaded with the current "
+                             "filters, without downloading any media.")
+    parser.add_argument("--archive", choices=("tar", "zip"),
+                        help="Stream the media of every account into one uncompressed archive per day "
+                             "(<user>/<user>-<YYYY-MM-DD>.tar) with a member index, instead of one file per item.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Fetch every profile and listing again instead of using the response cache.")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Users downloaded in parallel.")
+    parser.add_argument("--per-account", type=int, default=None, help="Maximum in-flight media requests per user.")
+    parser.add_argument("--global-limit", type=int, default=None, help="Maximum in-flight media requests overall.")
+    parser.add_argument("--bandwidth", metavar="RATE",
+                        help="Cap the media download bandwidth at RATE bytes/s (e.g. 5M, 800K; 0 for unlimited). "
+                             "Stories get the most of it, then posts of the last week, then older posts.")
+    parser.add_argument("--bandwidth-file", metavar="FILE",
+                        help="Read the bandwidth limit from FILE and apply changes to it while running "
+                             "(e.g. echo 2M > FILE).")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                        help="Write run metrics in Prometheus text format (for the node_exporter textfile collector).")
+    parser.add_argument("--report", metavar="FILE", help="Write a JSON run report with per-account totals.")
+    parser.add_argument("--verify", action="store_true",
+                        help="After the batch, validate the new files (truncated or corrupt images and videos are "
+                             "moved aside and fetched again next time) and hardlink duplicates.")
+    parser.add_argument("--check-archive", action="store_true",
+                        help="Validate and deduplicate every media file in the download directory not checked "
+                             "before, then exit; no usernames are needed.")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="With --check-archive, only validate; do not hardlink duplicates.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Do not journal the batch: download every user again, and leave an unfinished earlier "
+                             "run of the same users to be resumed later.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and poll every account on an adaptive interval, downloading new media "
+                             "as it appears (stop with Ctrl+C). Use with --state to keep the schedule across restarts.")
+    parser.add_argument("--enqueue", metavar="QUEUE",
+                        help="Add the usernames as jobs to the job queue file QUEUE and exit, instead of downloading.")
+    parser.add_argument("--worker", metavar="QUEUE",
+                        help="Take jobs from the job queue file QUEUE and download them until it is empty. Start one "
+                             "worker per process or machine; no usernames are needed.")
+    parser.add_argument("--keep-waiting", action="store_true",
+                        help="With --worker, wait for new jobs instead of exiting when the queue is empty.")
+    parser.add_argument("--queue-status", metavar="QUEUE",
+                        help="Print the job counts and reported totals of the job queue file QUEUE and exit.")
+    parser.add_argument("--batch", metavar="ID", help="Batch ID for --enqueue and --queue-status.")
+    parser.add_argument("--json", action="store_true", help="Write machine-readable JSON lines to stdout.")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Validate the arguments and print what would be downloaded, without any network access.")
+    return parser
+
+
+class _Reporter:
+    """Writes log, progress and result events either as text or as JSON lines."""
+
+    def __init__(self, as_json, stream=sys.stdout):
+        self.as_json = as_json
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._last_progress = -1
+
+    def emit(self, event, **fields):
+        with self._lock:
+            if self.as_json:
+                self.stream.write(json.dumps({"event": event, "time": round(time.time(), 3), **fields}) + "\n")
+            elif event in ("progress", "throughput"):
+                return
+            elif "message" in fields:
+                self.stream.write(f"{fields['message']}\n")
+            else:
+                self.stream.write(" ".join(f"{key}={value}" for key, value in fields.items()) + "\n")
+            self.stream.flush()
+
+    def log(self, message, log_type="info"):
+        self.emit("log", level=log_type, message=message)
+
+    def throughput(self, event):
+        self.emit("throughput", username=event["username"], user=event["user"], batch=event["batch"])
+
+    def progress(self, value):
+        value = int(value)
+        if value != self._last_progress:
+            self._last_progress = value
+            self.emit("progress", value=value)
+
+
+def watch(args, usernames, cookies, cookie_pool, store, download_path, reporter, workers, download_stories, download_posts,
+          media_filter, governor, archive_format):
+    from watch import Watcher
+
+    stop_event = CancelToken()
+    watch_options = {"max_workers": workers} if workers else {}
+    watcher = Watcher(usernames, cookies, download_path, reporter.log, stop_event, download_stories, download_posts,
+                      store=store, cookie_pool=cookie_pool, media_filter=media_filter, governor=governor,
+                      archive_format=archive_format, use_cache=not args.no_cache, **watch_options)
+    stopped = threading.Event()
+
+    def run_watcher():
+        try:
+            watcher.run()
+        finally:
+            stopped.set()
+
+    # Wait on an Event rather than Thread.join: a KeyboardInterrupt that lands inside
+    # join() can leave the thread looking finished while it is still running.
+    threading.Thread(target=run_watcher, name="insta-watcher").start()
+    try:
+        while not stopped.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        reporter.log("Stopping...", "warning")
+        stop_event.set()
+        stopped.wait()
+    finally:
+        if store is not None:
+            store.close()
+    if args.metrics_file:
+        watcher.metrics.write_prometheus_textfile(args.metrics_file)
+    if args.report:
+        watcher.metrics.write_json_report(args.report)
+    return 0
+
+
+def work(args, cookies, cookie_pool, store, download_path, reporter, workers, governor, archive_format,
+         media_filter):
+    from jobqueue import JobQueue, QueueWorker
+
+    stop_event = CancelToken()
+    queue = JobQueue(args.worker)
+    worker_options = {"max_workers": workers} if workers else {}
+    if store is not None:
+        def result_callback(username, status, result):
+            store.record_sync(username, status, result["files"], result["bytes"], result["failed_files"])
+        worker_options["result_callback"] = result_callback
+    worker = QueueWorker(queue, cookies, download_path, reporter.log, stop_event, keep_waiting=args.keep_waiting,
+                         cookie_pool=cookie_pool, governor=governor, archive_format=archive_format,
+                         use_cache=not args.no_cache, media_filter=media_filter, **worker_options)
+    stopped = threading.Event()
+    results = {}
+
+    def run_worker():
+        try:
+            results.update(worker.run())
+        finally:
+            stopped.set()
+
+    threading.Thread(target=run_worker, name="insta-worker").start()
+    try:
+        while not stopped.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        reporter.log("Stopping, running jobs go back to the queue...", "warning")
+        stop_event.set()
+        stopped.wait()
+    finally:
+        queue.close()
+        if store is not None:
+            store.close()
+    if args.metrics_file:
+        worker.metrics.write_prometheus_textfile(args.metrics_file)
+    if args.report:
+        worker.metrics.write_json_report(args.report)
+    failed = sum(1 for status in results.values() if status == "failed")
+    reporter.emit("summary", worker=worker.worker_id, jobs=len(results), failed=failed)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    reporter = _Reporter(args.json)
+
+    usernames = list(args.usernames)
+    if args.users_file:
+        if args.users_file == "-":
+            usernames.extend(read_usernames(sys.stdin))
+        else:
+            with open(args.users_file, 'r') as f:
+                usernames.extend(read_usernames(f))
+    usernames = read_usernames(usernames)
+    if args.queue_status:
+        from jobqueue import JobQueue
+
+        queue = JobQueue(args.queue_status)
+        try:
+            reporter.emit("queue", batch=args.batch, **queue.summary(args.batch))
+        finally:
+            queue.close()
+        return 0
+    if not usernames and not args.worker and not args.check_archive:
+        parser.error("no usernames given")
+
+    download_stories = not args.no_stories
+    download_posts = not args.no_posts
+    if not download_stories and not download_posts:
+        parser.error("--no-stories and --no-posts leave nothing to download")
+
+    config = load_config(args.config)
+    filter_settings = dict(config.get("filters") or {})
+    for key, value in (("media_types", args.types), ("posted_after", args.after), ("posted_before", args.before),
+                       ("max_size", args.max_size), ("max_resolution", args.max_resolution),
+                       ("max_items", args.max_items)):
+        if value is not None:
+            filter_settings[key] = value
+    try:
+        media_filter = MediaFilter.from_settings(filter_settings)
+    except FilterError as e:
+        parser.error(str(e))
+
+    if args.enqueue:
+        from jobqueue import JobQueue
+
+        queue = JobQueue(args.enqueue)
+        try:
+            batch = queue.enqueue(usernames, download_stories, download_posts, batch=args.batch,
+                                  filters=filter_settings if media_filter is not None else None)
+        finally:
+            queue.close()
+        reporter.emit("enqueued", batch=batch, jobs=len(usernames), queue=args.enqueue)
+        return 0
+
+    cookie_sets = []
+    # Checking the archive makes no requests, so it needs no cookies.
+    for cookies_str in [] if args.check_archive else args.cookies or [config.get("cookies", "")]:
+        if cookies_str.startswith("@"):
+            with open(cookies_str[1:], 'r') as f:
+                cookies_str = f.read()
+        parsed = parse_cookie_sets(cookies_str)
+        if parsed is None:
+            parser.error("cookies are missing or could not be parsed (use --cookies or the config file)")
+        cookie_sets.extend(parsed)
+
+    try:
+        bandwidth = parse_rate(args.bandwidth if args.bandwidth is not None else config.get("bandwidth"))
+    except ValueError as e:
+        parser.error(str(e))
+
+    download_path = args.output or config.get("download_path") or os.path.expanduser("~/Downloads/Insta")
+    workers = args.workers or config.get("max_workers")
+    archive_format = args.archive or config.get("archive_format") or None
+
+    if args.check_archive:
+        from integrity import IntegrityChecker
+
+        checker = IntegrityChecker(download_path, dedup=not args.no_dedup, log_callback=reporter.log)
+        try:
+            summary = checker.check()
+            if not args.no_dedup:
+                summary["objects_pruned"] = checker.prune_objects()
+        except KeyboardInterrupt:
+            reporter.log("Interrupted.", "warning")
+            return 130
+        finally:
+            checker.close()
+        reporter.emit("summary", **summary)
+        return 1 if summary["corrupt"] else 0
+
+    if args.dry_run:
+        for username in usernames:
+            reporter.emit("planned", username=username, stories=download_stories, posts=download_posts,
+                          sessions=len(cookie_sets), output=os.path.join(os.path.abspath(download_path), username))
+        return 0
+
+    from cookiepool import CookiePool
+    from engine import DownloadEngine
+
+    engine_options = {}
+    if workers:
+        engine_options["max_workers"] = workers
+    if args.per_account:
+        engine_options["per_account_limit"] = args.per_account
+    if args.global_limit:
+        engine_options["global_limit"] = args.global_limit
+    engine = DownloadEngine(**engine_options)
+
+    governor = None
+    if bandwidth or args.bandwidth_file:
+        from bandwidth import BandwidthGovernor, follow_rate_file
+
+        governor = BandwidthGovernor(bandwidth)
+        if args.bandwidth_file:
+            threading.Thread(target=follow_rate_file, args=(governor, args.bandwidth_file, threading.Event(), reporter.log),
+                             name="insta-bandwidth", daemon=True).start()
+
+    cookie_pool = CookiePool(cookie_sets) if len(cookie_sets) > 1 else None
+    store = StateStore(args.state) if args.state else None
+    result_callback = None
+    if store is not None:
+        def result_callback(username, status, snapshot):
+            store.record_sync(username, status, snapshot["items_done"], snapshot["bytes_done"], snapshot["items_failed"])
+
+    if args.worker:
+        return work(args, cookie_sets[0], cookie_pool, store, download_path, reporter, workers, governor,
+                    archive_format, media_filter)
+    if args.watch:
+        return watch(args, usernames, cookie_sets[0], cookie_pool, store, download_path, reporter, workers,
+                     download_stories, download_posts, media_filter, governor, archive_format)
+
+    download_options = {"media_filter": media_filter, "governor": governor, "archive_format": archive_format}
+    if args.no_cache:
+        download_options["cache"] = None
+    planned = []
+    if args.preview:
+        def preview(username, kind, entry):
+            planned.append(entry)
+            taken_at = time.strftime("%Y-%m-%d %H:%M", time.gmtime(entry['taken_at'])) if entry['taken_at'] else None
+            reporter.emit("would_fetch", username=username, kind=kind, id=entry['id'], type=entry['media_type'],
+                          taken_at=taken_at, width=entry['width'], height=entry['height'])
+        download_options["preview_callback"] = preview
+        result_callback = None
+
+    cancel_event = CancelToken()
+    started = time.monotonic()
+    try:
+        results = engine.run(usernames, cookie_sets[0], download_path, reporter.log, reporter.progress, cancel_event,
+                             download_stories, download_posts, event_callback=reporter.throughput,
+                             result_callback=result_callback, cookie_pool=cookie_pool,
+                             resume=not args.no_resume and not args.preview, verify=args.verify and not args.preview,
+                             **download_options)
+    except KeyboardInterrupt:
+        cancel_event.set()
+        reporter.log("Interrupted.", "warning")
+        return 130
+    finally:
+        if store is not None:
+            store.close()
+
+    if args.metrics_file:
+        engine.metrics.write_prometheus_textfile(args.metrics_file)
+    if args.report:
+        engine.metrics.write_json_report(args.report)
+
+    for username, status in results.items():
+        reporter.emit("result", username=username, status=status)
+    if engine.integrity is not None:
+        reporter.emit("integrity", **engine.integrity)
+    failed = sum(1 for status in results.values() if status != "done")
+    if args.preview:
+        reporter.emit("summary", users=len(results), failed=failed, would_fetch=len(planned),
+                      seconds=round(time.monotonic() - started, 3))
+        return 1 if failed else 0
+    reporter.emit("summary", users=len(results), failed=failed, seconds=round(time.monotonic() - started, 3))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import listing
+from ratelimit import RateLimiter
+from session import DownloadSession
+
+ACTIVE = "active"
+COOLING = "cooling"
+EXPIRED = "expired"
+
+# A session leaves rotation after THROTTLE_STRIKES API 429s within THROTTLE_WINDOW
+# seconds; single 429s are absorbed by the session's own rate limiter.
+THROTTLE_STRIKES = 3
+THROTTLE_WINDOW = 60.0
+# Seconds a throttled session is kept out of rotation; doubled every time it is
+# benched again before completing a user, up to MAX_COOLDOWN.
+DEFAULT_COOLDOWN = 30.0
+MAX_COOLDOWN = 300.0
+# Seconds between cancel_event checks while every session is cooling down.
+WAIT_POLL_INTERVAL = 0.5
+# API error bodies that mean the cookies are no longer logged in.
+LOGIN_ERRORS = ("login_required", "checkpoint_required", "challenge_required")
+
+
+class NoHealthySession(Exception):
+    """Raised when every session of a CookiePool has expired."""
+
+
+class PooledSession:
+    """One authenticated cookie set of a CookiePool, with its own HTTP session, rate limiter and health."""
+
+    def __init__(self, label, cookies):
+        self.label = label
+        self.cookies = cookies
+        self.session = None
+        self.rate_limiter = None
+        self.state = ACTIVE
+        self.reason = None
+        self.cooldown_until = 0.0
+        self.recent_throttles = []
+        self.benched = 0
+        # Incremented whenever the session leaves rotation, so release() can tell
+        # whether it stayed healthy during a job.
+        self.generation = 0
+        self.active_jobs = 0
+        self.jobs = 0
+        self.throttles = 0
+
+    def snapshot(self):
+        return {
+            "label": self.label,
+            "state": self.state,
+            "reason": self.reason,
+            "active_jobs": self.active_jobs,
+            "jobs": self.jobs,
+            "throttles": self.throttles,
+        }
+
+
+def _label_for(cookies, index):
+    user_id = cookies.get("ds_user_id")
+    return f"session {index + 1}" + (f" ({user_id})" if user_id else "")
+
+
+class CookiePool:
+    """
+    Several authenticated cookie sets that a batch spreads its users across.
+
+    Every cookie set gets its own DownloadSession and RateLimiter, so each account
+    is paced by its own limits and the batch throughput grows with the number of
+    sessions. A session that keeps getting throttled by the API (HTTP 429) is taken
+    out of rotation for a cooldown; one whose cookies stopped being logged in (HTTP 401,
+    a redirect to the login page or a login_required error) is retired for good.
+    acquire() always hands out the least busy session in rotation.
+    """
+
+    def __init__(self, cookie_sets, cooldown=DEFAULT_COOLDOWN, max_cooldown=MAX_COOLDOWN, clock=time.monotonic):
+        """
+        Args:
+            cookie_sets (list): The cookie dicts, one per Instagram account.
+            cooldown (float): Seconds a throttled session is out of rotation the first time.
+            max_cooldown (float): Upper bound for the doubling cooldown.
+            clock (function): Monotonic time source.
+        """
+        if not cookie_sets:
+            raise ValueError("CookiePool needs at least one cookie set")
+        self.sessions = [PooledSession(_label_for(cookies, i), cookies) for i, cookies in enumerate(cookie_sets)]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.log_callback = None
+        self._changed = threading.Condition()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self, metrics=None, log_callback=None):
+        """Creates a fresh HTTP session and rate limiter for every cookie set; called at the start of a batch."""
+        self.log_callback = log_callback
+        for pooled in self.sessions:
+            pooled.rate_limiter = RateLimiter(
+                on_rate_change=lambda host, rate, reason, pooled=pooled: self._on_rate_change(pooled, host, rate, reason))
+            pooled.session = DownloadSession(rate_limiter=pooled.rate_limiter, metrics=metrics)
+            pooled.session.hooks["response"].append(
+                lambda response, *args, pooled=pooled, **kwargs: self._check_login(pooled, response))
+
+    def close(self):
+        for pooled in self.sessions:
+            if pooled.session is not None:
+                pooled.session.close()
+                pooled.session = None
+
+    def healthy_count(self):
+        """Returns how many sessions have not expired."""
+        with self._changed:
+            return sum(1 for pooled in self.sessions if pooled.state != EXPIRED)
+
+    def _log(self, message):
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def _on_rate_change(self, pooled, host, rate, reason):
+        # Only API throttling is tied to the account; CDN media URLs are signed and shared.
+        if host == urlsplit(listing.INSTAGRAM_URL).netloc and reason == "HTTP 429":
+            self.mark_throttled(pooled)
+        else:
+            self._log(f"Throttled by {host} ({reason}) on {pooled.label}, slowing down to {rate:.2f} requests/s.")
+
+    def _check_login(self, pooled, response):
+        url = urlsplit(response.url)
+        if url.netloc != urlsplit(listing.INSTAGRAM_URL).netloc or response.status_code == 200:
+            return
+        location = response.headers.get("Location", "")
+        if response.status_code == 401:
+            self.mark_expired(pooled, "HTTP 401")
+        elif response.is_redirect and ("/accounts/login" in location or "/challenge" in location):
+            self.mark_expired(pooled, "redirected to the login page")
+        elif response.status_code in (400, 403):
+            error = next((error for error in LOGIN_ERRORS if error in response.text), None)
+            if error:
+                self.mark_expired(pooled, error)
+
+    def mark_throttled(self, pooled):
+        """
+        Counts an API 429 for a session and takes it out of rotation once it got
+        THROTTLE_STRIKES of them within THROTTLE_WINDOW seconds.
+        """
+        with self._changed:
+            pooled.throttles += 1
+            now = self.clock()
+            pooled.recent_throttles = [t for t in pooled.recent_throttles if now - t < THROTTLE_WINDOW] + [now]
+            if pooled.state != ACTIVE or len(pooled.recent_throttles) < THROTTLE_STRIKES:
+                return
+            cooldown = min(self.max_cooldown, self.cooldown * (2 ** pooled.benched))
+            pooled.benched += 1
+            pooled.recent_throttles = []
+            pooled.state = COOLING
+            pooled.reason = "HTTP 429"
+            pooled.cooldown_until = now + cooldown
+            pooled.generation += 1
+            self._changed.notify_all()
+        self._log(f"{pooled.label} is throttled by Instagram, taking it out of rotation for {cooldown:.0f}s.")
+
+    def mark_expired(self, pooled, reason):
+        """Retires a session whose cookies are no longer logged in."""
+        with self._changed:
+            if pooled.state == EXPIRED:
+                return
+            pooled.state = EXPIRED
+            pooled.reason = reason
+            pooled.generation += 1
+            self._changed.notify_all()
+        self._log(f"{pooled.label} is no longer logged in ({reason}), removing it from the pool. Refresh its cookies.")
+
+    def _wake_cooled(self, now):
+        for pooled in self.sessions:
+            if pooled.state == COOLING and now >= pooled.cooldown_until:
+                pooled.state = ACTIVE
+                pooled.reason = None
+
+    def acquire(self, cancel_event=None):
+        """
+        Returns the least busy session in rotation, waiting while every session is cooling down.
+
+        Returns:
+            PooledSession: The session to use, or None if cancel_event was set while waiting.
+
+        Raises:
+            NoHealthySession: If every session has expired.
+        """
+        with self._changed:
+            while True:
+                now = self.clock()
+                self._wake_cooled(now)
+                active = [pooled for pooled in self.sessions if pooled.state == ACTIVE]
+                if active:
+                    pooled = min(active, key=lambda candidate: (candidate.active_jobs, candidate.jobs))
+                    pooled.active_jobs += 1
+                    pooled.jobs += 1
+                    return pooled
+                cooling = [pooled.cooldown_until for pooled in self.sessions if pooled.state == COOLING]
+                if not cooling:
+                    raise NoHealthySession("Every cookie session has expired. Refresh the cookies.")
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                self._changed.wait(min(WAIT_POLL_INTERVAL, max(0.0, min(cooling) - now)))
+
+    def release(self, pooled, completed=True):
+        """
+        Returns a session after a job. A session that completed a user without leaving
+        rotation starts over with the shortest cooldown.
+        """
+        with self._changed:
+            pooled.active_jobs -= 1
+            if completed and pooled.state == ACTIVE:
+                pooled.benched = 0
+            self._changed.notify_all()
+
+    def stats(self):
+        """Returns the state, job count and throttle count of every session."""
+        with self._changed:
+            return [pooled.snapshot() for pooled in self.sessions]
+
+    def connection_stats(self):
+        """Returns the connection pool counters summed over every session."""
+        totals = {"checkouts": 0, "new_connections": 0, "reused_connections": 0, "wait_seconds": 0.0}
+        for pooled in self.sessions:
+            if pooled.session is not None:
+                for key, value in pooled.session.stats().items():
+                    totals[key] += value
+        totals["wait_seconds"] = round(totals["wait_seconds"], 3)
+        return totals
@@ -0,0 +1,82 @@
+import ast
+import json
+import re
+
+
+def parse_cookies(cookies_str):
+    """
+    Parses Instagram cookies pasted in any of the supported formats.
+
+    Supported formats are a Python snippet containing 'cookies = {...}' (as produced
+    by curlconverter), a JSON object, and a 'key=value; key=value' string.
+
+    Args:
+        cookies_str (str): The pasted cookies.
+
+    Returns:
+        dict: The parsed cookies, or None if the text matches none of the formats.
+    """
+    cookies_str = (cookies_str or "").strip()
+    if not cookies_str:
+        return None
+
+    cookies = None
+    if "cookies = {" in cookies_str:
+        match = re.search(r"cookies\s*=\s*(\{.*?\})", cookies_str, re.DOTALL)
+        if match:
+            try:
+                cookies = ast.literal_eval(match.group(1))
+            except (ValueError, SyntaxError):
+                pass
+
+    if cookies is None:
+        try:
+            cookies = json.loads(cookies_str)
+        except json.JSONDecodeError:
+            pass
+
+    if cookies is None:
+        try:
+            items = [item for item in cookies_str.split(';') if item.strip()]
+            if all('=' in item for item in items):
+                cookies = {k.strip(): v.strip() for k, v in (item.split('=', 1) for item in items)}
+            else:
+                raise ValueError("Invalid semicolon-separated format")
+        except Exception:
+            pass
+
+    return cookies if isinstance(cookies, dict) else None
+
+
+# A line consisting only of this separates the cookie sets of several accounts.
+COOKIE_SET_SEPARATOR = "---"
+
+
+def parse_cookie_sets(cookies_str):
+    """
+    Parses one or more cookie sets, e.g. the sessions of several Instagram accounts.
+
+    Sets are separated by a line containing only '---', and each set may use any
+    format parse_cookies accepts. A JSON array of objects is accepted as well.
+
+    Args:
+        cookies_str (str): The pasted cookies.
+
+    Returns:
+        list: The parsed cookie dicts, or None if the text is empty or any set fails to parse.
+    """
+    cookies_str = (cookies_str or "").strip()
+    if cookies_str.startswith("["):
+        try:
+            sets = json.loads(cookies_str)
+        except json.JSONDecodeError:
+            return None
+        if sets and all(isinstance(cookies, dict) for cookies in sets):
+            return sets
+        return None
+
+    blocks = re.split(rf"^\s*{re.escape(COOKIE_SET_SEPARATOR)}\s*$", cookies_str, flags=re.MULTILINE)
+    sets = [parse_cookies(block) for block in blocks if block.strip()]
+    if not sets or any(cookies is None for cookies in sets):
+        return None
+    return sets
@@ -1,71 +1,544 @@
-from instacapture import InstaStory, InstaPost
+import json
 import os
+import threading
+import time
+from urllib.parse import urlsplit
 
-def download_media(username, cookies, download_path, log_callback, progress_callback, cancel_event, download_stories=True, download_posts=True):
+import requests
+
+from archive import MAX_TRANSFERS, ArchiveError, ArchiveSet
+from bandwidth import priority_for
+from cancel import cancel_scope
+from fetcher import NOT_STARTED, MediaFetcher
+from journal import DONE, FAILED, PENDING, RUNNING
+from listing import PagePrefetcher, fetch_profile, fetch_story_reel, iter_post_pages, media_entries
+from manifest import Manifest
+from metrics import MetricsRegistry
+from progress import ProgressTracker
+from ratelimit import RateLimiter
+from session import DownloadSession
+from transfer import MediaTooLarge, TransferCancelled, stream_to_file
+
+CANCELLED = "cancelled"
+SKIPPED = "skipped"
+
+# The account's profile picture, saved in its directory next to "stories" and "posts".
+PROFILE_PICTURE = "profile.jpg"
+
+# Post pagination stops once this many consecutive media items are already in the manifest.
+KNOWN_RUN_LIMIT = 24
+
+
+def download_status(statuses, cancel_event):
+    """
+    Sums up the phase statuses download_media returned for one user.
+
+    Returns:
+        str: "failed" if a phase failed, otherwise "cancelled" if cancel_event is set,
+        otherwise "done".
+    """
+    if FAILED in (statuses or {}).values():
+        return FAILED
+    return CANCELLED if cancel_event.is_set() else DONE
+
+
+def user_output_dirs(download_path, username):
+    """
+    Returns the per-job output directories for a user.
+
+    Args:
+        download_path (str): The root download directory.
+        username (str): The Instagram username.
+
+    Returns:
+        dict: {"stories": <root>/<username>/stories, "posts": <root>/<username>/posts}
+    """
+    user_dir = os.path.join(os.path.abspath(download_path), username)
+    return {
+        "stories": os.path.join(user_dir, "stories"),
+        "posts": os.path.join(user_dir, "posts"),
+    }
+
+
+class _Job:
+    """Per-user state shared by the story and post phases of download_media."""
+
+    def __init__(self, username, cookies, session, manifest, fetcher, tracker, metrics, cancel_event, log_callback,
+                 journal=None, media_filter=None, preview_callback=None, governor=None, archives=None, cache=None):
+        self.username = username
+        self.cookies = cookies
+        self.session = session
+        self.manifest = manifest
+        self.fetcher = fetcher
+        self.tracker = tracker
+        self.metrics = metrics
+        self.cancel_event = cancel_event
+        self.log_callback = log_callback
+        self.journal = journal
+        self.media_filter = media_filter
+        self.preview_callback = preview_callback
+        self.governor = governor
+        self.archives = archives
+        self.cache = cache
+        # Entries the media filter skipped in the current phase, by reason.
+        self.filtered = {}
+        # Called after every finished item; download_media points it at the current phase.
+        self.on_item_finished = None
+
+    def bytes_transferred(self, nbytes):
+        self.tracker.bytes_transferred(self.username, nbytes)
+
+    def item_finished(self, failed=False):
+        self.tracker.item_finished(self.username, failed)
+        if self.on_item_finished is not None:
+            self.on_item_finished()
+
+
+def _fetch_entry(job, kind, entry, output_dir):
+    local_path = os.path.join(output_dir, f"{entry['id']}{entry['ext']}")
+    max_bytes = job.media_filter.max_size if job.media_filter is not None else None
+    on_bytes = job.bytes_transferred
+    if job.governor is not None:
+        priority = priority_for(kind, entry['taken_at'])
+
+        def on_bytes(nbytes):
+            job.bytes_transferred(nbytes)
+            waited = job.governor.consume(nbytes, priority, job.cancel_event)
+            if waited:
+                job.metrics.inc("insta_bandwidth_wait_seconds_total", waited, priority=priority)
+    try:
+        with cancel_scope(job.cancel_event):
+            if job.archives is not None:
+                size, local_path = job.archives.fetch(job.session, kind, entry, job.cancel_event, on_bytes=on_bytes,
+                                                      max_bytes=max_bytes)
+            else:
+                # A journaled batch resumes its partial files; otherwise cancelling cleans them up.
+                size = stream_to_file(job.session, entry['url'], local_path, job.cancel_event, on_bytes=on_bytes,
+                                      max_bytes=max_bytes, keep_partial=job.journal is not None)
+    except MediaTooLarge:
+        job.tracker.item_skipped(job.username)
+        job.metrics.inc("insta_filtered_total", kind=kind, reason="size")
+        if job.on_item_finished is not None:
+            job.on_item_finished()
+        return None
+    except BaseException as e:
+        job.item_finished(failed=True)
+        if not isinstance(e, TransferCancelled):
+            job.metrics.inc("insta_failures_total", stage=kind, cause=type(e).__name__)
+            job.metrics.account(job.username, failures=1)
+        raise
+    job.manifest.record(job.username, entry['id'], kind, local_path, size)
+    job.metrics.inc("insta_media_files_total", kind=kind)
+    job.metrics.inc("insta_media_bytes_total", size, kind=kind)
+    job.metrics.account(job.username, files=1, bytes=size)
+    job.item_finished()
+    return size
+
+
+def _transfer_limit(job):
+    """The in-flight limit for the job's media: an archive takes one member at a time."""
+    return MAX_TRANSFERS if job.archives is not None else None
+
+
+def _fetch_new_entries(job, kind, entries, output_dir):
+    """
+    Fetches entries concurrently through the fetcher and returns how many were
+    downloaded. In a preview, the entries are only reported to preview_callback.
+    """
+    if not entries:
+        return 0
+    if job.preview_callback is not None:
+        for entry in entries:
+            job.preview_callback(job.username, kind, entry)
+        return len(entries)
+    if job.archives is None:
+        os.makedirs(output_dir, exist_ok=True)
+    job.tracker.items_found(job.username, len(entries))
+
+    results = job.fetcher.fetch_all(lambda entry: _fetch_entry(job, kind, entry, output_dir), entries, job.cancel_event,
+                                    limit=_transfer_limit(job))
+    return sum(_handle_result(job, kind, entry, result) for entry, result in zip(entries, results))
+
+
+def _handle_result(job, kind, entry, result):
+    """Logs or re-raises the outcome of one fetch. Returns True if the entry was downloaded."""
+    if result is NOT_STARTED or isinstance(result, TransferCancelled):
+        return False
+    if isinstance(result, (requests.RequestException, OSError)):
+        job.log_callback(f"Could not download {kind} media {entry['id']} for @{job.username}: {result}")
+        return False
+    if isinstance(result, BaseException):
+        raise result
+    if result is None:
+        job.filtered["size"] = job.filtered.get("size", 0) + 1
+        return False
+    return True
+
+
+def _admit(job, kind, entry, budget):
+    """
+    Applies the media filter to one entry, newest first. Returns False if it is
+    skipped; budget is the one-element list holding the remaining item cap.
+    """
+    media_filter = job.media_filter
+    if media_filter is None:
+        return True
+    reason = media_filter.rejects(entry)
+    if reason is None and budget[0] is not None:
+        if budget[0] <= 0:
+            reason = "cap"
+        else:
+            budget[0] -= 1
+    if reason is None:
+        return True
+    job.filtered[reason] = job.filtered.get(reason, 0) + 1
+    job.metrics.inc("insta_filtered_total", kind=kind, reason=reason)
+    return False
+
+
+def _log_filtered(job, phase):
+    if job.filtered:
+        reasons = ", ".join(f"{reason}: {count}" for reason, count in sorted(job.filtered.items()))
+        job.log_callback(f"Skipped {sum(job.filtered.values())} {phase} item(s) of @{job.username} "
+                         f"because of the filters ({reasons}).")
+
+
+def _item_id(item):
+    return str(item.get('pk') or item.get('id')).split('_')[0]
+
+
+def _save_metadata(job, kind, items, new_entries, output_dir):
+    """
+    Saves the raw listing JSON of every item with new media as <item id>.json next to
+    its media files (or into the archive), so captions, dimensions and the like are
+    kept alongside the media.
+    """
+    if job.preview_callback is not None or not new_entries:
+        return
+    new_ids = {entry['id'] for entry in new_entries}
+    for item in items:
+        if not any(entry['id'] in new_ids for entry in media_entries(item)):
+            continue
+        name = f"{_item_id(item)}.json"
+        data = json.dumps(item, ensure_ascii=False).encode('utf-8')
+        try:
+            if job.archives is not None:
+                job.archives.add_bytes(kind, name, data, item.get('taken_at'))
+            else:
+                os.makedirs(output_dir, exist_ok=True)
+                path = os.path.join(output_dir, name)
+                with open(f"{path}.tmp", 'wb') as f:
+                    f.write(data)
+                os.replace(f"{path}.tmp", path)
+        except (OSError, ArchiveError) as e:
+            job.log_callback(f"Could not save the metadata of {kind} {_item_id(item)} for @{job.username}: {e}")
+
+
+def _save_profile_picture(job, url, user_dir):
+    """
+    Saves the account's profile picture as <user_dir>/profile.jpg, again only when it
+    changed: the manifest records which picture (by its file name on the CDN) is saved.
+    """
+    if not url or job.preview_callback is not None:
+        return
+    picture_id = f"profile:{os.path.basename(urlsplit(url).path)}"
+    if job.manifest.known_among(job.username, [picture_id]):
+        return
+    path = os.path.join(user_dir, PROFILE_PICTURE)
+    try:
+        os.makedirs(user_dir, exist_ok=True)
+        with cancel_scope(job.cancel_event):
+            size = stream_to_file(job.session, url, path, job.cancel_event, keep_partial=False)
+    except TransferCancelled:
+        return
+    except (requests.RequestException, OSError) as e:
+        job.log_callback(f"Could not download the profile picture of @{job.username}: {e}")
+        return
+    job.manifest.record(job.username, picture_id, "profile", path, size)
+
+
+def _download_stories(job, output_dir):
+    reel = fetch_story_reel(job.session, job.username, job.cookies, job.cache) or {}
+    _save_profile_picture(job, (reel.get('user') or {}).get('profile_pic_url'), os.path.dirname(output_dir))
+    entries = [entry for item in reel.get('items', []) for entry in media_entries(item)]
+    if not entries:
+        return 0, 0
+
+    # The reel lists the oldest story first; the item cap keeps the newest ones.
+    entries.sort(key=lambda entry: entry['taken_at'] or 0, reverse=True)
+    budget = [job.media_filter.max_items if job.media_filter is not None else None]
+    entries = [entry for entry in entries if _admit(job, "story", entry, budget)]
+    known = job.manifest.known_ids(job.username, "story")
+    new_entries = [entry for entry in entries if entry['id'] not in known]
+    _save_metadata(job, "story", reel['items'], new_entries, output_dir)
+    fetched = _fetch_new_entries(job, "story", new_entries, output_dir)
+    _log_filtered(job, "story")
+    return fetched, len(entries) - len(new_entries)
+
+
+def _iter_new_posts(job, pages, output_dir, counts):
+    """
+    Yields the post entries to download, one listing page at a time: entries the
+    media filter rejects are dropped, those already in the manifest are counted in
+    counts["skipped"], and pagination stops as soon as nothing further can be new
+    or match the filter. Only the current page is held in memory.
+    """
+    budget = [job.media_filter.max_items if job.media_filter is not None else None]
+    known_run = 0
+    for page in pages:
+        if job.cancel_event.is_set():
+            return
+        page_entries = [entry for item in page for entry in media_entries(item)]
+        admitted = [entry for entry in page_entries if _admit(job, "post", entry, budget)]
+        known = job.manifest.known_among(job.username, [entry['id'] for entry in admitted])
+        new_entries = []
+        for entry in admitted:
+            if entry['id'] in known:
+                counts["skipped"] += 1
+                known_run += 1
+            else:
+                known_run = 0
+                new_entries.append(entry)
+        if new_entries and job.preview_callback is None:
+            if job.archives is None:
+                os.makedirs(output_dir, exist_ok=True)
+            job.tracker.items_found(job.username, len(new_entries))
+        _save_metadata(job, "post", page, new_entries, output_dir)
+        yield from new_entries
+        if known_run >= KNOWN_RUN_LIMIT:
+            job.log_callback(f"Reached {known_run} already downloaded posts for @{job.username}, stopping early.")
+            return
+        if job.media_filter is not None:
+            # The feed is newest first (apart from pinned posts), so nothing further can match.
+            if budget[0] is not None and budget[0] <= 0:
+                return
+            if page_entries and all(job.media_filter.older_than_window(entry) for entry in page_entries):
+                return
+
+
+def _post_pages(job, output_dir):
+    profile = fetch_profile(job.session, job.username, job.cookies, job.cache)
+    _save_profile_picture(job, profile['profile_pic_url'], os.path.dirname(output_dir))
+    yield from iter_post_pages(job.session, profile['id'], job.cookies, job.cache)
+
+
+def _download_posts(job, output_dir):
+    """
+    Streams a user's feed into the fetcher: the media of a listing page start
+    downloading as soon as the page arrives, while the next page is requested in
+    the background, so neither memory nor the time to the first download grows
+    with the length of the account's history.
+    """
+    counts = {"fetched": 0, "skipped": 0}
+    pages = PagePrefetcher(_post_pages(job, output_dir), job.cancel_event)
+    try:
+        entries = _iter_new_posts(job, pages, output_dir, counts)
+        if job.preview_callback is not None:
+            for entry in entries:
+                job.preview_callback(job.username, "post", entry)
+                counts["fetched"] += 1
+        else:
+            def on_result(entry, result):
+                if _handle_result(job, "post", entry, result):
+                    counts["fetched"] += 1
+
+            job.fetcher.fetch_stream(lambda entry: _fetch_entry(job, "post", entry, output_dir), entries,
+                                     job.cancel_event, on_result, limit=_transfer_limit(job))
+    finally:
+        pages.close()
+    _log_filtered(job, "post")
+    return counts["fetched"], counts["skipped"]
+
+
+def _run_phase(job, phase, download_phase, output_dir):
+    """
+    Runs one phase, recording its duration and, if it fails, the cause. With a
+    batch journal, the phase is journaled as running first and as done, failed
+    (an error or files that failed) or pending again (cancelled) afterwards.
+    """
+    started = time.monotonic()
+    job.filtered = {}
+    failed_before = job.tracker.snapshot(job.username)["items_failed"]
+    if job.journal is not None:
+        job.journal.mark(job.username, phase, RUNNING)
+    try:
+        with cancel_scope(job.cancel_event):
+            result = download_phase(job, output_dir)
+    except Exception as e:
+        if not job.cancel_event.is_set():
+            job.metrics.inc("insta_failures_total", stage=phase, cause=type(e).__name__)
+            job.metrics.account(job.username, failures=1)
+        if job.journal is not None:
+            job.journal.mark(job.username, phase, PENDING if job.cancel_event.is_set() else FAILED, str(e))
+        raise
+    else:
+        if job.journal is not None:
+            failed = job.tracker.snapshot(job.username)["items_failed"] - failed_before
+            if job.cancel_event.is_set():
+                job.journal.mark(job.username, phase, PENDING)
+            elif failed:
+                job.journal.mark(job.username, phase, FAILED, f"{failed} file(s) failed")
+            else:
+                job.journal.mark(job.username, phase, DONE)
+        return result
+    finally:
+        duration = time.monotonic() - started
+        job.metrics.observe("insta_phase_duration_seconds", duration, phase=phase)
+        job.metrics.account(job.username, **{f"{phase}_seconds": round(duration, 3)})
+
+
+def _phase_progress(job, progress_callback, step, total_steps):
+    """
+    Returns a callback that reports the user's progress within one phase.
+
+    The phase fraction is finished items over items discovered so far in this
+    phase. Post pages are discovered as they are fetched, so the value is kept
+    monotonic instead of jumping back when a new page arrives.
+    """
+    base_found, base_finished = job.tracker.user_counts(job.username)
+    last = [int(step / total_steps * 100)]
+    lock = threading.Lock()
+
+    def report():
+        found, finished = job.tracker.user_counts(job.username)
+        fraction = (finished - base_finished) / (found - base_found) if found > base_found else 0
+        value = int((step + min(fraction, 1)) / total_steps * 100)
+        with lock:
+            if value <= last[0]:
+                return
+            last[0] = value
+        progress_callback(value)
+
+    return report
+
+
+def download_media(username, cookies, download_path, log_callback, progress_callback, cancel_event, download_stories=True, download_posts=True, manifest=None, session=None, fetcher=None, tracker=None, metrics=None, journal=None, media_filter=None, preview_callback=None, governor=None, archive_format=None, cache=None, counts=None):
     """
     Downloads stories and/or posts for a given Instagram username.
 
+    Every file is written through an explicit per-job directory
+    (<download_path>/<username>/stories and <download_path>/<username>/posts),
+    and the process working directory is never touched, so this function can
+    run from many threads at once. Media already recorded in the manifest is
+    skipped before any bytes are transferred, and the remaining media files of
+    the user are fetched concurrently by a MediaFetcher.
+
     Args:
         username (str): The Instagram username.
         cookies (dict): The cookies for authentication.
-        download_path (str): The path to save the downloaded media.
+        download_path (str): The root path to save the downloaded media.
         log_callback (function): A function to call for logging progress.
         progress_callback (function): A function to call to update progress (0-100).
-        cancel_event (threading.Event): An event to signal cancellation.
+        cancel_event (threading.Event): An event to signal cancellation. A CancelToken
+            also aborts the requests in flight the moment it is set.
         download_stories (bool): Whether to download stories.
         download_posts (bool): Whether to download posts.
-    """
-    if not os.path.exists(download_path):
-        os.makedirs(download_path)
+        manifest (Manifest): Optional, the index of already fetched media. Defaults to
+            the manifest in the root of download_path.
+        session (requests.Session): Optional, the HTTP session to use. Pass one shared
+            DownloadSession to reuse connections across users.
+        fetcher (MediaFetcher): Optional, the concurrent media fetcher. Pass one shared
+            fetcher to enforce a global in-flight request limit across users.
+        tracker (ProgressTracker): Optional, counts items and bytes for throughput and
+            ETA reporting. Pass one shared tracker to get batch-wide numbers.
+        metrics (MetricsRegistry): Optional, records phase durations, files, bytes and
+            failures (overall and per account) for the run report.
+        journal (JournalBatch): Optional, the batch journal. Phases it already has as
+            finished are skipped, and every phase that runs is journaled.
+        media_filter (MediaFilter): Optional, decides from the listing metadata which
+            media is downloaded at all.
+        preview_callback (function): Optional, turns the call into a preview: the
+            listings are fetched and filtered as usual, but every media entry that
+            would be downloaded is passed to preview_callback(username, kind, entry)
+            instead, and nothing is written.
+        governor (BandwidthGovernor): Optional, the shared bandwidth budget every media
+            transfer draws from, with stories ahead of recent posts ahead of backfill.
+        archive_format (str): Optional, "tar" or "zip" to stream the media into one
+            archive per day (<download_path>/<username>/<username>-<YYYY-MM-DD>.tar)
+            instead of writing a file per media item. See archive.ArchiveWriter.
+        cache (ResponseCache): Optional, caches the profile lookup and the story and
+            post listings, so an account that did not change costs few or no requests.
+        counts (dict): Optional, receives phase -> how many media items the phase
+            downloaded (listed, in a preview) for every phase that completed.
 
-    original_cwd = os.getcwd()
-    os.chdir(download_path)
+    Returns:
+        dict: phase ("stories", "posts") -> "done", "failed" (the phase raised, e.g.
+        the user does not exist), "skipped" (finished earlier in the journaled batch)
+        or "cancelled", for every phase that was reached. See download_status.
+    """
+    output_dirs = user_output_dirs(download_path, username)
+    own_manifest = manifest is None
+    if own_manifest:
+        manifest = Manifest.for_download_path(download_path)
+    own_session = session is None
+    if own_session:
+        session = DownloadSession(rate_limiter=RateLimiter())
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = MediaFetcher()
+    if tracker is None:
+        tracker = ProgressTracker()
+    if metrics is None:
+        metrics = MetricsRegistry()
+    archives = None
+    if archive_format and preview_callback is None:
+        archives = ArchiveSet(download_path, username, archive_format)
+    job = _Job(username, cookies, session, manifest, fetcher, tracker, metrics, cancel_event, log_callback, journal,
+               media_filter, preview_callback, governor, archives, cache)
 
+    statuses = {}
     try:
         log_callback(f"Starting download for @{username}...")
         progress_callback(0)
 
         if cancel_event.is_set():
             log_callback(f"Cancelled before starting download for @{username}.")
-            return
-
-        total_steps = int(download_stories) + int(download_posts)
-        current_step = 0
+            return statuses
 
-        # Story download
-        if download_stories:
-            if cancel_event.is_set():
-                log_callback(f"Download cancelled for @{username}.")
-                return
-            try:
-                log_callback(f"Downloading stories for @{username}...")
-                story_obj = InstaStory()
-                story_obj.cookies = cookies
-                story_obj.username = username
-                story_obj.story_download()
-                log_callback(f"Successfully downloaded stories for @{username}.")
-            except Exception as e:
-                log_callback(f"Could not download stories for @{username}: {e}")
-            current_step += 1
-            progress_callback(int((current_step / total_steps) * 100))
-
-        # Post download
-        if download_posts:
+        verb = "Listed" if preview_callback is not None else "Successfully downloaded"
+        phases = [(phase, download_phase) for phase, download_phase, enabled in
+                  (("stories", _download_stories, download_stories), ("posts", _download_posts, download_posts))
+                  if enabled]
+        for current_step, (phase, download_phase) in enumerate(phases):
             if cancel_event.is_set():
                 log_callback(f"Download cancelled for @{username}.")
-                return
-            try:
-                log_callback(f"Downloading posts for @{username}...")
-                post_obj = InstaPost()
-                post_obj.cookies = cookies
-                post_obj.reel_id = username
-                post_obj.media_download()
-                log_callback(f"Successfully downloaded posts for @{username}.")
-            except Exception as e:
-                log_callback(f"Could not download posts for @{username}: {e}")
-            current_step += 1
-            progress_callback(int((current_step / total_steps) * 100))
+                statuses[phase] = CANCELLED
+                return statuses
+            if journal is not None and not journal.should_run(username, phase):
+                log_callback(f"{phase.capitalize()} of @{username} were already downloaded in this batch, skipping.")
+                statuses[phase] = SKIPPED
+            else:
+                try:
+                    log_callback(f"Downloading {phase} for @{username}...")
+                    job.on_item_finished = _phase_progress(job, progress_callback, current_step, len(phases))
+                    fetched, skipped = _run_phase(job, phase, download_phase, output_dirs[phase])
+                    if cancel_event.is_set():
+                        # The phase stopped taking new media, so it did not finish.
+                        log_callback(f"Download cancelled for @{username}.")
+                        statuses[phase] = CANCELLED
+                        return statuses
+                    if counts is not None:
+                        counts[phase] = fetched
+                    log_callback(f"{verb} {phase} for @{username} ({fetched} new, {skipped} already downloaded).")
+                    statuses[phase] = DONE
+                except Exception as e:
+                    if cancel_event.is_set():
+                        log_callback(f"Download cancelled for @{username}.")
+                        statuses[phase] = CANCELLED
+                        return statuses
+                    log_callback(f"Could not download {phase} for @{username}: {e}")
+                    statuses[phase] = FAILED
+            progress_callback(int(((current_step + 1) / len(phases)) * 100))
+        return statuses
 
     finally:
-        os.chdir(original_cwd)
+        if archives is not None:
+            archives.close()
+        if own_manifest:
+            manifest.close()
+        if own_session:
+            session.close()
+        if own_fetcher:
+            fetcher.close()
+        tracker.flush(username)
         progress_callback(100) # Ensure it ends at 100
@@ -0,0 +1,284 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bandwidth import PRIORITIES, format_limit
+from cache import ResponseCache
+from cookiepool import EXPIRED, NoHealthySession
+from downloader import download_media, download_status
+from fetcher import DEFAULT_GLOBAL_LIMIT, DEFAULT_PER_ACCOUNT_LIMIT, MediaFetcher
+from integrity import IntegrityChecker
+from journal import BatchJournal
+from manifest import Manifest
+from metrics import MetricsRegistry
+from progress import ProgressTracker
+from ratelimit import RateLimiter
+from session import DownloadSession
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class DownloadEngine:
+    """Downloads several Instagram users at once on a pool of worker threads."""
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, download_func=download_media,
+                 per_account_limit=DEFAULT_PER_ACCOUNT_LIMIT, global_limit=DEFAULT_GLOBAL_LIMIT, rate_limiter=None):
+        """
+        Args:
+            max_workers (int): How many users are downloaded concurrently.
+            download_func (function): The per-user download function, called with
+                the same arguments as downloader.download_media and returning its
+                phase statuses.
+            per_account_limit (int): Maximum in-flight media requests for one user.
+            global_limit (int): Maximum in-flight media requests over the whole batch.
+            rate_limiter (RateLimiter): Optional, the limiter every request of a batch goes
+                through. A fresh one is created for each run when omitted; the one in use
+                is available as engine.rate_limiter.
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.per_account_limit = per_account_limit
+        self.global_limit = global_limit
+        self._shared_rate_limiter = rate_limiter
+        self.rate_limiter = rate_limiter
+        self.download_func = download_func
+        self._lock = threading.Lock()
+        self._job_progress = {}
+        self.pool_stats = {}
+        self.session_stats = []
+        self.tracker = None
+        self.metrics = None
+        self.integrity = None
+
+    def run(self, usernames, cookies, download_path, log_callback, progress_callback, cancel_event,
+            download_stories=True, download_posts=True, job_progress_callback=None, event_callback=None,
+            result_callback=None, cookie_pool=None, resume=False, verify=False, **download_options):
+        """
+        Downloads every username in the batch and blocks until all jobs are done.
+
+        Args:
+            usernames (list): The Instagram usernames to download.
+            cookies (dict): The cookies for authentication. Ignored when cookie_pool is given.
+            download_path (str): The root directory to save the downloaded media.
+            log_callback (function): A function to call for logging progress.
+            progress_callback (function): Called with the overall batch progress (0-100).
+            cancel_event (threading.Event): An event to signal cancellation. Jobs that
+                have not started yet are skipped once it is set; with a CancelToken, the
+                requests in flight are aborted too, so the workers stop within a second.
+                An exception in the calling thread (e.g. KeyboardInterrupt) sets it.
+            download_stories (bool): Whether to download stories.
+            download_posts (bool): Whether to download posts.
+            job_progress_callback (function): Optional, called as (username, progress)
+                whenever a single job reports progress (0-100).
+            event_callback (function): Optional, receives the structured throughput events
+                (items, bytes, MB/s, files/s and ETA per user and for the batch) of the
+                batch's ProgressTracker, which is available as engine.tracker.
+                The batch's MetricsRegistry is available as engine.metrics for export.
+            result_callback (function): Optional, called from the worker thread as
+                (username, status, snapshot) as soon as a user's job finishes, where
+                snapshot is that user's ProgressTracker snapshot.
+            cookie_pool (CookiePool): Optional, several authenticated sessions to spread the
+                users across. Each user runs on the least busy session in rotation with
+                that session's cookies, HTTP session and rate limiter; max_workers then
+                counts workers per session. A user whose session expired while it ran is
+                retried on another session (the manifest skips whatever was already fetched).
+            resume (bool): Journal the batch in the download directory's BatchJournal. If the
+                same users and phases were started before and interrupted (the process was
+                closed, crashed or cancelled) within the journal's max age, only their
+                unfinished stories and posts phases run, and failed phases are retried up
+                to the journal's attempt limit. A batch that ran to the end is not resumed.
+            verify (bool): After the batch, hash and validate the files it downloaded in a
+                process pool and hardlink duplicates (see IntegrityChecker). The summary
+                is available as engine.integrity. Media streamed into archives
+                (archive_format) is not checked.
+            **download_options: Extra keyword arguments passed to every download_func call.
+                Unless a "manifest", "session" or "fetcher" is given, one manifest, one
+                pooled DownloadSession and one MediaFetcher are shared by the whole batch.
+                Pass a BandwidthGovernor as "governor" to cap the batch's bandwidth. Listings
+                go through the download directory's ResponseCache unless "cache" is given
+                (None turns caching off).
+
+        Returns:
+            dict: username -> "done", "failed" (the download raised or one of its
+            phases failed, see downloader.download_status) or "cancelled".
+        """
+        usernames = list(dict.fromkeys(usernames))
+        results = {}
+        if not usernames:
+            return results
+
+        journal = batch = None
+        if resume:
+            journal = BatchJournal.for_download_path(download_path)
+            phases = [phase for phase, enabled in (("stories", download_stories), ("posts", download_posts)) if enabled]
+            batch = download_options["journal"] = journal.begin(usernames, phases)
+            usernames, finished, exhausted = batch.plan()
+            if batch.resumed:
+                gave_up = f", {len(exhausted)} given up after {journal.max_attempts} attempts" if exhausted else ""
+                log_callback(f"Resuming an interrupted batch: {len(finished)} user(s) already finished{gave_up}, "
+                             f"{len(usernames)} to go.")
+            results.update({username: "done" for username in finished})
+            results.update({username: "failed" for username in exhausted})
+            if not usernames:
+                batch.finish()
+                journal.close()
+                return results
+
+        with self._lock:
+            self._job_progress = {username: 0 for username in usernames}
+        total_users = len(usernames)
+
+        def make_progress_callback(username):
+            def job_progress(value):
+                with self._lock:
+                    self._job_progress[username] = value
+                    overall = sum(self._job_progress.values()) / total_users
+                if job_progress_callback:
+                    job_progress_callback(username, value)
+                progress_callback(overall)
+            return job_progress
+
+        def download(username, user_cookies, options):
+            try:
+                statuses = self.download_func(username, user_cookies, download_path, log_callback,
+                                              make_progress_callback(username), cancel_event,
+                                              download_stories, download_posts, **options)
+            except Exception as e:
+                log_callback(f"Download failed for @{username}: {e}")
+                return "failed"
+            return download_status(statuses, cancel_event)
+
+        def download_pooled(username):
+            for attempt in range(len(cookie_pool)):
+                try:
+                    pooled = cookie_pool.acquire(cancel_event)
+                except NoHealthySession as e:
+                    log_callback(f"Download failed for @{username}: {e}")
+                    return "failed"
+                if pooled is None:
+                    return "cancelled"
+                generation = pooled.generation
+                try:
+                    status = download(username, pooled.cookies, {**download_options, "session": pooled.session})
+                finally:
+                    cookie_pool.release(pooled, completed=pooled.generation == generation)
+                if pooled.state != EXPIRED or cancel_event.is_set():
+                    return status
+                log_callback(f"Retrying @{username} on another session, {pooled.label} is no longer logged in.")
+            return status
+
+        def run_job(index, username):
+            if cancel_event.is_set():
+                return "cancelled"
+            log_callback(f"Processing user {index + 1} of {total_users}: @{username}")
+            if cookie_pool is not None:
+                return download_pooled(username)
+            return download(username, cookies, download_options)
+
+        def job(index, username):
+            status = run_job(index, username)
+            if result_callback is not None:
+                result_callback(username, status, self.tracker.snapshot(username))
+            return status
+
+        def announce_rate(host, rate, reason):
+            log_callback(f"Throttled by {host} ({reason}), slowing down to {rate:.2f} requests/s.")
+
+        self.rate_limiter = self._shared_rate_limiter or RateLimiter(on_rate_change=announce_rate)
+        self.tracker = download_options.setdefault("tracker", ProgressTracker(event_callback))
+        self.metrics = download_options.setdefault("metrics", MetricsRegistry())
+        shared_factories = {
+            "manifest": lambda: Manifest.for_download_path(download_path),
+            "session": lambda: DownloadSession(rate_limiter=self.rate_limiter, metrics=self.metrics),
+            "fetcher": lambda: MediaFetcher(self.per_account_limit, self.global_limit),
+            "cache": lambda: ResponseCache.for_download_path(download_path, metrics=self.metrics),
+        }
+        if cookie_pool is not None:
+            # Every cookie set brings its own session; see CookiePool.
+            del shared_factories["session"]
+            cookie_pool.open(self.metrics, log_callback)
+        owned = []
+        for name, factory in shared_factories.items():
+            if name not in download_options:
+                download_options[name] = factory()
+                owned.append(download_options[name])
+
+        batch_started = time.time()
+        workers = self.max_workers
+        if cookie_pool is not None:
+            workers *= max(1, cookie_pool.healthy_count())
+        workers = min(workers, total_users)
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="insta-dl") as executor:
+                futures = {username: executor.submit(job, i, username) for i, username in enumerate(usernames)}
+                try:
+                    for username, future in futures.items():
+                        results[username] = future.result()
+                        self.metrics.inc("insta_accounts_total", status=results[username])
+                except BaseException:
+                    # E.g. KeyboardInterrupt: stop the workers before the executor waits for them.
+                    cancel_event.set()
+                    raise
+            if batch is not None and not cancel_event.is_set():
+                batch.finish()
+            if verify and not cancel_event.is_set():
+                self.verify(download_path, download_options["manifest"], batch_started, log_callback, cancel_event)
+        finally:
+            if journal is not None:
+                journal.close()
+            for resource in owned:
+                resource.close()
+            if cookie_pool is not None:
+                self.pool_stats = cookie_pool.connection_stats()
+                self.session_stats = cookie_pool.stats()
+                cookie_pool.close()
+
+        batch_stats = self.tracker.snapshot()
+        elapsed = max(batch_stats['elapsed_seconds'], 1e-6)
+        megabytes = batch_stats['bytes_done'] / (1024 * 1024)
+        log_callback(f"Downloaded {batch_stats['items_done']} file(s), {megabytes:.1f} MB in {elapsed:.1f}s "
+                     f"(average {megabytes / elapsed:.2f} MB/s, {batch_stats['items_done'] / elapsed:.1f} files/s).")
+
+        governor = download_options.get("governor")
+        if governor is not None:
+            bandwidth = governor.stats()
+            log_callback(f"Bandwidth: limit {format_limit(bandwidth['rate'])}; " + ", ".join(
+                f"{priority} {bandwidth['bytes'][priority] / (1024 * 1024):.1f} MB "
+                f"({bandwidth['wait_seconds'][priority]}s throttled)" for priority in PRIORITIES) + ".")
+
+        cache = download_options.get("cache")
+        if cache is not None:
+            cache_stats = cache.stats()
+            log_callback("Listing cache: {hit} hits, {revalidated} revalidated, {miss} misses, "
+                         "{stale} expired.".format(**cache_stats["totals"]))
+
+        session = download_options.get("session")
+        if cookie_pool is not None:
+            log_callback("Connection pool: {checkouts} requests, {new_connections} new connections, "
+                         "{reused_connections} reused, {wait_seconds}s waiting for a connection.".format(**self.pool_stats))
+            log_callback("Cookie sessions: " + "; ".join(
+                f"{stats['label']} {stats['jobs']} user(s), {stats['throttles']} throttled, {stats['state']}"
+                + (f" ({stats['reason']})" if stats['reason'] else "") for stats in self.session_stats) + ".")
+        elif isinstance(session, DownloadSession):
+            self.pool_stats = session.stats()
+            log_callback("Connection pool: {checkouts} requests, {new_connections} new connections, "
+                         "{reused_connections} reused, {wait_seconds}s waiting for a connection.".format(**self.pool_stats))
+            if session.rate_limiter is not None:
+                limiter_stats = session.rate_limiter.stats()
+                rates = ", ".join(f"{host} {rate}/s" for host, rate in sorted(limiter_stats["rates"].items()))
+                log_callback(f"Rate limiter: {limiter_stats['throttled']} throttled responses, {limiter_stats['retries']} retries, "
+                             f"current rates: {rates or 'none'}.")
+
+        return results
+
+    def verify(self, download_path, manifest, since, log_callback, cancel_event):
+        """Verifies and deduplicates the files recorded in the manifest since a timestamp."""
+        checker = IntegrityChecker(download_path, log_callback=log_callback, cancel_event=cancel_event,
+                                   manifest=manifest)
+        try:
+            self.integrity = checker.check(manifest.paths_since(since))
+        finally:
+            checker.close()
+        self.metrics.inc("insta_corrupt_files_total", self.integrity["corrupt"])
+        self.metrics.inc("insta_deduplicated_files_total", self.integrity["duplicates"])
+        self.metrics.inc("insta_deduplicated_bytes_total", self.integrity["bytes_saved"])
+        return self.integrity
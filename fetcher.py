@@ -0,0 +1,119 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PER_ACCOUNT_LIMIT = 4
+DEFAULT_GLOBAL_LIMIT = 16
+
+_EXHAUSTED = object()
+
+# fetch_all's result for an item it skipped because cancellation was requested
+# before the item started.
+NOT_STARTED = object()
+
+
+class MediaFetcher:
+    """
+    Fetches the media files of an account concurrently on an asyncio event loop.
+
+    Each fetch_all call runs its own event loop (so it can be called from any
+    worker thread) and allows at most per_account_limit transfers in flight.
+    The blocking transfers themselves run on one thread pool shared by every
+    call, whose size is the global in-flight limit across all accounts.
+    """
+
+    def __init__(self, per_account_limit=DEFAULT_PER_ACCOUNT_LIMIT, global_limit=DEFAULT_GLOBAL_LIMIT):
+        """
+        Args:
+            per_account_limit (int): Maximum in-flight requests for one account.
+            global_limit (int): Maximum in-flight requests over all accounts.
+        """
+        self.per_account_limit = max(1, int(per_account_limit))
+        self.global_limit = max(1, int(global_limit))
+        self._executor = ThreadPoolExecutor(max_workers=self.global_limit, thread_name_prefix="insta-fetch")
+
+    def fetch_all(self, fetch_one, items, cancel_event, limit=None):
+        """
+        Calls fetch_one(item) for every item, several at a time, and waits for all of them.
+
+        Items that have not started when cancel_event is set are skipped.
+
+        Args:
+            fetch_one (function): The blocking function that fetches one item.
+            items (list): The items to fetch.
+            cancel_event (threading.Event): An event to signal cancellation.
+            limit (int): Optional, a lower in-flight limit than per_account_limit for this call.
+
+        Returns:
+            list: One entry per item, in order: fetch_one's return value, the exception
+            it raised, or NOT_STARTED if the item was skipped because of cancellation.
+        """
+        items = list(items)
+        if not items:
+            return []
+        return asyncio.run(self._fetch_all(fetch_one, items, cancel_event, self._limit(limit)))
+
+    def _limit(self, limit):
+        return self.per_account_limit if limit is None else max(1, min(int(limit), self.per_account_limit))
+
+    async def _fetch_all(self, fetch_one, items, cancel_event, limit):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(item):
+            async with semaphore:
+                if cancel_event.is_set():
+                    return NOT_STARTED
+                return await loop.run_in_executor(self._executor, fetch_one, item)
+
+        return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+    def fetch_stream(self, fetch_one, items, cancel_event, on_result, limit=None):
+        """
+        Calls fetch_one(item) for the items of an iterator as they come, several at a
+        time, without a barrier between them, and waits for all of them.
+
+        The iterator is only advanced while fewer than per_account_limit items are in
+        flight, so a lazy listing is fetched no further ahead of the downloads than it
+        has to be, and no results are kept: on_result(item, result) is called on the
+        calling thread as every item finishes, with fetch_one's return value or the
+        exception it raised. Items are not taken from the iterator any more once
+        cancel_event is set.
+
+        Args:
+            fetch_one (function): The blocking function that fetches one item.
+            items (iterable): The items to fetch, e.g. a generator.
+            cancel_event (threading.Event): An event to signal cancellation.
+            on_result (function): Called with every item and its result.
+            limit (int): Optional, a lower in-flight limit than per_account_limit for this call.
+        """
+        asyncio.run(self._fetch_stream(fetch_one, iter(items), cancel_event, on_result, self._limit(limit)))
+
+    async def _fetch_stream(self, fetch_one, items, cancel_event, on_result, limit):
+        loop = asyncio.get_running_loop()
+        running = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(running) < limit and not cancel_event.is_set():
+                    # Advancing the iterator may wait for a listing request; the
+                    # transfers in flight keep running on the executor meanwhile.
+                    item = next(items, _EXHAUSTED)
+                    if item is _EXHAUSTED:
+                        exhausted = True
+                    else:
+                        running[loop.run_in_executor(self._executor, fetch_one, item)] = item
+                if not running:
+                    return
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    item = running.pop(future)
+                    error = future.exception()
+                    on_result(item, error if error is not None else future.result())
+        except BaseException:
+            if running:
+                # Do not leave transfers running behind the caller's back.
+                await asyncio.wait(running)
+            raise
+
+    def close(self):
+        self._executor.shutdown(wait=True)
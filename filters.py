@@ -0,0 +1,179 @@
+import re
+from datetime import datetime, timezone
+
+MEDIA_TYPES = ("image", "video", "reel", "carousel")
+
+_SIZE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+class FilterError(ValueError):
+    """Raised when a filter option cannot be parsed."""
+
+
+def parse_date(text):
+    """
+    Parses "YYYY-MM-DD" (UTC midnight), "YYYY-MM-DDTHH:MM[:SS]" or a Unix timestamp.
+
+    Returns:
+        float: The Unix timestamp, or None for an empty value.
+    """
+    text = str(text or "").strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        raise FilterError(f"Invalid date {text!r}, use YYYY-MM-DD")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def parse_size(text):
+    """
+    Parses a byte size such as "500000", "800K", "20MB" or "1.5G" (binary units).
+
+    Returns:
+        int: The size in bytes, or None for an empty value.
+    """
+    text = str(text or "").strip()
+    if not text:
+        return None
+    match = _SIZE.match(text)
+    if not match:
+        raise FilterError(f"Invalid size {text!r}, use e.g. 800K or 20MB")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_resolution(text):
+    """
+    Parses a maximum resolution, "1080" (the longer side) or "1920x1080".
+
+    Returns:
+        int: The maximum length of the longer side in pixels, or None for an empty value.
+    """
+    text = str(text or "").strip().lower()
+    if not text:
+        return None
+    try:
+        return max(int(side) for side in text.split("x"))
+    except ValueError:
+        raise FilterError(f"Invalid resolution {text!r}, use e.g. 1080 or 1920x1080")
+
+
+def parse_media_types(text):
+    """Parses a comma-separated list of media types. Returns a tuple, or None for an empty value."""
+    if isinstance(text, (list, tuple)):
+        types = [str(media_type).strip().lower() for media_type in text]
+    else:
+        types = [media_type.strip().lower() for media_type in str(text or "").split(",")]
+    types = tuple(media_type for media_type in types if media_type)
+    if not types:
+        return None
+    unknown = [media_type for media_type in types if media_type not in MEDIA_TYPES]
+    if unknown:
+        raise FilterError(f"Unknown media type(s) {', '.join(unknown)}; choose from {', '.join(MEDIA_TYPES)}")
+    return types
+
+
+class MediaFilter:
+    """
+    Decides from the listing metadata alone which media entries get downloaded.
+
+    Every check runs before a media request is made: the media type, the posted
+    date window, the resolution and the per-account item cap. With a maximum
+    resolution, the largest rendition within the limit is picked rather than the
+    full-size one, and an entry without such a rendition is skipped. The file size
+    is not in the listing, so max_size is checked against the Content-Length of
+    the media response, before any of its body is read.
+    """
+
+    def __init__(self, media_types=None, posted_after=None, posted_before=None, max_size=None, max_resolution=None,
+                 max_items=None):
+        """
+        Args:
+            media_types (tuple): Optional, the types to keep, out of MEDIA_TYPES.
+                Every child of a carousel post counts as "carousel".
+            posted_after (float): Optional, skip media posted before this Unix time.
+            posted_before (float): Optional, skip media posted at or after this Unix time.
+            max_size (int): Optional, skip media files larger than this many bytes.
+            max_resolution (int): Optional, the longest allowed side in pixels.
+            max_items (int): Optional, only the newest max_items matching stories and the
+                newest max_items matching posts of every account are downloaded. Media
+                already downloaded counts towards the cap.
+        """
+        self.media_types = tuple(media_types) if media_types else None
+        self.posted_after = posted_after
+        self.posted_before = posted_before
+        self.max_size = max_size
+        self.max_resolution = max_resolution
+        self.max_items = max_items
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Builds a filter from user-facing strings, as stored in the settings or given on
+        the command line: {"media_types": "image,video", "posted_after": "2024-01-01",
+        "posted_before": ..., "max_size": "20MB", "max_resolution": "1080", "max_items": "50"}.
+
+        Returns:
+            MediaFilter: The filter, or None if no option is set.
+
+        Raises:
+            FilterError: If an option cannot be parsed.
+        """
+        max_items = str(settings.get("max_items") or "").strip()
+        if max_items and (not max_items.isdigit() or int(max_items) < 1):
+            raise FilterError(f"Invalid item cap {max_items!r}, use a positive number")
+        media_filter = cls(
+            media_types=parse_media_types(settings.get("media_types")),
+            posted_after=parse_date(settings.get("posted_after")),
+            posted_before=parse_date(settings.get("posted_before")),
+            max_size=parse_size(settings.get("max_size")),
+            max_resolution=parse_resolution(settings.get("max_resolution")),
+            max_items=int(max_items) if max_items else None,
+        )
+        return media_filter if media_filter.active() else None
+
+    def active(self):
+        return any(value is not None for value in (self.media_types, self.posted_after, self.posted_before,
+                                                   self.max_size, self.max_resolution, self.max_items))
+
+    def older_than_window(self, entry):
+        """Whether an entry was posted before posted_after; newest-first listings can stop there."""
+        taken_at = entry.get('taken_at')
+        return self.posted_after is not None and taken_at is not None and taken_at < self.posted_after
+
+    def select(self, entries):
+        """
+        Returns the entries a download would admit, in the given (newest first) order:
+        those the filter does not reject, up to max_items of them.
+        """
+        selected = [entry for entry in entries if self.rejects(entry) is None]
+        return selected if self.max_items is None else selected[:self.max_items]
+
+    def rejects(self, entry):
+        """
+        Returns why an entry is skipped ("type", "date" or "resolution"), or None if it
+        passes. A passing entry's url may be switched to a smaller rendition.
+        """
+        if self.media_types is not None and entry.get('media_type') not in self.media_types:
+            return "type"
+        taken_at = entry.get('taken_at')
+        if taken_at is not None:
+            if self.posted_after is not None and taken_at < self.posted_after:
+                return "date"
+            if self.posted_before is not None and taken_at >= self.posted_before:
+                return "date"
+        if self.max_resolution is not None and max(entry.get('width') or 0, entry.get('height') or 0) > self.max_resolution:
+            smaller = [version for version in entry.get('versions', [])
+                       if 0 < max(version[1], version[2]) <= self.max_resolution]
+            if not smaller:
+                return "resolution"
+            entry['url'], entry['width'], entry['height'] = smaller[0]
+        return None
@@ -1,11 +1,169 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import json
+import logging
+import logging.handlers
 import os
+import itertools
+import queue
 import threading
-import re
-import ast
-from downloader import download_media
+from bandwidth import BandwidthGovernor, format_limit, parse_rate
+from cancel import CancelToken
+from cookiepool import CookiePool
+from cookies import parse_cookie_sets
+from engine import DownloadEngine, DEFAULT_MAX_WORKERS
+from filters import MEDIA_TYPES, FilterError, MediaFilter
+from progress import format_rate
+from store import LEGACY_CONFIG_FILENAME, STATE_FILENAME, USERNAME_PAGE_SIZE, StateStore
+from userlist import UserList, read_usernames
+from watch import Watcher
+
+# Lines kept in the on-screen log; the full history goes to LOG_FILE.
+MAX_LOG_LINES = 2000
+LOG_FILE = "insta_downloader.log"
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+# How often (ms) the Tk main loop drains log and progress events posted by worker threads.
+UI_POLL_INTERVAL_MS = 100
+
+LOG_LEVELS = {
+    "info": logging.INFO,
+    "download": logging.INFO,
+    "success": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+
+class VirtualUserList(tk.Frame):
+    """
+    Scrollable list of checkable usernames that only draws the visible rows.
+
+    Rows are canvas items, not widgets, and are redrawn from the UserList model on
+    every scroll, so the cost of drawing does not depend on the size of the list.
+    Click toggles a row, Shift+click selects the range from the last clicked row.
+    """
+
+    ROW_HEIGHT = 20
+
+    def __init__(self, master, users, colors, on_change=None, height=120):
+        super().__init__(master, bg=colors['secondary'])
+        self.users = users
+        self.colors = colors
+        self.on_change = on_change
+        self.rows = users.names
+        self.offset = 0
+        self.anchor = None
+        self.query = ""
+
+        self.canvas = tk.Canvas(self, bg=colors['secondary'], height=height, highlightthickness=0)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.canvas.bind("<Configure>", lambda e: self.redraw())
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<Shift-Button-1>", self._on_shift_click)
+        self.canvas.bind("<MouseWheel>", self._on_mousewheel)
+        self.canvas.bind("<Button-4>", lambda e: self._scroll_wheel(-1))
+        self.canvas.bind("<Button-5>", lambda e: self._scroll_wheel(1))
+
+    def refresh(self, query=None):
+        """Re-applies the filter after the model changed (or with a new query) and redraws"""
+        if query is not None:
+            self.query = query
+        self.rows = self.users.filter(self.query)
+        self.anchor = None
+        self.redraw()
+
+    def _view_height(self):
+        return max(1, self.canvas.winfo_height())
+
+    def _max_offset(self):
+        return max(0, len(self.rows) * self.ROW_HEIGHT - self._view_height())
+
+    def redraw(self):
+        self.offset = min(max(0, self.offset), self._max_offset())
+        height = self._view_height()
+        first = self.offset // self.ROW_HEIGHT
+        last = min(len(self.rows), (self.offset + height) // self.ROW_HEIGHT + 1)
+
+        self.canvas.delete("row")
+        for index in range(first, last):
+            username = self.rows[index]
+            mark = "\u2611" if username in self.users.selected else "\u2610"
+            self.canvas.create_text(6, index * self.ROW_HEIGHT - self.offset + self.ROW_HEIGHT // 2,
+                                    text=f"{mark}  @{username}", anchor="w", tags="row",
+                                    fill=self.colors['fg'], font=('Segoe UI', 9))
+        if not self.rows and self.query:
+            self.canvas.create_text(6, self.ROW_HEIGHT // 2, text="No usernames match.", anchor="w",
+                                    tags="row", fill=self.colors['text_light'], font=('Segoe UI', 9, 'italic'))
+
+        total = max(1, len(self.rows) * self.ROW_HEIGHT)
+        self.scrollbar.set(self.offset / total, min(1.0, (self.offset + height) / total))
+
+    def yview(self, *args):
+        """Scrollbar protocol: ("moveto", fraction) or ("scroll", n, "units"|"pages")"""
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.rows) * self.ROW_HEIGHT)
+        elif args[0] == "scroll":
+            step = self.ROW_HEIGHT if args[2] == "units" else self._view_height()
+            self.offset += int(args[1]) * step
+        self.redraw()
+
+    def _scroll_wheel(self, direction):
+        self.offset += direction * 3 * self.ROW_HEIGHT
+        self.redraw()
+        return "break"
+
+    def _on_mousewheel(self, event):
+        # "break" keeps the window-wide wheel binding from scrolling the page as well.
+        return self._scroll_wheel(-1 if event.delta > 0 else 1)
+
+    def _row_at(self, y):
+        index = (self.offset + y) // self.ROW_HEIGHT
+        return index if 0 <= index < len(self.rows) else None
+
+    def _on_click(self, event):
+        index = self._row_at(event.y)
+        if index is None:
+            return
+        self.users.toggle(self.rows[index])
+        self.anchor = index
+        self._changed()
+
+    def _on_shift_click(self, event):
+        index = self._row_at(event.y)
+        if index is None:
+            return
+        if self.anchor is None:
+            return self._on_click(event)
+        start, end = sorted((self.anchor, index))
+        self.users.select(self.rows[start:end + 1])
+        self._changed()
+
+    def select_visible(self, selected=True):
+        """Selects (or deselects) every row that matches the current filter"""
+        self.users.select(self.rows, selected)
+        self._changed()
+
+    def _changed(self):
+        self.redraw()
+        if self.on_change is not None:
+            self.on_change()
+
+
+def create_file_logger(path):
+    """Returns a logger that streams the full log history to a rotating file."""
+    logger = logging.getLogger("insta_downloader")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_MAX_BYTES,
+                                                       backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+    return logger
+
 
 class InstaDownloaderApp(tk.Tk):
     def __init__(self):
@@ -31,13 +189,25 @@ class InstaDownloaderApp(tk.Tk):
             'border': '#444444'        # Border color
         }
 
-        self.config_file = "config.json"
+        self.store = StateStore(STATE_FILENAME)
+        self.migrated_config = self.store.migrate_json(LEGACY_CONFIG_FILENAME)
         self.config = self.load_config()
-        self.cancel_event = threading.Event()
+        self.cancel_event = CancelToken()
+        try:
+            bandwidth = parse_rate(self.config.get("bandwidth"))
+        except ValueError:
+            bandwidth = None
+        # Shared by every batch, so a new limit also applies to the running one.
+        self.governor = BandwidthGovernor(bandwidth)
+
+        # Worker threads never touch Tk widgets; they post events here instead.
+        self.ui_events = queue.Queue()
+        self.file_logger = create_file_logger(LOG_FILE)
 
         # Setup theme first, then create widgets
         self.setup_theme()
         self.create_widgets()
+        self.after(UI_POLL_INTERVAL_MS, self.process_ui_events)
 
     def setup_theme(self):
         """Configure the dark theme with neon purple accents"""
@@ -155,19 +325,17 @@ class InstaDownloaderApp(tk.Tk):
                             darkcolor=self.colors['accent_dark'])
 
     def load_config(self):
-        if os.path.exists(self.config_file):
-            with open(self.config_file, 'r') as f:
-                return json.load(f)
-        else:
-            return {
-                "cookies": "",
-                "usernames": [],
-                "download_path": os.path.expanduser("~/Downloads/Insta")
-            }
+        """Settings from the state store; the saved usernames are loaded separately, page by page"""
+        config = {
+            "cookies": "",
+            "download_path": os.path.expanduser("~/Downloads/Insta"),
+            "max_workers": DEFAULT_MAX_WORKERS
+        }
+        config.update(self.store.settings())
+        return config
 
     def save_config(self):
-        with open(self.config_file, 'w') as f:
-            json.dump(self.config, f, indent=4)
+        self.store.set_many(self.config)
         self.log("Settings saved.", "success")
 
     def create_widgets(self):
@@ -215,29 +383,27 @@ class InstaDownloaderApp(tk.Tk):
                                     style='Accent.TLabelframe', padding="10")
         users_frame.pack(fill=tk.X, pady=(0, 8))
 
-        self.user_vars = {}
-        
-        # Scrollable user list
-        user_list_frame = tk.Frame(users_frame, bg=self.colors['secondary'])
-        user_list_frame.pack(fill=tk.X, pady=(0, 8))
-        
-        self.user_canvas = tk.Canvas(user_list_frame, 
-                                    bg=self.colors['secondary'], 
-                                    height=80, 
-                                    highlightthickness=0)
-        user_scrollbar = ttk.Scrollbar(user_list_frame, orient="vertical", command=self.user_canvas.yview)
-        self.scrollable_user_frame = tk.Frame(self.user_canvas, bg=self.colors['secondary'])
-        
-        self.scrollable_user_frame.bind(
-            "<Configure>",
-            lambda e: self.user_canvas.configure(scrollregion=self.user_canvas.bbox("all"))
-        )
-        
-        self.user_canvas.create_window((0, 0), window=self.scrollable_user_frame, anchor="nw")
-        self.user_canvas.configure(yscrollcommand=user_scrollbar.set)
-        
-        self.user_canvas.pack(side="left", fill="both", expand=True)
-        user_scrollbar.pack(side="right", fill="y")
+        self.users = UserList()
+
+        # Search and bulk selection
+        search_frame = tk.Frame(users_frame, bg=self.colors['secondary'])
+        search_frame.pack(fill=tk.X, pady=(0, 3))
+
+        ttk.Label(search_frame, text="Search:", style='Custom.TLabel').pack(side=tk.LEFT, padx=(0, 8))
+        self.user_search_var = tk.StringVar()
+        ttk.Entry(search_frame, textvariable=self.user_search_var,
+                  style='Custom.TEntry', font=('Segoe UI', 9)).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(0, 8))
+        self.user_search_var.trace_add("write", lambda *args: self.user_list.refresh(self.user_search_var.get()))
+        ttk.Button(search_frame, text="Select All",
+                  command=lambda: self.user_list.select_visible(True), style='Accent.TButton').pack(side=tk.LEFT, padx=(0, 8))
+        ttk.Button(search_frame, text="Select None",
+                  command=lambda: self.user_list.select_visible(False), style='Accent.TButton').pack(side=tk.LEFT)
+
+        # Virtualized user list: only the visible rows are drawn
+        self.user_list = VirtualUserList(users_frame, self.users, self.colors, on_change=self.update_start_button_text)
+        self.user_list.pack(fill=tk.X, pady=(0, 3))
+        self.user_count_var = tk.StringVar()
+        ttk.Label(users_frame, textvariable=self.user_count_var, style='Custom.TLabel').pack(anchor=tk.W, pady=(0, 5))
 
         # Add user controls
         add_user_frame = tk.Frame(users_frame, bg=self.colors['secondary'])
@@ -249,6 +415,8 @@ class InstaDownloaderApp(tk.Tk):
         
         ttk.Button(add_user_frame, text="Add", 
                   command=self.add_user, style='Accent.TButton').pack(side=tk.LEFT, padx=(0, 8))
+        ttk.Button(add_user_frame, text="Import...", 
+                  command=self.import_users, style='Accent.TButton').pack(side=tk.LEFT, padx=(0, 8))
         ttk.Button(add_user_frame, text="Remove Selected", 
                   command=self.remove_selected_users, style='Danger.TButton').pack(side=tk.LEFT)
 
@@ -282,13 +450,73 @@ class InstaDownloaderApp(tk.Tk):
                                  variable=self.download_posts_var, style='Custom.TCheckbutton')
         posts_cb.pack(anchor=tk.W, pady=1)
 
+        self.watch_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Keep watching (poll for new stories and posts until cancelled)",
+                        variable=self.watch_var, style='Custom.TCheckbutton').pack(anchor=tk.W, pady=1)
+
+        self.verify_var = tk.BooleanVar(value=self.config.get("verify", False))
+        ttk.Checkbutton(options_frame, text="Verify new files and hardlink duplicates after each batch",
+                        variable=self.verify_var, style='Custom.TCheckbutton',
+                        command=self.save_verify_option).pack(anchor=tk.W, pady=1)
+
+        self.archive_var = tk.BooleanVar(value=bool(self.config.get("archive_format")))
+        ttk.Checkbutton(options_frame, text="Save into one tar archive per account and day instead of single files",
+                        variable=self.archive_var, style='Custom.TCheckbutton',
+                        command=self.save_archive_option).pack(anchor=tk.W, pady=1)
+
+        workers_frame = tk.Frame(options_frame, bg=self.colors['secondary'])
+        workers_frame.pack(fill=tk.X, pady=(3, 0))
+
+        ttk.Label(workers_frame, text="Parallel downloads:", style='Custom.TLabel').pack(side=tk.LEFT, padx=(0, 8))
+        self.max_workers_var = tk.IntVar(value=self.config.get("max_workers", DEFAULT_MAX_WORKERS))
+        tk.Spinbox(workers_frame,
+                   from_=1, to=32, width=5,
+                   textvariable=self.max_workers_var,
+                   bg=self.colors['tertiary'],
+                   fg=self.colors['fg'],
+                   buttonbackground=self.colors['tertiary'],
+                   insertbackground=self.colors['accent'],
+                   relief='flat',
+                   font=('Segoe UI', 9)).pack(side=tk.LEFT)
+
+        ttk.Label(workers_frame, text="Bandwidth limit (e.g. 5M, empty for none):",
+                  style='Custom.TLabel').pack(side=tk.LEFT, padx=(16, 8))
+        self.bandwidth_var = tk.StringVar(value=str(self.config.get("bandwidth") or ""))
+        bandwidth_entry = ttk.Entry(workers_frame, textvariable=self.bandwidth_var, width=8,
+                                    style='Custom.TEntry', font=('Segoe UI', 9))
+        bandwidth_entry.pack(side=tk.LEFT)
+        bandwidth_entry.bind('<Return>', lambda event: self.apply_bandwidth())
+        bandwidth_entry.bind('<FocusOut>', lambda event: self.apply_bandwidth())
+
+        # Filters are checked on the listing, before any media is requested
+        filters = self.config.get("filters") or {}
+        types_frame = tk.Frame(options_frame, bg=self.colors['secondary'])
+        types_frame.pack(fill=tk.X, pady=(3, 0))
+        ttk.Label(types_frame, text="Media types:", style='Custom.TLabel').pack(side=tk.LEFT, padx=(0, 8))
+        selected_types = filters.get("media_types") or ",".join(MEDIA_TYPES)
+        self.media_type_vars = {}
+        for media_type in MEDIA_TYPES:
+            self.media_type_vars[media_type] = tk.BooleanVar(value=media_type in selected_types.split(","))
+            ttk.Checkbutton(types_frame, text=media_type.capitalize() + "s", variable=self.media_type_vars[media_type],
+                            style='Custom.TCheckbutton').pack(side=tk.LEFT, padx=(0, 6))
+
+        limits_frame = tk.Frame(options_frame, bg=self.colors['secondary'])
+        limits_frame.pack(fill=tk.X, pady=(3, 0))
+        self.filter_vars = {}
+        for key, label, width in (("posted_after", "Posted after (YYYY-MM-DD):", 11), ("max_items", "Newest items:", 5),
+                                  ("max_size", "Max size:", 7), ("max_resolution", "Max resolution:", 6)):
+            ttk.Label(limits_frame, text=label, style='Custom.TLabel').pack(side=tk.LEFT, padx=(0, 4))
+            self.filter_vars[key] = tk.StringVar(value=str(filters.get(key) or ""))
+            ttk.Entry(limits_frame, textvariable=self.filter_vars[key], width=width,
+                      style='Custom.TEntry', font=('Segoe UI', 9)).pack(side=tk.LEFT, padx=(0, 10))
+
         # --- Settings ---
         settings_frame = ttk.LabelFrame(main_container, text="Settings", 
                                       style='Accent.TLabelframe', padding="10")
         settings_frame.pack(fill=tk.X, pady=(0, 8))
 
         # Cookies section
-        cookies_label = ttk.Label(settings_frame, text="Instagram Cookies (Required):", 
+        cookies_label = ttk.Label(settings_frame, text="Instagram Cookies (Required, separate several accounts with a '---' line):", 
                                 style='Custom.TLabel')
         cookies_label.pack(anchor=tk.W, pady=(0, 3))
         
@@ -345,6 +573,8 @@ class InstaDownloaderApp(tk.Tk):
                                           maximum=100,
                                           style='Custom.Horizontal.TProgressbar')
         self.progress_bar.pack(fill=tk.X, pady=3)
+        self.throughput_var = tk.StringVar(value="")
+        ttk.Label(progress_frame, textvariable=self.throughput_var, style='Progress.TLabel').pack(anchor=tk.W)
 
         # --- Status Log ---
         log_frame = ttk.LabelFrame(main_container, text="Status Log", 
@@ -378,50 +608,60 @@ class InstaDownloaderApp(tk.Tk):
 
         self.update_user_listbox()
         self.log("Ready to download!", "success")
-        self.log(f"Loading config from {self.config_file}...", "info")
+        if self.migrated_config:
+            self.log(f"Migrated {LEGACY_CONFIG_FILENAME} to {STATE_FILENAME}.", "success")
+        self.log(f"Loading settings from {self.store.path}...", "info")
+        self.after_idle(self.load_usernames_page, self.store.iter_usernames())
+
+    def load_usernames_page(self, usernames, page_size=USERNAME_PAGE_SIZE):
+        """Adds the next page of saved usernames to the list, then yields to the main loop"""
+        page = list(itertools.islice(usernames, page_size))
+        if not page:
+            return
+        self.users.add_many(page)
+        self.update_user_listbox()
+        self.after_idle(self.load_usernames_page, usernames)
 
     def update_user_listbox(self):
-        """Update the scrollable user list with checkboxes"""
-        for widget in self.scrollable_user_frame.winfo_children():
-            widget.destroy()
-        
-        self.user_vars = {}
-        for username in sorted(self.config.get("usernames", [])):
-            var = tk.BooleanVar()
-            
-            # Create a frame for each user
-            user_frame = tk.Frame(self.scrollable_user_frame, bg=self.colors['secondary'])
-            user_frame.pack(fill=tk.X, pady=1, padx=3)
-            
-            cb = ttk.Checkbutton(user_frame, 
-                               text=f"@{username}", 
-                               variable=var, 
-                               command=self.update_start_button_text,
-                               style='Custom.TCheckbutton')
-            cb.pack(anchor=tk.W)
-            
-            self.user_vars[username] = var
-        
+        """Redraw the visible part of the user list after the saved usernames changed"""
+        self.user_list.refresh()
         self.update_start_button_text()
 
     def add_user(self):
-        new_user = self.new_user_entry.get().strip()
-        if new_user and new_user not in self.config["usernames"]:
-            self.config["usernames"].append(new_user)
+        # Several usernames can be pasted at once, separated by spaces or commas.
+        new_users = read_usernames(self.new_user_entry.get().replace(',', ' ').split())
+        if not new_users:
+            self.log("Error: Username cannot be empty.", "error")
+            return
+        added = self.users.add_many(new_users)
+        self.store.add_usernames(new_users)
+        if added:
             self.update_user_listbox()
             self.new_user_entry.delete(0, tk.END)
-            self.log(f"Added user: @{new_user}", "success")
-        elif not new_user:
-            self.log("Error: Username cannot be empty.", "error")
+        if len(new_users) == 1:
+            if added:
+                self.log(f"Added user: @{new_users[0]}", "success")
+            else:
+                self.log(f"Error: User @{new_users[0]} already exists.", "warning")
         else:
-            self.log(f"Error: User @{new_user} already exists.", "warning")
+            self.log(f"Added {added} user(s), {len(new_users) - added} already saved.", "success")
+
+    def import_users(self):
+        path = filedialog.askopenfilename(title="Import usernames",
+                                          filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+        if not path:
+            return
+        with open(path, 'r', encoding="utf-8") as f:
+            usernames = read_usernames(f)
+        added = self.users.add_many(usernames)
+        self.store.add_usernames(usernames)
+        self.update_user_listbox()
+        self.log(f"Imported {added} new user(s) from {path} ({len(usernames) - added} already saved).", "success")
 
     def remove_selected_users(self):
-        removed_count = 0
-        for username, var in list(self.user_vars.items()):
-            if var.get():
-                self.config["usernames"].remove(username)
-                removed_count += 1
+        selected = list(self.users.selected)
+        removed_count = self.users.remove_many(selected)
+        self.store.remove_usernames(selected)
         if removed_count > 0:
             self.update_user_listbox()
             self.log(f"Removed {removed_count} user(s).", "success")
@@ -437,21 +677,112 @@ class InstaDownloaderApp(tk.Tk):
     def save_settings(self):
         self.config["cookies"] = self.cookies_text.get("1.0", tk.END).strip()
         self.config["download_path"] = self.path_var.get()
+        self.config["max_workers"] = self.get_max_workers()
         self.save_config()
 
+    def get_max_workers(self):
+        try:
+            return max(1, int(self.max_workers_var.get()))
+        except (tk.TclError, ValueError):
+            return DEFAULT_MAX_WORKERS
+
+    def apply_bandwidth(self):
+        """Applies the bandwidth limit field at once, also to a running batch"""
+        text = self.bandwidth_var.get().strip()
+        try:
+            rate = parse_rate(text)
+        except ValueError as e:
+            self.log(str(e), "error")
+            return
+        if rate != self.governor.rate:
+            self.governor.set_rate(rate)
+            self.log(f"Bandwidth limit set to {format_limit(rate)}.", "info")
+        if text != self.config.get("bandwidth", ""):
+            self.config["bandwidth"] = text
+            self.store.set("bandwidth", text)
+
+    def save_verify_option(self):
+        self.config["verify"] = self.verify_var.get()
+        self.store.set("verify", self.config["verify"])
+
+    def save_archive_option(self):
+        # A zip format set in the settings file is kept while the option stays on
+        self.config["archive_format"] = (self.config.get("archive_format") or "tar") if self.archive_var.get() else None
+        self.store.set("archive_format", self.config["archive_format"])
+
+    def get_media_filter(self):
+        """The MediaFilter of the filter fields (None if nothing is filtered), or False after showing an error"""
+        filters = {key: var.get().strip() for key, var in self.filter_vars.items()}
+        types = [media_type for media_type, var in self.media_type_vars.items() if var.get()]
+        if not types:
+            messagebox.showerror("Error", "Select at least one media type.")
+            return False
+        filters["media_types"] = ",".join(types) if len(types) < len(MEDIA_TYPES) else ""
+        try:
+            media_filter = MediaFilter.from_settings(filters)
+        except FilterError as e:
+            messagebox.showerror("Error", str(e))
+            return False
+        if filters != self.config.get("filters"):
+            self.config["filters"] = filters
+            self.store.set("filters", filters)
+        return media_filter
+
     def get_selected_users(self):
-        return [username for username, var in self.user_vars.items() if var.get()]
+        return self.users.selected_names()
 
     def update_start_button_text(self):
-        count = len(self.get_selected_users())
+        count = len(self.users.selected)
         self.start_button.config(text=f"Start Download for Selected ({count})")
+        self.user_count_var.set(f"{len(self.users)} saved, {count} selected")
 
     def log(self, message, log_type="info"):
-        """Enhanced logging with icons"""
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.config(state='disabled')
-        self.log_text.see(tk.END)
+        """Thread-safe logging: writes to the log file and queues the line for the on-screen log"""
+        self.file_logger.log(LOG_LEVELS.get(log_type, logging.INFO), message)
+        self.ui_events.put(("log", message))
+
+    def call_in_ui(self, func, *args):
+        """Runs func(*args) on the Tk main loop; safe to call from worker threads"""
+        self.ui_events.put(("call", func, args))
+
+    def process_ui_events(self):
+        """Drains queued events in one batch: one Text insert, one trim and one progress update"""
+        lines = []
+        progress = None
+        throughput = None
+        calls = []
+        try:
+            while True:
+                event = self.ui_events.get_nowait()
+                if event[0] == "log":
+                    lines.append(event[1])
+                elif event[0] == "progress":
+                    progress = event[1]
+                elif event[0] == "throughput":
+                    throughput = event[1]
+                else:
+                    calls.append(event)
+        except queue.Empty:
+            pass
+
+        if lines:
+            lines = lines[-MAX_LOG_LINES:]
+            self.log_text.config(state='normal')
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - MAX_LOG_LINES
+            if excess > 0:
+                self.log_text.delete('1.0', f'{excess + 1}.0')
+            self.log_text.config(state='disabled')
+            self.log_text.see(tk.END)
+        if progress is not None:
+            self.progress_var.set(progress)
+        if throughput is not None:
+            batch = throughput["batch"]
+            self.throughput_var.set(f"{batch['items_done']}/{batch['items_found']} files, {format_rate(batch)}")
+        for _, func, args in calls:
+            func(*args)
+
+        self.after(UI_POLL_INTERVAL_MS, self.process_ui_events)
 
     def clear_logs(self):
         self.log_text.config(state='normal')
@@ -461,10 +792,17 @@ class InstaDownloaderApp(tk.Tk):
 
     def cancel_download(self):
         self.cancel_event.set()
-        self.log("Cancellation signal sent. Finishing current operation...", "warning")
+        self.log("Cancelling, aborting the downloads in progress...", "warning")
 
     def update_progress(self, value):
-        self.progress_var.set(value)
+        self.ui_events.put(("progress", value))
+
+    def update_throughput(self, event):
+        self.ui_events.put(("throughput", event))
+
+    def record_result(self, username, status, snapshot):
+        """Stores the outcome of one user's download; called from worker threads"""
+        self.store.record_sync(username, status, snapshot["items_done"], snapshot["bytes_done"], snapshot["items_failed"])
 
     def quick_download(self):
         username = self.quick_user_entry.get().strip()
@@ -494,73 +832,70 @@ class InstaDownloaderApp(tk.Tk):
             messagebox.showerror("Error", "Cookies are required. Please add them in the settings.")
             return
 
-        cookies = None
-        if "cookies = {" in cookies_str:
-            match = re.search(r"cookies\s*=\s*(\{.*?\})", cookies_str, re.DOTALL)
-            if match:
-                try:
-                    cookies = ast.literal_eval(match.group(1))
-                except (ValueError, SyntaxError):
-                    pass
-
-        if cookies is None:
-            try:
-                cookies = json.loads(cookies_str)
-            except json.JSONDecodeError:
-                pass
-
-        if cookies is None:
-            try:
-                items = [item for item in cookies_str.split(';') if item.strip()]
-                if all('=' in item for item in items):
-                    cookies = {k.strip(): v.strip() for k, v in (item.split('=', 1) for item in items)}
-                else:
-                    raise ValueError("Invalid semicolon-separated format")
-            except Exception:
-                pass
+        cookie_sets = parse_cookie_sets(cookies_str)
+        if cookie_sets is None:
+            messagebox.showerror("Error", "Could not parse cookies. Please paste the full code snippet including 'cookies = {...}', a valid JSON object, or a 'key=value;' string. Separate the cookies of several accounts with a '---' line.")
+            return
 
-        if cookies is None:
-            messagebox.showerror("Error", "Could not parse cookies. Please paste the full code snippet including 'cookies = {...}', a valid JSON object, or a 'key=value;' string.")
+        media_filter = self.get_media_filter()
+        if media_filter is False:
             return
 
         download_path = self.config.get("download_path")
-        self.cancel_event.clear()
+        # A fresh token per batch, so nothing registered with the last one carries over.
+        self.cancel_event = CancelToken()
         self.progress_var.set(0)
+        self.throughput_var.set("")
 
-        thread = threading.Thread(target=self.run_downloads, args=(usernames_to_download, cookies, download_path, download_stories, download_posts))
-        thread.daemon = True
-        thread.start()
+        max_workers = self.get_max_workers()
 
-    def run_downloads(self, usernames, cookies, download_path, download_stories, download_posts):
         self.start_button.config(state=tk.DISABLED)
         self.cancel_button.config(state=tk.NORMAL)
 
-        total_users = len(usernames)
-        for i, username in enumerate(usernames):
-            if self.cancel_event.is_set():
-                self.log("Download process cancelled by user.", "warning")
-                break
-            
-            self.log(f"Processing user {i+1} of {total_users}: @{username}", "download")
-            # This progress update is for the user level
-            user_progress_start = (i / total_users) * 100
-            user_progress_end = ((i + 1) / total_users) * 100
-            
-            def user_progress_callback(step_progress):
-                # Scale the 0-100 step_progress to the user's portion of the total progress
-                total_progress = user_progress_start + (step_progress / 100) * (user_progress_end - user_progress_start)
-                self.update_progress(total_progress)
-
-            download_media(username, cookies, download_path, self.log, user_progress_callback, self.cancel_event, download_stories, download_posts)
-
-        if not self.cancel_event.is_set():
-            self.log("All downloads completed!", "success")
-            self.update_progress(100)
-        else:
-            self.log("Download process finished with cancellation.", "warning")
+        target = self.run_watch if self.watch_var.get() else self.run_downloads
+        thread = threading.Thread(target=target, args=(usernames_to_download, cookie_sets, download_path, download_stories, download_posts, max_workers, media_filter))
+        thread.daemon = True
+        thread.start()
 
-        self.start_button.config(state=tk.NORMAL)
-        self.cancel_button.config(state=tk.DISABLED)
+    def run_downloads(self, usernames, cookie_sets, download_path, download_stories, download_posts, max_workers=DEFAULT_MAX_WORKERS, media_filter=None):
+        cookie_pool = None
+        if len(cookie_sets) > 1:
+            cookie_pool = CookiePool(cookie_sets)
+            self.log(f"Downloading {len(usernames)} user(s) over {len(cookie_sets)} cookie sessions "
+                     f"with {max_workers} parallel worker(s) each...", "download")
+        else:
+            self.log(f"Downloading {len(usernames)} user(s) with {max_workers} parallel worker(s)...", "download")
+        engine = DownloadEngine(max_workers=max_workers)
+        try:
+            engine.run(usernames, cookie_sets[0], download_path, self.log, self.update_progress, self.cancel_event, download_stories, download_posts,
+                       event_callback=self.update_throughput, result_callback=self.record_result, cookie_pool=cookie_pool,
+                       resume=True, verify=self.config.get("verify", False), media_filter=media_filter,
+                       governor=self.governor, archive_format=self.config.get("archive_format"))
+        except Exception as e:
+            self.log(f"Download process failed: {e}", "error")
+        else:
+            if not self.cancel_event.is_set():
+                self.log("All downloads completed!", "success")
+                self.update_progress(100)
+            else:
+                self.log("Download process finished with cancellation. Start the same selection again to resume it.", "warning")
+        finally:
+            self.call_in_ui(self.start_button.config, {"state": tk.NORMAL})
+            self.call_in_ui(self.cancel_button.config, {"state": tk.DISABLED})
+
+    def run_watch(self, usernames, cookie_sets, download_path, download_stories, download_posts, max_workers=DEFAULT_MAX_WORKERS, media_filter=None):
+        cookie_pool = CookiePool(cookie_sets) if len(cookie_sets) > 1 else None
+        watcher = Watcher(usernames, cookie_sets[0], download_path, self.log, self.cancel_event, download_stories,
+                          download_posts, max_workers=max_workers, store=self.store, cookie_pool=cookie_pool,
+                          media_filter=media_filter, governor=self.governor,
+                          archive_format=self.config.get("archive_format"))
+        try:
+            watcher.run()
+        except Exception as e:
+            self.log(f"Watch mode failed: {e}", "error")
+        finally:
+            self.call_in_ui(self.start_button.config, {"state": tk.NORMAL})
+            self.call_in_ui(self.cancel_button.config, {"state": tk.DISABLED})
 
 if __name__ == "__main__":
     app = InstaDownloaderApp()
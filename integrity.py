@@ -0,0 +1,363 @@
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest import Manifest
+
+INTEGRITY_FILENAME = ".integrity.sqlite3"
+OBJECTS_DIRNAME = ".objects"
+CORRUPT_SUFFIX = ".corrupt"
+MEDIA_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".heic", ".mp4", ".mov")
+HASH_CHUNK_SIZE = 1024 * 1024
+# Files handed to a worker process at once; large enough to amortize the IPC per file.
+PROCESS_CHUNK_SIZE = 8
+
+OK = "ok"
+CORRUPT = "corrupt"
+
+_JPEG_END = b"\xff\xd9"
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_END = b"IEND\xaeB`\x82"
+
+
+def _check_jpeg(f, size):
+    if f.read(3) != b"\xff\xd8\xff":
+        return "not a JPEG file"
+    # Some encoders pad the file after the end-of-image marker.
+    f.seek(max(0, size - 32))
+    if _JPEG_END not in f.read().rstrip(b"\x00"):
+        return "JPEG end marker missing (truncated)"
+    return None
+
+
+def _check_png(f, size):
+    if f.read(8) != _PNG_SIGNATURE:
+        return "not a PNG file"
+    f.seek(max(0, size - 8))
+    if f.read() != _PNG_END:
+        return "PNG IEND chunk missing (truncated)"
+    return None
+
+
+def _check_webp(f, size):
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        return "not a WebP file"
+    if struct.unpack("<I", header[4:8])[0] + 8 > size:
+        return "WebP data shorter than its header says (truncated)"
+    return None
+
+
+def _check_boxes(f, size, kind, required):
+    """
+    Walks the top-level boxes of an ISO media file (MP4, MOV, HEIF); they must cover
+    the file exactly and include ftyp and the required boxes.
+    """
+    seen = set()
+    offset = 0
+    while offset < size:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return f"{kind} box header cut off (truncated)"
+        box_size, box_type = struct.unpack(">I4s", header)
+        if box_size == 1:
+            largesize = f.read(8)
+            if len(largesize) < 8:
+                return f"{kind} box header cut off (truncated)"
+            box_size = struct.unpack(">Q", largesize)[0]
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < 8:
+            return f"invalid {kind} box size at byte {offset}"
+        if offset + box_size > size:
+            return f"{kind} {box_type.decode('latin-1')} box extends past the end of the file (truncated)"
+        seen.add(box_type)
+        offset += box_size
+    if b"ftyp" not in seen:
+        return f"not an {kind} file"
+    missing = [name for name in required if name not in seen]
+    if missing:
+        return f"{kind} {', '.join(name.decode() for name in missing)} box missing"
+    return None
+
+
+def _check_mp4(f, size):
+    return _check_boxes(f, size, "MP4", (b"moov", b"mdat"))
+
+
+def _check_heif(f, size):
+    return _check_boxes(f, size, "HEIF", (b"meta",))
+
+
+# Major brands of HEIF images (HEIC, AVIF) in the ftyp box; other brands are videos.
+_HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1", b"avif", b"avis"}
+
+_CHECKS = {
+    ".jpg": _check_jpeg,
+    ".jpeg": _check_jpeg,
+    ".png": _check_png,
+    ".webp": _check_webp,
+    ".heic": _check_heif,
+    ".mp4": _check_mp4,
+    ".mov": _check_mp4,
+}
+
+
+def _detect_check(header, extension):
+    """
+    Picks the check for a file by its leading bytes, since the extension is not
+    reliable: every image is saved as .jpg, whatever format the CDN served. Falls
+    back to the extension's check for content that is not a known format.
+    """
+    if header.startswith(b"\xff\xd8\xff"):
+        return _check_jpeg
+    if header.startswith(_PNG_SIGNATURE):
+        return _check_png
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return _check_webp
+    if header[4:8] == b"ftyp":
+        return _check_heif if header[8:12] in _HEIF_BRANDS else _check_mp4
+    return _CHECKS.get(extension)
+
+
+def verify_file(path):
+    """
+    Hashes one media file and checks that it is complete.
+
+    Runs in a worker process, so it only takes and returns plain values.
+
+    Returns:
+        dict: {"path", "size", "mtime_ns", "sha256", "error"}; error is None for a
+        valid file, and sha256 is None if the file could not be read.
+    """
+    result = {"path": path, "size": None, "mtime_ns": None, "sha256": None, "error": None}
+    try:
+        stat = os.stat(path)
+        result["size"], result["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+            if stat.st_size == 0:
+                result["error"] = "empty file"
+            else:
+                f.seek(0)
+                check = _detect_check(f.read(16), os.path.splitext(path)[1].lower())
+                if check is not None:
+                    f.seek(0)
+                    result["error"] = check(f, stat.st_size)
+        result["sha256"] = digest.hexdigest()
+    except OSError as e:
+        result["error"] = f"unreadable: {e}"
+    return result
+
+
+class IntegrityChecker:
+    """
+    Verifies the media files of a download directory and deduplicates them.
+
+    New or changed files are hashed (SHA-256) and validated in a process pool, so
+    the work spreads over every core. The format is detected from the file's
+    leading bytes: JPEG files need their end marker, PNG files their IEND chunk,
+    WebP files their full RIFF length, MP4/MOV files top-level boxes that exactly
+    cover the file, including ftyp, moov and mdat, and HEIF images the same with a
+    meta box. A corrupt
+    file is renamed to "<name>.corrupt" and dropped from the manifest, so the next
+    sync downloads it again.
+
+    A valid file is linked into a content-addressed store (.objects/<hash prefix>/<hash>)
+    in the download directory. A later file with the same content is replaced by a
+    hardlink to the stored copy, so every distinct file takes disk space (and backup
+    I/O) once. Hardlinked files share their data: editing one in place changes all
+    of them.
+
+    Results are kept in .integrity.sqlite3, keyed by path, size and modification
+    time, so unchanged files are never hashed twice.
+    """
+
+    def __init__(self, download_path, processes=None, dedup=True, log_callback=None, cancel_event=None,
+                 manifest=None):
+        """
+        Args:
+            download_path (str): The root download directory.
+            processes (int): Worker processes; defaults to the number of CPUs.
+            dedup (bool): Whether to replace duplicates with hardlinks.
+            log_callback (function): Optional, a function to call for logging progress.
+            cancel_event (threading.Event): Optional, stops a check between files.
+            manifest (Manifest): Optional, the manifest to drop corrupt files from.
+                Defaults to the manifest in the root of download_path.
+        """
+        self.download_path = os.path.abspath(download_path)
+        self.processes = processes or os.cpu_count() or 1
+        self.dedup = dedup
+        self.log_callback = log_callback or (lambda message: None)
+        self.cancel_event = cancel_event or threading.Event()
+        self.manifest = manifest
+        self.objects_path = os.path.join(self.download_path, OBJECTS_DIRNAME)
+        os.makedirs(self.download_path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.download_path, INTEGRITY_FILENAME), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS files (
+                       path TEXT PRIMARY KEY,
+                       size INTEGER NOT NULL,
+                       mtime_ns INTEGER NOT NULL,
+                       sha256 TEXT,
+                       status TEXT NOT NULL,
+                       error TEXT,
+                       checked_at REAL NOT NULL
+                   )"""
+            )
+
+    def media_files(self):
+        """Yields every media file in the download directory, outside the object store."""
+        for root, dirs, files in os.walk(self.download_path):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in files:
+                if name.lower().endswith(MEDIA_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+    def _unchecked(self, paths):
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            row = self._conn.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (path,)).fetchone()
+            if row != (stat.st_size, stat.st_mtime_ns):
+                yield path
+
+    def check(self, paths=None):
+        """
+        Verifies and deduplicates the given files (default: every media file in the
+        download directory) that were not checked before in their current state.
+
+        Returns:
+            dict: {"checked", "ok", "corrupt", "duplicates", "bytes_saved", "seconds"}.
+        """
+        started = time.monotonic()
+        paths = self.media_files() if paths is None else (os.path.abspath(path) for path in paths)
+        summary = {"checked": 0, "ok": 0, "corrupt": 0, "duplicates": 0, "bytes_saved": 0}
+        pending = list(self._unchecked(paths))
+        if pending:
+            self.log_callback(f"Verifying {len(pending)} file(s) on {min(self.processes, len(pending))} process(es)...")
+            with ProcessPoolExecutor(max_workers=min(self.processes, len(pending))) as executor:
+                results = executor.map(verify_file, pending, chunksize=PROCESS_CHUNK_SIZE)
+                try:
+                    for result in results:
+                        self._handle(result, summary)
+                        if self.cancel_event.is_set():
+                            self.log_callback("Verification cancelled.")
+                            break
+                finally:
+                    executor.shutdown(wait=True, cancel_futures=True)
+        summary["seconds"] = round(time.monotonic() - started, 3)
+        if summary["checked"]:
+            self.log_callback(
+                f"Verified {summary['checked']} file(s): {summary['corrupt']} corrupt, {summary['duplicates']} "
+                f"duplicate(s) hardlinked, {summary['bytes_saved'] / (1024 * 1024):.1f} MB saved.")
+        return summary
+
+    def _handle(self, result, summary):
+        path = result["path"]
+        if result["size"] is None:
+            return
+        summary["checked"] += 1
+        status = OK
+        if result["error"]:
+            status = CORRUPT
+            summary["corrupt"] += 1
+            self._quarantine(path, result["error"])
+        else:
+            summary["ok"] += 1
+            if self.dedup:
+                saved = self._link(path, result)
+                if saved is not None:
+                    summary["duplicates"] += 1
+                    summary["bytes_saved"] += saved
+        with self._conn:
+            if status == CORRUPT:
+                self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            else:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Deleted or moved while it was being verified.
+                    self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                    return
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256, status, error, checked_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns, result["sha256"], status, None, time.time()),
+                )
+
+    def _quarantine(self, path, error):
+        self.log_callback(f"Corrupt file {os.path.relpath(path, self.download_path)}: {error}")
+        try:
+            os.replace(path, path + CORRUPT_SUFFIX)
+        except OSError as e:
+            self.log_callback(f"Could not move {path} aside: {e}")
+            return
+        manifest = self.manifest
+        if manifest is None:
+            manifest = Manifest.for_download_path(self.download_path)
+        try:
+            manifest.forget_path(path)
+        finally:
+            if self.manifest is None:
+                manifest.close()
+
+    def _link(self, path, result):
+        """
+        Links a verified file into the object store, or replaces it with a hardlink to
+        the stored copy of the same content. Returns the bytes saved, or None if the
+        file was not a duplicate.
+        """
+        digest = result["sha256"]
+        object_path = os.path.join(self.objects_path, digest[:2], digest)
+        try:
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime_ns) != (result["size"], result["mtime_ns"]):
+                return None  # Changed while it was being hashed; checked again next time.
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.link(path, object_path)
+                return None
+            stored = os.stat(object_path)
+            if os.path.samestat(stat, stored) or stored.st_size != stat.st_size:
+                return None
+            temporary = f"{path}.link"
+            os.link(object_path, temporary)
+            os.replace(temporary, path)
+        except OSError as e:
+            # Hardlinks need one filesystem that supports them; dedup is skipped otherwise.
+            self.log_callback(f"Could not deduplicate {os.path.relpath(path, self.download_path)}: {e}")
+            return None
+        return stat.st_size if stat.st_nlink == 1 else 0
+
+    def prune_objects(self):
+        """
+        Removes stored objects that no media file links to any more (deleted by the
+        user). Returns how many were removed.
+        """
+        removed = 0
+        for root, dirs, files in os.walk(self.objects_path):
+            for name in files:
+                object_path = os.path.join(root, name)
+                try:
+                    if os.stat(object_path).st_nlink == 1:
+                        os.remove(object_path)
+                        removed += 1
+                except OSError as e:
+                    self.log_callback(f"Could not prune {os.path.relpath(object_path, self.download_path)}: {e}")
+        return removed
+
+    def close(self):
+        self._conn.close()
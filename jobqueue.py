@@ -0,0 +1,464 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from cache import ResponseCache
+from cancel import CancelToken, on_cancel, remove_on_cancel
+from cookiepool import NoHealthySession
+from downloader import download_media, download_status
+from engine import DEFAULT_MAX_WORKERS
+from fetcher import MediaFetcher
+from filters import MediaFilter
+from manifest import Manifest
+from metrics import MetricsRegistry
+from progress import ProgressTracker
+from ratelimit import RateLimiter
+from session import DownloadSession
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# Seconds a claimed job stays leased without a heartbeat before another worker may take it.
+DEFAULT_LEASE = 120.0
+# Attempts (claims) per job before it is given up as failed.
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds an idle worker waits before asking the queue for work again.
+IDLE_POLL_INTERVAL = 2.0
+# Longest sleep of the heartbeat thread, so stop_event reaches running jobs quickly.
+WAKEUP_INTERVAL = 0.5
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Job:
+    """A claimed download job."""
+
+    def __init__(self, job_id, batch, username, options, attempts):
+        self.id = job_id
+        self.batch = batch
+        self.username = username
+        self.options = options
+        self.attempts = attempts
+        self.cancel_event = CancelToken()
+
+
+class JobQueue:
+    """
+    Durable queue of per-user download jobs that several worker processes or
+    machines can share.
+
+    Workers claim a job with a lease and extend it with heartbeats while they work.
+    A job whose lease ran out (its worker died or lost the connection to the queue)
+    is handed to the next worker that asks, up to max_attempts claims. Every state
+    change is a single SQLite transaction, so any number of workers can use one
+    queue file at the same time.
+
+    The queue uses SQLite's rollback journal instead of WAL: WAL needs shared memory
+    and only works for processes on one host, while the rollback journal also works
+    for workers on other machines that open the file on a network share with working
+    file locks.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The SQLite database file. Created if it does not exist.
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   batch TEXT NOT NULL,
+                   username TEXT NOT NULL,
+                   options TEXT NOT NULL,
+                   state TEXT NOT NULL,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   max_attempts INTEGER NOT NULL,
+                   worker TEXT,
+                   lease_expires REAL,
+                   enqueued_at REAL NOT NULL,
+                   started_at REAL,
+                   finished_at REAL,
+                   result TEXT,
+                   UNIQUE (batch, username)
+               )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+
+    def _transaction(self, func, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can never
+        # read the same queued job and both claim it.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, usernames, download_stories=True, download_posts=True, batch=None,
+                max_attempts=DEFAULT_MAX_ATTEMPTS, filters=None):
+        """
+        Adds one job per username. A username already in the batch is not added twice.
+
+        Args:
+            usernames (list): The accounts to download.
+            download_stories (bool): Whether the jobs download stories.
+            download_posts (bool): Whether the jobs download posts.
+            batch (str): Optional, the batch to add the jobs to; a new one by default.
+            max_attempts (int): Claims per job before it is given up as failed.
+            filters (dict): Optional, media filter settings as taken by
+                MediaFilter.from_settings, applied by the worker that runs each job.
+
+        Returns:
+            str: The batch ID.
+        """
+        batch = batch or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        options = {"download_stories": download_stories, "download_posts": download_posts}
+        if filters:
+            options["filters"] = filters
+        options = json.dumps(options)
+        now = time.time()
+
+        def insert():
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (batch, username, options, state, max_attempts, enqueued_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(batch, username, options, QUEUED, max_attempts, now) for username in dict.fromkeys(usernames)],
+            )
+        self._transaction(insert)
+        return batch
+
+    def _expire_leases(self, now):
+        self._conn.execute(
+            "UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, finished_at = ?, "
+            "result = json_object('status', 'failed', 'error', 'lease expired') "
+            "WHERE state = ? AND lease_expires < ? AND attempts >= max_attempts",
+            (FAILED, now, LEASED, now),
+        )
+        self._conn.execute(
+            "UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL WHERE state = ? AND lease_expires < ?",
+            (QUEUED, LEASED, now),
+        )
+
+    def claim(self, worker, lease=DEFAULT_LEASE):
+        """
+        Leases the oldest queued job to a worker, after requeueing jobs whose lease expired.
+
+        Returns:
+            Job: The claimed job, or None if nothing is queued.
+        """
+        def claim_one():
+            now = time.time()
+            self._expire_leases(now)
+            row = self._conn.execute(
+                "SELECT id, batch, username, options, attempts FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, started_at = ? "
+                "WHERE id = ?",
+                (LEASED, worker, now + lease, now, row[0]),
+            )
+            return Job(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1)
+        return self._transaction(claim_one)
+
+    def heartbeat(self, job_id, worker, lease=DEFAULT_LEASE):
+        """
+        Extends a lease. Returns False if the worker no longer holds it, in which
+        case the job may already run somewhere else and the worker should stop it.
+        """
+        def extend():
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?",
+                (time.time() + lease, job_id, worker, LEASED),
+            )
+            return cursor.rowcount == 1
+        return self._transaction(extend)
+
+    def complete(self, job_id, worker, status, result=None):
+        """
+        Reports the outcome of a job. A "failed" job is queued again while it has
+        attempts left; a "cancelled" one (its worker stopped) is queued again
+        without using up an attempt.
+
+        Returns:
+            bool: False if the worker no longer held the lease and the report was ignored.
+        """
+        result = dict(result or {}, status=status, worker=worker)
+
+        def finish():
+            row = self._conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND state = ?",
+                (job_id, worker, LEASED),
+            ).fetchone()
+            if row is None:
+                return False
+            attempts, max_attempts = row
+            if status == "cancelled":
+                state, attempts = QUEUED, attempts - 1
+            elif status == FAILED and attempts < max_attempts:
+                state = QUEUED
+            else:
+                state = DONE if status == DONE else FAILED
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, attempts = ?, worker = NULL, lease_expires = NULL, finished_at = ?, "
+                "result = ? WHERE id = ?",
+                (state, attempts, time.time(), json.dumps(result), job_id),
+            )
+            return True
+        return self._transaction(finish)
+
+    def summary(self, batch=None):
+        """
+        Returns the job counts by state and the totals reported by the workers, for
+        one batch or the whole queue.
+
+        Returns:
+            dict: {"jobs": {state: count}, "files": ..., "bytes": ..., "failed_files": ...,
+            "workers": {worker: jobs finished}}.
+        """
+        where, params = ("WHERE batch = ?", (batch,)) if batch else ("", ())
+        with self._lock:
+            states = dict(self._conn.execute(f"SELECT state, COUNT(*) FROM jobs {where} GROUP BY state", params))
+            results = [json.loads(row[0]) for row in self._conn.execute(
+                f"SELECT result FROM jobs {where} {'AND' if where else 'WHERE'} state IN (?, ?) AND result IS NOT NULL",
+                params + (DONE, FAILED))]
+        summary = {"jobs": states, "files": 0, "bytes": 0, "failed_files": 0, "workers": {}}
+        for result in results:
+            summary["files"] += result.get("files", 0)
+            summary["bytes"] += result.get("bytes", 0)
+            summary["failed_files"] += result.get("failed_files", 0)
+            worker = result.get("worker")
+            summary["workers"][worker] = summary["workers"].get(worker, 0) + 1
+        return summary
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class QueueWorker:
+    """
+    Claims jobs from a JobQueue and runs download_media for each, max_workers at a time.
+
+    One HTTP session, manifest, media fetcher, progress tracker and metrics registry
+    are shared by all jobs of the worker, as in DownloadEngine. A background thread
+    renews the lease of every running job; a job whose lease was lost is cancelled
+    so that it does not run twice.
+    """
+
+    def __init__(self, queue, cookies, download_path, log_callback, stop_event, worker_id=None,
+                 max_workers=DEFAULT_MAX_WORKERS, lease=DEFAULT_LEASE, keep_waiting=False, cookie_pool=None,
+                 result_callback=None, governor=None, archive_format=None, use_cache=True, media_filter=None,
+                 download_func=download_media):
+        """
+        Args:
+            queue (JobQueue): The queue to take jobs from.
+            cookies (dict): The cookies for authentication. Ignored when cookie_pool is given.
+            download_path (str): The root directory to save the downloaded media.
+            log_callback (function): A function to call for logging progress.
+            stop_event (threading.Event): Stops the worker when set; running jobs are
+                cancelled and put back in the queue.
+            worker_id (str): Optional, defaults to "<hostname>:<pid>".
+            max_workers (int): Jobs run at the same time.
+            lease (float): Lease duration in seconds, renewed every lease / 4 while a job runs.
+            keep_waiting (bool): Wait for new jobs when the queue is empty instead of returning.
+            cookie_pool (CookiePool): Optional, several sessions to spread the jobs across.
+            result_callback (function): Optional, called as (username, status, result) after
+                every job, with the result dict that is reported to the queue.
+            governor (BandwidthGovernor): Optional, the bandwidth budget of the worker.
+            archive_format (str): Optional, "tar" or "zip" to write daily archives per account.
+            use_cache (bool): Keep listings in the download directory's ResponseCache.
+            media_filter (MediaFilter): Optional, applied to jobs that were enqueued
+                without filters of their own.
+            download_func (function): The per-user download function, called with the
+                same arguments as downloader.download_media and returning its phase statuses.
+        """
+        self.queue = queue
+        self.cookies = cookies
+        self.download_path = download_path
+        self.log_callback = log_callback
+        self.stop_event = stop_event
+        self.worker_id = worker_id or default_worker_id()
+        self.max_workers = max(1, int(max_workers))
+        self.lease = lease
+        self.keep_waiting = keep_waiting
+        self.cookie_pool = cookie_pool
+        self.result_callback = result_callback
+        self.governor = governor
+        self.archive_format = archive_format
+        self.use_cache = use_cache
+        self.media_filter = media_filter
+        self.download_func = download_func
+        self.tracker = ProgressTracker()
+        self.metrics = MetricsRegistry()
+        self.results = {}
+        self._running = {}
+        self._halted = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Processes jobs until the queue is empty (or stop_event is set). Returns {job id: status}."""
+        self.log_callback(f"Worker {self.worker_id} is taking jobs from {self.queue.path}...")
+        shared = {
+            "manifest": Manifest.for_download_path(self.download_path),
+            "fetcher": MediaFetcher(),
+            "tracker": self.tracker,
+            "metrics": self.metrics,
+        }
+        if self.governor is not None:
+            shared["governor"] = self.governor
+        if self.archive_format:
+            shared["archive_format"] = self.archive_format
+        if self.use_cache:
+            shared["cache"] = ResponseCache.for_download_path(self.download_path, metrics=self.metrics)
+        session = None
+        if self.cookie_pool is not None:
+            self.cookie_pool.open(self.metrics, self.log_callback)
+        else:
+            session = DownloadSession(rate_limiter=RateLimiter(), metrics=self.metrics)
+        # A CancelToken as stop_event reaches the running jobs at once, not on the next heartbeat tick.
+        stop_handle = on_cancel(self._cancel_running, self.stop_event)
+        heartbeats_done = threading.Event()
+        heartbeat_thread = threading.Thread(target=self._heartbeat_loop, args=(heartbeats_done,), daemon=True)
+        heartbeat_thread.start()
+        slots = [threading.Thread(target=self._slot_loop, args=(shared, session), name=f"insta-queue-{i}")
+                 for i in range(self.max_workers)]
+        try:
+            for slot in slots:
+                slot.start()
+            for slot in slots:
+                slot.join()
+        finally:
+            remove_on_cancel(stop_handle)
+            heartbeats_done.set()
+            heartbeat_thread.join()
+            shared["manifest"].close()
+            shared["fetcher"].close()
+            if "cache" in shared:
+                shared["cache"].close()
+            if session is not None:
+                session.close()
+            if self.cookie_pool is not None:
+                self.cookie_pool.close()
+        self.log_callback(f"Worker {self.worker_id} finished {len(self.results)} job(s).")
+        return self.results
+
+    def _slot_loop(self, shared, session):
+        while not self.stop_event.is_set() and not self._halted.is_set():
+            job = self.queue.claim(self.worker_id, self.lease)
+            if job is None:
+                if not self.keep_waiting:
+                    return
+                self.stop_event.wait(IDLE_POLL_INTERVAL)
+                continue
+            with self._lock:
+                self._running[job.id] = job
+            try:
+                status, result = self._run_job(job, shared, session)
+            finally:
+                with self._lock:
+                    del self._running[job.id]
+            if not self.queue.complete(job.id, self.worker_id, status, result):
+                self.log_callback(f"Job {job.id} (@{job.username}) was taken over by another worker, "
+                                  f"its result was discarded.")
+            if self.result_callback is not None and status != "cancelled":
+                self.result_callback(job.username, status, result)
+            with self._lock:
+                self.results[job.id] = status
+
+    def _run_job(self, job, shared, session):
+        self.log_callback(f"Job {job.id}: @{job.username} (batch {job.batch}, attempt {job.attempts})")
+        before = self.tracker.snapshot(job.username)
+        started = time.monotonic()
+        pooled = None
+        error = None
+        try:
+            if self.cookie_pool is not None:
+                pooled = self.cookie_pool.acquire(job.cancel_event)
+                if pooled is None:
+                    return "cancelled", {}
+                cookies, session = pooled.cookies, pooled.session
+            else:
+                cookies = self.cookies
+            media_filter = self.media_filter
+            if job.options.get("filters"):
+                media_filter = MediaFilter.from_settings(job.options["filters"])
+            statuses = self.download_func(job.username, cookies, self.download_path, self.log_callback,
+                                          lambda value: None, job.cancel_event, job.options["download_stories"],
+                                          job.options["download_posts"], session=session, media_filter=media_filter,
+                                          **shared)
+            status = download_status(statuses, job.cancel_event)
+        except NoHealthySession as e:
+            # Nothing this worker can do any more; leave the job to a worker with valid cookies.
+            self.log_callback(f"{e} Worker {self.worker_id} stops taking jobs.")
+            self._halted.set()
+            return "cancelled", {}
+        except Exception as e:
+            self.log_callback(f"Download failed for @{job.username}: {e}")
+            status, error = FAILED, str(e)
+        finally:
+            if pooled is not None:
+                self.cookie_pool.release(pooled, completed=error is None and not job.cancel_event.is_set())
+        self.metrics.inc("insta_accounts_total", status=status)
+        after = self.tracker.snapshot(job.username)
+        result = {
+            "files": after["items_done"] - before["items_done"],
+            "bytes": after["bytes_done"] - before["bytes_done"],
+            "failed_files": after["items_failed"] - before["items_failed"],
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        if error:
+            result["error"] = error
+        elif status == FAILED:
+            failed = [phase for phase, phase_status in statuses.items() if phase_status == FAILED]
+            result["error"] = f"{' and '.join(failed).capitalize()} failed"
+        return status, result
+
+    def _cancel_running(self):
+        with self._lock:
+            running = list(self._running.values())
+        for job in running:
+            job.cancel_event.set()
+
+    def _heartbeat_loop(self, done):
+        next_heartbeat = time.monotonic() + self.lease / 4
+        while not done.wait(WAKEUP_INTERVAL):
+            with self._lock:
+                running = list(self._running.values())
+            if self.stop_event.is_set() or self._halted.is_set():
+                for job in running:
+                    job.cancel_event.set()
+                continue
+            if time.monotonic() < next_heartbeat:
+                continue
+            next_heartbeat = time.monotonic() + self.lease / 4
+            for job in running:
+                try:
+                    held = self.queue.heartbeat(job.id, self.worker_id, self.lease)
+                except sqlite3.OperationalError as e:
+                    # E.g. "database is locked" while other workers write. The lease is
+                    # renewed at a quarter of its duration, so there is time to retry.
+                    self.log_callback(f"Could not renew the lease on @{job.username}: {e}. Retrying.")
+                    next_heartbeat = time.monotonic()
+                    continue
+                if not held:
+                    self.log_callback(f"Lost the lease on @{job.username}, cancelling it.")
+                    job.cancel_event.set()
@@ -0,0 +1,196 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+JOURNAL_FILENAME = ".journal.sqlite3"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Runs of a unit (one phase of one user) before a failed unit is no longer retried on resume.
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds since an interrupted batch last made progress after which it is no longer resumed.
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+def batch_key(usernames, phases):
+    """Identifies a batch by its users and phases, so the same selection resumes the same batch."""
+    digest = hashlib.sha1()
+    for part in sorted(usernames) + ["|"] + sorted(phases):
+        digest.update(part.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+class BatchJournal:
+    """
+    Write-ahead journal of the batches run into one download directory.
+
+    Every batch is split into units, one per user and phase ("stories", "posts").
+    A unit is marked running before it starts and done or failed when it ends, each
+    in its own committed transaction with synchronous=FULL, so the journal survives
+    the application being closed or the machine losing power at any point. A batch
+    that runs to the end is closed, even if some of its units failed. Starting the
+    same batch again (the same users and phases) after it was interrupted, by a
+    cancel or by the process dying, resumes it: finished units are skipped, units
+    that were running or cancelled start over, and failed units are retried until
+    they used up max_attempts runs.
+    """
+
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS, max_age=DEFAULT_MAX_AGE):
+        """
+        Args:
+            path (str): The SQLite database file. Created if it does not exist.
+            max_attempts (int): Runs of a unit before a failure is final.
+            max_age (float): Seconds since an interrupted batch last made progress
+                after which starting it again begins a new batch instead.
+        """
+        self.path = path
+        self.max_attempts = max(1, int(max_attempts))
+        self.max_age = max_age
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS batches (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       key TEXT NOT NULL,
+                       created_at REAL NOT NULL,
+                       finished_at REAL
+                   )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS units (
+                       batch INTEGER NOT NULL,
+                       username TEXT NOT NULL,
+                       phase TEXT NOT NULL,
+                       position INTEGER NOT NULL,
+                       state TEXT NOT NULL,
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       error TEXT,
+                       updated_at REAL NOT NULL,
+                       PRIMARY KEY (batch, username, phase)
+                   )"""
+            )
+
+    @classmethod
+    def for_download_path(cls, download_path, **kwargs):
+        """Opens the journal that lives in the root of a download directory."""
+        return cls(os.path.join(os.path.abspath(download_path), JOURNAL_FILENAME), **kwargs)
+
+    def begin(self, usernames, phases):
+        """
+        Resumes the interrupted batch with the same users and phases, or starts a new one.
+
+        A batch is resumed only while it has units left pending or running, and only
+        if it made progress within max_age. Other unclosed batches with the key are
+        closed.
+
+        Returns:
+            JournalBatch: The batch; batch.resumed tells whether it was resumed.
+        """
+        usernames = list(dict.fromkeys(usernames))
+        key = batch_key(usernames, phases)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT id FROM batches WHERE key = ? AND finished_at IS NULL ORDER BY id DESC LIMIT 1", (key,)
+            ).fetchone()
+            if row is not None:
+                batch_id = row[0]
+                interrupted = self._conn.execute(
+                    "SELECT COUNT(*) FROM units WHERE batch = ? AND state IN (?, ?)", (batch_id, PENDING, RUNNING)
+                ).fetchone()[0]
+                last_update = self._conn.execute(
+                    "SELECT MAX(updated_at) FROM units WHERE batch = ?", (batch_id,)
+                ).fetchone()[0]
+                if interrupted and last_update is not None and now - last_update <= self.max_age:
+                    # Units still marked running were interrupted by a crash or a forced exit.
+                    self._conn.execute("UPDATE units SET state = ?, updated_at = ? WHERE batch = ? AND state = ?",
+                                       (PENDING, now, batch_id, RUNNING))
+                    return JournalBatch(self, batch_id, resumed=True)
+                self._conn.execute("UPDATE batches SET finished_at = ? WHERE key = ? AND finished_at IS NULL",
+                                   (now, key))
+            batch_id = self._conn.execute("INSERT INTO batches (key, created_at) VALUES (?, ?)", (key, now)).lastrowid
+            self._conn.executemany(
+                "INSERT INTO units (batch, username, phase, position, state, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(batch_id, username, phase, position, PENDING, now)
+                 for position, username in enumerate(usernames) for phase in phases],
+            )
+        return JournalBatch(self, batch_id, resumed=False)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JournalBatch:
+    """One batch of a BatchJournal; passed to download_media to journal its phases."""
+
+    def __init__(self, journal, batch_id, resumed):
+        self.journal = journal
+        self.id = batch_id
+        self.resumed = resumed
+
+    def _units(self):
+        with self.journal._lock:
+            return self.journal._conn.execute(
+                "SELECT username, phase, state, attempts FROM units WHERE batch = ? ORDER BY position", (self.id,)
+            ).fetchall()
+
+    def plan(self):
+        """
+        Sorts the users of the batch by what is left to do, in batch order.
+
+        Returns:
+            tuple: (usernames with units to run, usernames that are finished,
+            usernames whose failed units used up their attempts).
+        """
+        todo, finished, exhausted = {}, {}, {}
+        for username, phase, state, attempts in self._units():
+            if state == PENDING or (state == FAILED and attempts < self.journal.max_attempts):
+                todo[username] = True
+            elif state == FAILED:
+                exhausted[username] = True
+            else:
+                finished[username] = True
+        exhausted = [username for username in exhausted if username not in todo]
+        finished = [username for username in finished if username not in todo and username not in exhausted]
+        return list(todo), finished, exhausted
+
+    def should_run(self, username, phase):
+        """Whether a unit still has to run: it is pending, or failed with attempts left."""
+        with self.journal._lock:
+            row = self.journal._conn.execute(
+                "SELECT state, attempts FROM units WHERE batch = ? AND username = ? AND phase = ?",
+                (self.id, username, phase),
+            ).fetchone()
+        if row is None:
+            return True
+        state, attempts = row
+        return state == PENDING or (state == FAILED and attempts < self.journal.max_attempts)
+
+    def mark(self, username, phase, state, error=None):
+        """Records a unit's new state; marking it running counts an attempt."""
+        with self.journal._lock, self.journal._conn:
+            self.journal._conn.execute(
+                "UPDATE units SET state = ?, error = ?, updated_at = ?, attempts = attempts + ? "
+                "WHERE batch = ? AND username = ? AND phase = ?",
+                (state, error, time.time(), int(state == RUNNING), self.id, username, phase),
+            )
+
+    def finish(self):
+        """
+        Closes the batch after it ran to the end, failed units included, so the next
+        run with the same selection starts a new batch. A cancelled batch is left open
+        for the next run to resume.
+        """
+        with self.journal._lock, self.journal._conn:
+            self.journal._conn.execute("UPDATE batches SET finished_at = ? WHERE id = ?", (time.time(), self.id))
@@ -0,0 +1,268 @@
+import queue
+import threading
+
+from cache import FEED, FEED_PAGE, PROFILE, STORIES, session_identity
+from cancel import cancel_scope
+from session import TIMEOUT
+
+INSTAGRAM_URL = "https://www.instagram.com"
+WEB_APP_ID = "936619743392459"
+POSTS_PAGE_SIZE = 12
+
+API_HEADERS = {
+    'accept': '*/*',
+    'accept-language': 'en-US,en;q=0.9',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+    'x-ig-app-id': WEB_APP_ID,
+    'x-requested-with': 'XMLHttpRequest',
+}
+
+
+class ListingError(Exception):
+    """Raised when a profile or media listing cannot be fetched."""
+
+
+def _parse_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        raise ListingError(f"{response.url} did not return JSON")
+
+
+def _cached_get(session, url, cookies, headers, params, parse, cache=None, endpoint=None, key=None):
+    """
+    GETs a listing URL and returns parse(response), through the response cache if one
+    is given: a fresh cached value is returned without a request, and a stale one is
+    revalidated with its ETag / Last-Modified, keeping it on 304 Not Modified. Keys
+    are scoped to the account the cookies are logged in as.
+    """
+    if cache is not None:
+        key = f"{session_identity(cookies)}:{key}"
+    cached = cache.lookup(endpoint, key) if cache is not None else None
+    if cached is not None:
+        if cached.fresh:
+            return cached.value
+        headers = dict(headers, **cached.validators())
+    response = session.get(url, params=params, cookies=cookies, headers=headers, timeout=TIMEOUT)
+    if response.status_code == 304 and cached is not None:
+        cache.revalidated(endpoint, key)
+        return cached.value
+    if response.status_code != 200:
+        raise ListingError(f"{url} returned HTTP {response.status_code}")
+    value = parse(response)
+    if cache is not None:
+        cache.store(endpoint, key, value, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return value
+
+
+def _api_headers(cookies):
+    headers = dict(API_HEADERS)
+    csrf_token = cookies.get('csrftoken') if isinstance(cookies, dict) else None
+    if csrf_token:
+        headers['x-csrftoken'] = csrf_token
+    return headers
+
+
+def _get_json(session, url, cookies, params=None, cache=None, endpoint=None, key=None):
+    return _cached_get(session, url, cookies, _api_headers(cookies), params, _parse_json, cache, endpoint, key)
+
+
+def fetch_profile(session, username, cookies, cache=None):
+    """
+    Looks up an Instagram username.
+
+    Args:
+        session (requests.Session): The HTTP session to use.
+        username (str): The Instagram username.
+        cookies (dict): The cookies for authentication.
+        cache (ResponseCache): Optional, caches the profile of every username.
+
+    Returns:
+        dict: "id", the numeric user ID, and "profile_pic_url" (None if there is none).
+    """
+    def parse(response):
+        # Only what is used is kept, the full profile response is large.
+        try:
+            user = _parse_json(response)['data']['user']
+            return {'id': str(user['id']),
+                    'profile_pic_url': user.get('profile_pic_url_hd') or user.get('profile_pic_url')}
+        except (KeyError, TypeError):
+            raise ListingError(f"User @{username} not found")
+
+    return _cached_get(session, f"{INSTAGRAM_URL}/api/v1/users/web_profile_info/", cookies, _api_headers(cookies),
+                       {'username': username}, parse, cache, PROFILE, username.lower())
+
+
+def resolve_user_id(session, username, cookies, cache=None):
+    """
+    Resolves an Instagram username to its numeric user ID (see fetch_profile).
+
+    Returns:
+        str: The user ID.
+    """
+    return fetch_profile(session, username, cookies, cache)['id']
+
+
+def iter_post_pages(session, user_id, cookies, cache=None):
+    """
+    Yields a user's feed one listing page at a time, newest first.
+
+    Args:
+        session (requests.Session): The HTTP session to use.
+        user_id (str): The numeric Instagram user ID.
+        cookies (dict): The cookies for authentication.
+        cache (ResponseCache): Optional, caches the pages; the newest page for a
+            shorter time than the older ones.
+
+    Yields:
+        list: The raw feed items of one page.
+    """
+    max_id = None
+    while True:
+        params = {'count': POSTS_PAGE_SIZE}
+        if max_id:
+            params['max_id'] = max_id
+        data = _get_json(session, f"{INSTAGRAM_URL}/api/v1/feed/user/{user_id}/", cookies, params=params, cache=cache,
+                         endpoint=FEED_PAGE if max_id else FEED, key=f"{user_id}:{max_id or ''}")
+        yield data.get('items', [])
+        max_id = data.get('next_max_id')
+        if not data.get('more_available') or not max_id:
+            return
+
+
+class PagePrefetcher:
+    """
+    Iterates over a page iterator such as iter_post_pages with the next page already
+    being requested in a background thread while the caller works on the current one.
+
+    The first page is requested as soon as the prefetcher is created and the second
+    only once it is asked for, so the usual short feed costs no more listing requests
+    in a burst than iterating directly; from the second page on, the next one is
+    fetched ahead. At most one page is held ahead, so memory use stays the same
+    however many pages there are. close() stops the background thread after the
+    request it has in flight.
+    """
+
+    def __init__(self, pages, cancel_event=None):
+        """
+        Args:
+            pages (iterator): The pages to iterate over.
+            cancel_event (threading.Event): Optional, the background thread's cancel
+                event (see cancel.cancel_scope), so cancelling aborts its request in flight.
+        """
+        self._ready = queue.Queue()
+        self._room = threading.Semaphore(0)
+        self._stopped = threading.Event()
+        self._finished = False
+        self._taken = 0
+        threading.Thread(target=self._produce, args=(pages, cancel_event), name="insta-prefetch", daemon=True).start()
+
+    def _produce(self, pages, cancel_event):
+        with cancel_scope(cancel_event):
+            try:
+                for page in pages:
+                    self._ready.put((page, None))
+                    self._room.acquire()  # Wait until the caller lets the next page be fetched.
+                    if self._stopped.is_set():
+                        return
+            except BaseException as e:
+                self._ready.put((None, e))
+                return
+            self._ready.put((None, StopIteration()))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Returns the next page. An exception raised while fetching it is raised instead."""
+        if self._finished:
+            raise StopIteration
+        if self._taken == 1:
+            self._room.release()  # The feed goes on: request the second page now.
+        page, error = self._ready.get()
+        self._taken += 1
+        if self._taken > 1:
+            self._room.release()
+        if error is not None:
+            self._finished = True
+            raise error
+        return page
+
+    def close(self):
+        self._finished = True
+        self._stopped.set()
+        self._room.release()
+
+
+def fetch_story_reel(session, username, cookies, cache=None):
+    """
+    Fetches a user's current story reel by loading the story page anonymously and
+    extracting the reel JSON with instacapture's parser.
+
+    Args:
+        cache (ResponseCache): Optional, caches the extracted reel, not the page.
+
+    Returns:
+        dict: The reel JSON (with "items"), or None when the user has no active stories.
+    """
+    from instacapture import InstaStory  # Imported lazily, it pulls in lxml and pytz.
+
+    story = InstaStory(username, cookies)
+    try:
+        return _cached_get(session, f"{INSTAGRAM_URL}/stories/{story.username}/", story.cookies, story.headers(),
+                           {'r': '1'}, lambda response: story.get_json_data(response) or None, cache, STORIES,
+                           username.lower())
+    except ListingError as e:
+        raise ListingError(f"Story page for @{username}: {e}")
+
+
+def media_entries(item):
+    """
+    Flattens a story or feed item into downloadable media entries.
+
+    Carousel posts produce one entry per child. Items without a usable URL are skipped.
+
+    Args:
+        item (dict): A raw story or feed item.
+
+    Returns:
+        list: dicts with "id", "url", "is_video", "ext", "taken_at", "parent_id",
+        "media_type" ("image", "video", "reel" or "carousel"), "width", "height" and
+        "versions" (every rendition as a (url, width, height) tuple, largest first).
+    """
+    entries = []
+    carousel = bool(item.get('carousel_media'))
+    nodes = item.get('carousel_media') or [item]
+    for node in nodes:
+        try:
+            if node.get('video_versions'):
+                renditions, is_video = node['video_versions'], True
+            else:
+                renditions, is_video = node['image_versions2']['candidates'], False
+            url = renditions[0]['url']
+        except (KeyError, IndexError, TypeError):
+            continue
+        if not url:
+            continue
+        versions = sorted(((rendition.get('url'), rendition.get('width') or 0, rendition.get('height') or 0)
+                           for rendition in renditions if rendition.get('url')),
+                          key=lambda version: version[1] * version[2], reverse=True)
+        if carousel:
+            media_type = 'carousel'
+        elif item.get('product_type') == 'clips':
+            media_type = 'reel'
+        else:
+            media_type = 'video' if is_video else 'image'
+        entries.append({
+            'id': str(node.get('pk') or node.get('id')).split('_')[0],
+            'url': url,
+            'is_video': is_video,
+            'ext': '.mp4' if is_video else '.jpg',
+            'taken_at': node.get('taken_at') or item.get('taken_at'),
+            'parent_id': str(item.get('pk') or item.get('id')).split('_')[0],
+            'media_type': media_type,
+            'width': renditions[0].get('width') or 0,
+            'height': renditions[0].get('height') or 0,
+            'versions': versions,
+        })
+    return entries
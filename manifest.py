@@ -0,0 +1,95 @@
+import os
+import sqlite3
+import threading
+import time
+
+MANIFEST_FILENAME = ".manifest.sqlite3"
+
+
+class Manifest:
+    """Persistent index of every media file already fetched, keyed by username and media ID."""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The SQLite database file. Created if it does not exist.
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS media (
+                   username TEXT NOT NULL,
+                   media_id TEXT NOT NULL,
+                   kind TEXT NOT NULL,
+                   path TEXT,
+                   size INTEGER,
+                   fetched_at REAL NOT NULL,
+                   PRIMARY KEY (username, media_id)
+               )"""
+        )
+        self._conn.commit()
+
+    @classmethod
+    def for_download_path(cls, download_path):
+        """Opens the manifest that lives in the root of a download directory."""
+        return cls(os.path.join(os.path.abspath(download_path), MANIFEST_FILENAME))
+
+    def known_ids(self, username, kind=None):
+        """
+        Returns the set of media IDs already fetched for a user.
+
+        Args:
+            username (str): The Instagram username.
+            kind (str): Optional, only return IDs of this kind ("story" or "post").
+        """
+        query = "SELECT media_id FROM media WHERE username = ?"
+        params = [username]
+        if kind:
+            query += " AND kind = ?"
+            params.append(kind)
+        with self._lock:
+            return {row[0] for row in self._conn.execute(query, params)}
+
+    def known_among(self, username, media_ids):
+        """
+        Returns the subset of media_ids already fetched for a user. Unlike known_ids,
+        the memory this takes does not grow with the user's history.
+        """
+        media_ids = list(media_ids)
+        if not media_ids:
+            return set()
+        placeholders = ", ".join("?" * len(media_ids))
+        with self._lock:
+            return {row[0] for row in self._conn.execute(
+                f"SELECT media_id FROM media WHERE username = ? AND media_id IN ({placeholders})",
+                [username] + media_ids)}
+
+    def record(self, username, media_id, kind, path, size):
+        """Marks a media item as fetched."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media (username, media_id, kind, path, size, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (username, media_id, kind, path, size, time.time()),
+            )
+            self._conn.commit()
+
+    def paths_since(self, timestamp):
+        """Returns the paths of the media fetched at or after timestamp."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT path FROM media WHERE fetched_at >= ? AND path IS NOT NULL", (timestamp,))]
+
+    def forget_path(self, path):
+        """Drops the media stored at path, so that the next sync fetches it again."""
+        with self._lock:
+            self._conn.execute("DELETE FROM media WHERE path = ?", (path,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
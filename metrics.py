@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# name -> (type, help). Every metric the download core records is declared here.
+METRICS = {
+    "insta_http_requests_total": ("counter", "HTTP requests sent, by host and status code."),
+    "insta_http_request_duration_seconds": ("histogram", "Time until the response headers arrived, by host."),
+    "insta_http_retries_total": ("counter", "Retried HTTP requests, by host and cause."),
+    "insta_phase_duration_seconds": ("histogram", "Duration of the story and post phase of one user."),
+    "insta_media_files_total": ("counter", "Media files downloaded, by kind."),
+    "insta_media_bytes_total": ("counter", "Media bytes downloaded, by kind."),
+    "insta_failures_total": ("counter", "Failed media files and phases, by stage and cause."),
+    "insta_accounts_total": ("counter", "Accounts processed, by status."),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and duration histograms for one download run.
+
+    Aggregate metrics are labelled by host, kind, phase and cause only, so the
+    Prometheus export stays small however many accounts a batch has. Per-account
+    totals are kept separately and appear only in the JSON run report.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._accounts = {}
+        self.started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            key = _label_key(labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(DURATION_BUCKETS)
+            histogram.observe(value)
+
+    def account(self, username, **amounts):
+        """Adds amounts (files, bytes, failures, <phase>_seconds, ...) to an account's totals."""
+        with self._lock:
+            totals = self._accounts.setdefault(username, {})
+            for field, amount in amounts.items():
+                totals[field] = totals.get(field, 0) + amount
+
+    def to_prometheus(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in METRICS.items():
+                if metric_type == "counter" and name in self._counters:
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                    for key, value in sorted(self._counters[name].items()):
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+                elif metric_type == "histogram" and name in self._histograms:
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                    for key, histogram in sorted(self._histograms[name].items()):
+                        for bound, count in zip(histogram.buckets, histogram.counts):
+                            lines.append(f"{name}_bucket{_format_labels(key, {'le': bound})} {count}")
+                        lines.append(f"{name}_bucket{_format_labels(key, {'le': '+Inf'})} {histogram.count}")
+                        lines.append(f"{name}_sum{_format_labels(key)} {round(histogram.sum, 6)}")
+                        lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+            lines.append("# HELP insta_run_started_timestamp_seconds Start time of the run.")
+            lines.append("# TYPE insta_run_started_timestamp_seconds gauge")
+            lines.append(f"insta_run_started_timestamp_seconds {round(self.started, 3)}")
+        return "\n".join(lines) + "\n"
+
+    def to_report(self):
+        """Returns the run as a JSON-serialisable dict, including per-account totals."""
+        with self._lock:
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in sorted(series.items())]
+                for name, series in self._counters.items()
+            }
+            histograms = {
+                name: [{"labels": dict(key), "count": h.count, "sum": round(h.sum, 6),
+                        "buckets": dict(zip(map(str, h.buckets), h.counts))} for key, h in sorted(series.items())]
+                for name, series in self._histograms.items()
+            }
+            accounts = {username: dict(totals) for username, totals in self._accounts.items()}
+        return {
+            "started": round(self.started, 3),
+            "finished": round(time.time(), 3),
+            "counters": counters,
+            "histograms": histograms,
+            "accounts": accounts,
+        }
+
+    def write_prometheus_textfile(self, path):
+        """Writes the Prometheus export atomically (for node_exporter's textfile collector)."""
+        _write_atomic(path, self.to_prometheus())
+
+    def write_json_report(self, path):
+        _write_atomic(path, json.dumps(self.to_report(), indent=2))
+
+
+def _write_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,154 @@
+import collections
+import threading
+import time
+
+# Seconds of history used for the rolling throughput.
+THROUGHPUT_WINDOW = 10.0
+# Minimum seconds between two throughput events.
+EVENT_INTERVAL = 1.0
+
+
+class _Counts:
+    def __init__(self):
+        self.items_found = 0
+        self.items_done = 0
+        self.items_failed = 0
+        self.bytes_done = 0
+        self.started = time.monotonic()
+        self.samples = collections.deque()
+
+    def add_sample(self, now, nbytes, files):
+        self.samples.append((now, nbytes, files))
+        while self.samples and now - self.samples[0][0] > THROUGHPUT_WINDOW:
+            self.samples.popleft()
+
+    def snapshot(self, now):
+        span = min(THROUGHPUT_WINDOW, max(now - self.started, 1e-6))
+        window_bytes = sum(sample[1] for sample in self.samples if now - sample[0] <= span)
+        window_files = sum(sample[2] for sample in self.samples if now - sample[0] <= span)
+        bytes_per_s = window_bytes / span
+        files_per_s = window_files / span
+        remaining = max(0, self.items_found - self.items_done - self.items_failed)
+        eta = None
+        if remaining == 0:
+            eta = 0.0
+        elif self.items_done and bytes_per_s > 0:
+            eta = remaining * (self.bytes_done / self.items_done) / bytes_per_s
+        elif files_per_s > 0:
+            eta = remaining / files_per_s
+        return {
+            "items_found": self.items_found,
+            "items_done": self.items_done,
+            "items_failed": self.items_failed,
+            "bytes_done": self.bytes_done,
+            "bytes_per_s": round(bytes_per_s, 1),
+            "files_per_s": round(files_per_s, 3),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "elapsed_seconds": round(now - self.started, 3),
+        }
+
+
+class ProgressTracker:
+    """
+    Counts media items and bytes per user and for the whole batch.
+
+    The download core reports every discovered item, every chunk of bytes and every
+    finished item. From that the tracker derives a rolling throughput (bytes/s and
+    files/s over the last THROUGHPUT_WINDOW seconds) and an ETA for the items
+    discovered so far. Snapshots are published to event_callback at most once per
+    EVENT_INTERVAL, as a structured event stream next to the plain percentage
+    passed to progress_callback.
+    """
+
+    def __init__(self, event_callback=None):
+        """
+        Args:
+            event_callback (function): Optional, called with a dict
+                {"event": "throughput", "username": ..., "user": {...}, "batch": {...}}.
+        """
+        self.event_callback = event_callback
+        self._lock = threading.Lock()
+        self._batch = _Counts()
+        self._users = {}
+        self._last_event = 0.0
+
+    def _user(self, username):
+        counts = self._users.get(username)
+        if counts is None:
+            counts = self._users[username] = _Counts()
+        return counts
+
+    def items_found(self, username, count):
+        with self._lock:
+            self._user(username).items_found += count
+            self._batch.items_found += count
+        self._publish(username)
+
+    def bytes_transferred(self, username, nbytes):
+        now = time.monotonic()
+        with self._lock:
+            for counts in (self._user(username), self._batch):
+                counts.bytes_done += nbytes
+                counts.add_sample(now, nbytes, 0)
+        self._publish(username)
+
+    def item_finished(self, username, failed=False):
+        now = time.monotonic()
+        with self._lock:
+            for counts in (self._user(username), self._batch):
+                if failed:
+                    counts.items_failed += 1
+                else:
+                    counts.items_done += 1
+                    counts.add_sample(now, 0, 1)
+        self._publish(username)
+
+    def item_skipped(self, username):
+        """Takes back an item that was found but is not going to be downloaded after all."""
+        with self._lock:
+            for counts in (self._user(username), self._batch):
+                counts.items_found -= 1
+        self._publish(username)
+
+    def user_counts(self, username):
+        """Returns (items_found, items_finished) for a user, failed items included as finished."""
+        with self._lock:
+            counts = self._user(username)
+            return counts.items_found, counts.items_done + counts.items_failed
+
+    def snapshot(self, username=None):
+        """Returns the counters, throughput and ETA of one user, or of the batch when username is None."""
+        now = time.monotonic()
+        with self._lock:
+            counts = self._batch if username is None else self._user(username)
+            return counts.snapshot(now)
+
+    def _publish(self, username, force=False):
+        if self.event_callback is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_event < EVENT_INTERVAL:
+                return
+            self._last_event = now
+            event = {
+                "event": "throughput",
+                "username": username,
+                "user": self._user(username).snapshot(now),
+                "batch": self._batch.snapshot(now),
+            }
+        self.event_callback(event)
+
+    def flush(self, username):
+        """Publishes a final snapshot regardless of EVENT_INTERVAL."""
+        self._publish(username, force=True)
+
+
+def format_rate(snapshot):
+    """Formats a snapshot as 'x.x MB/s, y.y files/s, ETA m:ss' for display."""
+    text = f"{snapshot['bytes_per_s'] / (1024 * 1024):.1f} MB/s, {snapshot['files_per_s']:.1f} files/s"
+    eta = snapshot.get("eta_seconds")
+    if eta is not None:
+        minutes, seconds = divmod(int(eta), 60)
+        text += f", ETA {minutes}:{seconds:02d}"
+    return text
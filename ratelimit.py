@@ -0,0 +1,161 @@
+import email.utils
+import random
+import threading
+import time
+
+DEFAULT_RATE = 8.0
+DEFAULT_BURST = 16
+DEFAULT_MIN_RATE = 0.2
+DEFAULT_MAX_RATE = 64.0
+DEFAULT_MAX_RETRIES = 5
+# Responses that mean "slow down and try again".
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, given either in seconds or as an HTTP date.
+
+    Returns:
+        float: The number of seconds to wait, or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class _Bucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+
+class RateLimiter:
+    """
+    Shared token-bucket rate limiter that adapts to throttling.
+
+    Every request takes one token from the bucket of its host, so throttling on the
+    API host does not slow down media downloads from the CDN. A bucket's refill rate
+    grows additively after each successful response and is halved on 429/5xx
+    responses, so a batch settles near the highest rate the server tolerates instead
+    of bursting and failing. A Retry-After header pauses the host's bucket for that long.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=DEFAULT_MIN_RATE, max_rate=DEFAULT_MAX_RATE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_base=1.0, backoff_cap=60.0, on_rate_change=None):
+        """
+        Args:
+            rate (float): Initial requests per second for each host.
+            burst (int): Bucket capacity, the number of requests that may be sent back to back.
+            min_rate (float): A host's rate never drops below this.
+            max_rate (float): A host's rate never grows beyond this.
+            max_retries (int): Retries per request before the throttled response is returned.
+            backoff_base (float): First retry delay in seconds, doubled on every further retry.
+            backoff_cap (float): Upper bound for a single retry delay.
+            on_rate_change (function): Optional, called as (host, new_rate, reason) when
+                throttling lowers a host's rate.
+        """
+        self.initial_rate = min(max(rate, min_rate), max_rate)
+        self.burst = max(1, int(burst))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.on_rate_change = on_rate_change
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_seconds = 0.0
+
+    def _bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = _Bucket(self.initial_rate, self.burst)
+        return bucket
+
+    def rates(self):
+        """Returns the current refill rate of every host in requests per second."""
+        with self._lock:
+            return {host: round(bucket.rate, 2) for host, bucket in self._buckets.items()}
+
+    def acquire(self, host, cancel_event=None):
+        """
+        Blocks until a request to host may be sent.
+
+        Returns:
+            bool: True, or False if cancel_event was set while waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                bucket = self._bucket(host)
+                now = time.monotonic()
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                bucket.updated = now
+                if now >= bucket.paused_until and bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    self.requests += 1
+                    self.wait_seconds += waited
+                    return True
+                delay = max(bucket.paused_until - now, (1 - bucket.tokens) / bucket.rate)
+            if cancel_event is None:
+                time.sleep(delay)
+            elif cancel_event.wait(delay):
+                return False
+            waited += delay
+
+    def record_success(self, host):
+        """Additive increase: about one extra request per second for every `rate` successes."""
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.rate = min(self.max_rate, bucket.rate + 1.0 / bucket.rate)
+
+    def record_throttle(self, host, status, retry_after=None):
+        """Multiplicative decrease, and a pause of the host's bucket when the server asks for one."""
+        with self._lock:
+            self.throttled += 1
+            bucket = self._bucket(host)
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            bucket.tokens = min(bucket.tokens, 0.0)
+            if retry_after:
+                bucket.paused_until = max(bucket.paused_until, time.monotonic() + retry_after)
+            rate = bucket.rate
+        if self.on_rate_change:
+            self.on_rate_change(host, rate, f"HTTP {status}")
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Returns the delay before retry number `attempt` (0-based): exponential with full
+        jitter, but never shorter than the server's Retry-After.
+        """
+        with self._lock:
+            self.retries += 1
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+        return max(delay, retry_after or 0.0)
+
+    def stats(self):
+        """
+        Returns:
+            dict: requests, throttled, retries, wait_seconds and the per-host rates.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "rates": {host: round(bucket.rate, 2) for host, bucket in self._buckets.items()},
+            }
@@ -0,0 +1,203 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from cancel import abort_connection, cancellable_sleep, current_cancel_event, is_cancelled, on_cancel, remove_on_cancel
+from ratelimit import RETRY_STATUSES, parse_retry_after
+
+# (connect, read) timeouts in seconds for every listing request and media transfer, so
+# a stalled connection fails instead of hanging its worker.
+TIMEOUT = (10, 60)
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 8
+# How many per-host pools are kept alive (Instagram spreads media over many CDN hosts).
+DEFAULT_MAX_HOSTS = 32
+
+
+class RequestCancelled(requests.RequestException):
+    """Raised when the current cancel event is set before or while a request is sent."""
+
+
+class PoolStats:
+    """Thread-safe connection pool counters shared by every host pool of a session."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.new_connections = 0
+        self.wait_seconds = 0.0
+
+    def record_checkout(self, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += waited
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: checkouts, new_connections, reused_connections and wait_seconds.
+        """
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.checkouts - self.new_connections),
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+
+def _release_cancel_handle(conn):
+    remove_on_cancel(getattr(conn, "_cancel_handle", None))
+    conn._cancel_handle = None
+
+
+def _instrumented(pool_cls, stats):
+    class CancellableConnection(pool_cls.ConnectionCls):
+        def close(self):
+            # urllib3 closes a connection it discards after an error and then puts
+            # None back into the pool, so the cancel handle is released here as well.
+            _release_cancel_handle(self)
+            super().close()
+
+    class InstrumentedPool(pool_cls):
+        ConnectionCls = CancellableConnection
+
+        def _get_conn(self, timeout=None):
+            started = time.monotonic()
+            conn = super()._get_conn(timeout=timeout)
+            if is_cancelled():
+                # Cancelled while waiting for a free connection.
+                super()._put_conn(conn)
+                raise RequestCancelled("Cancelled while waiting for a connection")
+            stats.record_checkout(time.monotonic() - started)
+            # While the connection is checked out (until a streamed body is read or
+            # closed), cancelling the thread's cancel event shuts its socket down.
+            conn._cancel_handle = on_cancel(lambda: abort_connection(conn))
+            return conn
+
+        def _put_conn(self, conn):
+            if conn is not None:
+                _release_cancel_handle(conn)
+            super()._put_conn(conn)
+
+        def _new_conn(self):
+            stats.record_new_connection()
+            return super()._new_conn()
+
+    InstrumentedPool.__name__ = f"Instrumented{pool_cls.__name__}"
+    return InstrumentedPool
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connection pools report into a PoolStats.
+
+    With a rate limiter, every request first takes a token from it, and throttled
+    (429/5xx) or failed requests are retried with jittered exponential backoff.
+
+    Requests honour the calling thread's cancel event (see cancel.cancel_scope): once
+    it is set, no request is sent, waits for a token or a retry end at once, and a
+    request in flight fails with RequestCancelled as soon as its socket is shut down.
+    """
+
+    def __init__(self, stats, max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST, max_hosts=DEFAULT_MAX_HOSTS,
+                 rate_limiter=None, metrics=None):
+        self.stats = stats
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        super().__init__(pool_connections=max_hosts, pool_maxsize=max_connections_per_host, pool_block=True)
+
+    def _send_once(self, host, request, **kwargs):
+        started = time.monotonic()
+        cancel_event = current_cancel_event()
+        if cancel_event is not None and cancel_event.is_set():
+            raise RequestCancelled(f"Cancelled before requesting {request.url}")
+        try:
+            response = super().send(request, **kwargs)
+        except requests.RequestException as e:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled(f"Cancelled while requesting {request.url}") from e
+            if self.metrics is not None:
+                self.metrics.inc("insta_http_requests_total", host=host, status=type(e).__name__)
+            raise
+        if self.metrics is not None:
+            self.metrics.inc("insta_http_requests_total", host=host, status=response.status_code)
+            self.metrics.observe("insta_http_request_duration_seconds", time.monotonic() - started, host=host)
+        return response
+
+    def _record_retry(self, host, cause):
+        if self.metrics is not None:
+            self.metrics.inc("insta_http_retries_total", host=host, cause=cause)
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).netloc
+        limiter = self.rate_limiter
+        if limiter is None:
+            return self._send_once(host, request, **kwargs)
+
+        cancel_event = current_cancel_event()
+        attempt = 0
+        while True:
+            if not limiter.acquire(host, cancel_event):
+                raise RequestCancelled(f"Cancelled while waiting to request {request.url}")
+            try:
+                response = self._send_once(host, request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= limiter.max_retries:
+                    raise
+                self._record_retry(host, type(e).__name__)
+                if cancellable_sleep(limiter.backoff(attempt), cancel_event):
+                    raise RequestCancelled(f"Cancelled while retrying {request.url}") from e
+                attempt += 1
+                continue
+
+            if response.status_code not in RETRY_STATUSES:
+                limiter.record_success(host)
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            limiter.record_throttle(host, response.status_code, retry_after)
+            if attempt >= limiter.max_retries:
+                return response
+            self._record_retry(host, f"HTTP {response.status_code}")
+            response.close()
+            if cancellable_sleep(limiter.backoff(attempt, retry_after), cancel_event):
+                raise RequestCancelled(f"Cancelled while retrying {request.url}")
+            attempt += 1
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _instrumented(HTTPConnectionPool, self.stats),
+            "https": _instrumented(HTTPSConnectionPool, self.stats),
+        }
+
+
+class DownloadSession(requests.Session):
+    """
+    A keep-alive HTTP session shared by every story, post and media request of a batch.
+
+    Connections are pooled per host and capped at max_connections_per_host; once the
+    cap is reached, further requests to that host wait for a free connection instead
+    of opening a new one. An optional RateLimiter paces and retries every request,
+    and an optional MetricsRegistry records request counts, durations and retries.
+    """
+
+    def __init__(self, max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST, rate_limiter=None, metrics=None):
+        super().__init__()
+        self.pool_stats = PoolStats()
+        self.rate_limiter = rate_limiter
+        adapter = PooledAdapter(self.pool_stats, max_connections_per_host, rate_limiter=rate_limiter, metrics=metrics)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def stats(self):
+        """Returns a snapshot of the connection pool counters."""
+        return self.pool_stats.snapshot()
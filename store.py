@@ -0,0 +1,194 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_FILENAME = "state.sqlite3"
+LEGACY_CONFIG_FILENAME = "config.json"
+# Usernames fetched per query by iter_usernames.
+USERNAME_PAGE_SIZE = 1000
+
+
+class StateStore:
+    """
+    Persistent settings, saved usernames and per-account state of the application.
+
+    Replaces the config.json blob that was rewritten as a whole on every save.
+    Every setting, username and account row is upserted on its own in a short
+    transaction, and the database runs in WAL mode, so the GUI, the CLI and a
+    running batch can all write to it at the same time without losing updates.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The SQLite database file. Created if it does not exist.
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS settings (
+                       key TEXT PRIMARY KEY,
+                       value TEXT NOT NULL
+                   )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS accounts (
+                       username TEXT PRIMARY KEY,
+                       saved INTEGER NOT NULL DEFAULT 1,
+                       added_at REAL NOT NULL,
+                       settings TEXT NOT NULL DEFAULT '{}',
+                       last_sync_at REAL,
+                       last_status TEXT,
+                       last_files INTEGER,
+                       last_bytes INTEGER,
+                       last_failed INTEGER
+                   )"""
+            )
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        """Upserts several settings in one transaction."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value)) for key, value in values.items()],
+            )
+
+    def settings(self):
+        """Returns every setting as a dict."""
+        with self._lock:
+            return {key: json.loads(value) for key, value in self._conn.execute("SELECT key, value FROM settings")}
+
+    def iter_usernames(self, page_size=USERNAME_PAGE_SIZE):
+        """
+        Yields the saved usernames in alphabetical order, page_size rows per query.
+
+        Pages are read by keyset (username > last seen), so no cursor stays open
+        between pages and a caller can consume them lazily, e.g. one page per Tk
+        idle callback.
+        """
+        last = ""
+        while True:
+            with self._lock:
+                page = [row[0] for row in self._conn.execute(
+                    "SELECT username FROM accounts WHERE saved = 1 AND username > ? ORDER BY username LIMIT ?",
+                    (last, page_size),
+                )]
+            if not page:
+                return
+            yield from page
+            last = page[-1]
+
+    def add_usernames(self, usernames):
+        """Saves usernames in one transaction. Returns how many were not saved before."""
+        now = time.time()
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT INTO accounts (username, saved, added_at) VALUES (?, 1, ?) "
+                "ON CONFLICT(username) DO UPDATE SET saved = 1, added_at = excluded.added_at WHERE saved = 0",
+                [(username, now) for username in usernames],
+            )
+            return self._conn.total_changes - before
+
+    def remove_usernames(self, usernames):
+        """
+        Removes usernames from the saved list in one transaction. Their settings and
+        sync history are kept. Returns how many were removed.
+        """
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany("UPDATE accounts SET saved = 0 WHERE username = ? AND saved = 1",
+                                   [(username,) for username in usernames])
+            return self._conn.total_changes - before
+
+    def account(self, username):
+        """Returns the stored state of one account as a dict, or None if it is unknown."""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM accounts WHERE username = ?", (username,))
+            row = cursor.fetchone()
+            columns = [description[0] for description in cursor.description]
+        if row is None:
+            return None
+        account = dict(zip(columns, row))
+        account["saved"] = bool(account["saved"])
+        account["settings"] = json.loads(account["settings"])
+        return account
+
+    def update_account_settings(self, username, **settings):
+        """Merges settings into an account's per-account settings (the account does not have to be saved)."""
+        with self._lock, self._conn:
+            self._ensure_account(username)
+            row = self._conn.execute("SELECT settings FROM accounts WHERE username = ?", (username,)).fetchone()
+            merged = {**json.loads(row[0]), **settings}
+            self._conn.execute("UPDATE accounts SET settings = ? WHERE username = ?", (json.dumps(merged), username))
+
+    def record_sync(self, username, status, files=0, nbytes=0, failed=0):
+        """
+        Records the outcome of the last download of an account.
+
+        Args:
+            username (str): The Instagram username.
+            status (str): "done", "failed" or "cancelled".
+            files (int): Media files downloaded.
+            nbytes (int): Media bytes downloaded.
+            failed (int): Media files that failed.
+        """
+        with self._lock, self._conn:
+            self._ensure_account(username)
+            self._conn.execute(
+                "UPDATE accounts SET last_sync_at = ?, last_status = ?, last_files = ?, last_bytes = ?, last_failed = ? "
+                "WHERE username = ?",
+                (time.time(), status, files, nbytes, failed, username),
+            )
+
+    def _ensure_account(self, username):
+        self._conn.execute("INSERT OR IGNORE INTO accounts (username, saved, added_at) VALUES (?, 0, ?)",
+                           (username, time.time()))
+
+    def migrate_json(self, config_path):
+        """
+        Imports a legacy config.json once: its usernames become saved accounts and
+        every other key a setting, in a single transaction. The file is then renamed
+        to "<config_path>.migrated" so the import is not repeated.
+
+        Returns:
+            bool: True if a config file was migrated.
+        """
+        if not os.path.exists(config_path):
+            return False
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+        usernames = list(dict.fromkeys(config.pop("usernames", [])))
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value)) for key, value in config.items()],
+            )
+            self._conn.executemany(
+                "INSERT INTO accounts (username, saved, added_at) VALUES (?, 1, ?) "
+                "ON CONFLICT(username) DO UPDATE SET saved = 1",
+                [(username, now) for username in usernames],
+            )
+        os.replace(config_path, f"{config_path}.migrated")
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import listing  # noqa: E402
+from benchmarks.fake_instagram import FakeInstagram  # noqa: E402
+
+
+@pytest.fixture
+def fake_instagram(monkeypatch):
+    """Starts a FakeInstagram for the given accounts and points the listing requests at it."""
+    servers = []
+
+    def start(accounts, **kwargs):
+        fake = FakeInstagram(accounts, **kwargs).start()
+        servers.append(fake)
+        monkeypatch.setattr(listing, "INSTAGRAM_URL", fake.api_url)
+        return fake
+
+    yield start
+    for fake in servers:
+        fake.stop()
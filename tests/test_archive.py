@@ -0,0 +1,143 @@
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import archive
+from archive import ArchiveSet, ArchiveWriter, close_archive, index_path, load_index, open_archive, read_member
+from benchmarks.fake_instagram import Account, media_body
+from session import DownloadSession
+from transfer import IncompleteTransfer
+
+
+def failing_chunks(data, after):
+    yield data[:after]
+    raise ConnectionError("connection lost")
+
+
+def tar_names(path):
+    with tarfile.open(path, 'r:') as tar:
+        return [info.name for info in tar]
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "zip"])
+def test_partial_member_is_rolled_back(tmp_path, archive_format):
+    path = str(tmp_path / f"alice.{archive_format}")
+    writer = ArchiveWriter(path, archive_format)
+    writer.add("posts/1.jpg", 5000, [b"a" * 5000])
+
+    with pytest.raises(ConnectionError):
+        writer.add("posts/2.jpg", 5000, failing_chunks(b"b" * 5000, 2000))
+    with pytest.raises(IncompleteTransfer):
+        writer.add("posts/3.jpg", 5000, [b"c" * 4000])
+    writer.add("posts/4.jpg", None, [b"d" * 3000])
+    writer.close()
+
+    assert [entry[0] for entry in load_index(path)] == ["posts/1.jpg", "posts/4.jpg"]
+    assert read_member(path, "posts/4.jpg") == b"d" * 3000
+    if archive_format == "tar":
+        assert tar_names(path) == ["posts/1.jpg", "posts/4.jpg"]
+    else:
+        with zipfile.ZipFile(path) as zip_file:
+            assert zip_file.namelist() == ["posts/1.jpg", "posts/4.jpg"]
+            assert zip_file.testzip() is None
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "zip"])
+def test_closed_archive_is_appended_to(tmp_path, archive_format):
+    path = str(tmp_path / f"alice.{archive_format}")
+    writer = ArchiveWriter(path, archive_format)
+    writer.add("posts/1.jpg", 100, [b"1" * 100])
+    writer.close()
+
+    writer = ArchiveWriter(path, archive_format)
+    assert writer.members == 1
+    writer.add("posts/2.jpg", 200, [b"2" * 200])
+    writer.close()
+
+    assert read_member(path, "posts/1.jpg") == b"1" * 100
+    assert read_member(path, "posts/2.jpg") == b"2" * 200
+    if archive_format == "tar":
+        assert tar_names(path) == ["posts/1.jpg", "posts/2.jpg"]
+    else:
+        with zipfile.ZipFile(path) as zip_file:
+            assert zip_file.read("posts/2.jpg") == b"2" * 200
+
+
+def crash(writer, garbage):
+    """Leaves the writer's files as a killed process would, with a torn member at the end."""
+    writer._file.write(garbage)
+    writer._file.flush()
+    writer._index.write("posts/torn.jpg\t123")
+    writer._index.flush()
+
+
+def test_tar_is_repaired_after_a_crash(tmp_path):
+    path = str(tmp_path / "alice.tar")
+    writer = ArchiveWriter(path, "tar")
+    writer.add("posts/1.jpg", 1000, [b"1" * 1000])
+    writer.add("posts/2.jpg", 1000, [b"2" * 1000])
+    crash(writer, b"half a member")
+
+    writer = ArchiveWriter(path, "tar")
+    assert writer.members == 2
+    writer.add("posts/3.jpg", 1000, [b"3" * 1000])
+    writer.close()
+
+    assert tar_names(path) == ["posts/1.jpg", "posts/2.jpg", "posts/3.jpg"]
+    assert read_member(path, "posts/3.jpg") == b"3" * 1000
+
+
+def test_lost_tar_index_is_rebuilt(tmp_path):
+    path = str(tmp_path / "alice.tar")
+    writer = ArchiveWriter(path, "tar")
+    writer.add("posts/1.jpg", 1000, [b"1" * 1000])
+    writer.add("posts/2.jpg", 3000, [b"2" * 3000])
+    expected = [entry[:3] for entry in load_index(path)]
+    writer._file.flush()
+    # The last member is cut off half-way, and the index is gone.
+    os.truncate(path, expected[1][1] + 1000)
+    os.remove(index_path(path))
+
+    writer = ArchiveWriter(path, "tar")
+    assert [entry[:3] for entry in load_index(path)] == expected[:1]
+    writer.add("posts/3.jpg", 500, [b"3" * 500])
+    writer.close()
+
+    assert tar_names(path) == ["posts/1.jpg", "posts/3.jpg"]
+    assert read_member(path, "posts/1.jpg") == b"1" * 1000
+
+
+def test_crashed_zip_continues_in_a_new_part(tmp_path):
+    writer = open_archive(str(tmp_path), "alice", "2024-01-01", "zip")
+    writer.add("posts/1.jpg", 100, [b"1" * 100])
+    writer._file.flush()  # No central directory: the process died.
+    first = writer.path
+
+    archive._open_writers.clear()  # A new process.
+    writer = open_archive(str(tmp_path), "alice", "2024-01-01", "zip")
+    writer.add("posts/2.jpg", 100, [b"2" * 100])
+    close_archive(writer)
+
+    assert writer.path == str(tmp_path / "alice-2024-01-01.1.zip")
+    assert read_member(first, "posts/1.jpg") == b"1" * 100
+    with zipfile.ZipFile(writer.path) as zip_file:
+        assert zip_file.namelist() == ["posts/2.jpg"]
+
+
+def test_media_is_streamed_into_the_archive(fake_instagram, tmp_path):
+    fake = fake_instagram([Account("alice", media_size=300 * 1024)])
+    archives = ArchiveSet(str(tmp_path), "alice", "tar")
+    entry = {"id": "1000000001", "ext": ".jpg", "url": f"{fake.cdn_url}/media/alice/1000000001.jpg",
+             "taken_at": 1700000000}
+    counted = []
+
+    size, location = archives.fetch(DownloadSession(), "post", entry, on_bytes=counted.append)
+    archives.close()
+
+    path, name = location.split("#")
+    body = media_body("1000000001", 300 * 1024, False)
+    assert size == sum(counted) == len(body)
+    assert read_member(path, name) == body
+    assert not [name for name in os.listdir(tmp_path / "alice") if not name.startswith("alice-")]
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+import bandwidth
+from bandwidth import BACKFILL, STORY, BandwidthGovernor
+
+# Powers of two, so the refilled tokens add up exactly.
+CHUNK = 128
+RATE = 1024
+
+
+class ManualClock:
+    """A monotonic clock that only moves when the test advances it."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    # Waiting transfers notice the manual clock moving within a few milliseconds.
+    monkeypatch.setattr(bandwidth, "WAIT_POLL_INTERVAL", 0.005)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def start_transfer(governor, priority, granted, stop_event):
+    def run():
+        while not stop_event.is_set():
+            governor.consume(CHUNK, priority, stop_event)
+            if not stop_event.is_set():
+                granted.append(priority)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def waiting(governor, priority):
+    with governor._changed:
+        return bool(governor._waiting[priority])
+
+
+def test_waiting_classes_share_by_weight():
+    clock = ManualClock()
+    governor = BandwidthGovernor(rate=RATE, clock=clock)
+    granted = []
+    stop_event = threading.Event()
+    threads = [start_transfer(governor, priority, granted, stop_event) for priority in (STORY, BACKFILL)]
+
+    # Each step refills exactly one chunk, which goes to the class whose turn it is.
+    for step in range(18):
+        wait_for(lambda: len(granted) == step and waiting(governor, STORY) and waiting(governor, BACKFILL))
+        clock.advance(CHUNK / RATE)
+        wait_for(lambda: len(granted) == step + 1)
+    stop_event.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert granted.count(STORY) == 16 and granted.count(BACKFILL) == 2
+    # The backfill class is not starved: it gets its turn in every round of 9 chunks.
+    assert BACKFILL in granted[:9] and BACKFILL in granted[9:]
+    assert governor.stats()["bytes"][STORY] >= 16 * CHUNK
+
+
+def test_limit_is_changed_while_a_transfer_waits():
+    clock = ManualClock()
+    governor = BandwidthGovernor(rate=100, clock=clock)
+    clock.advance(1)
+    governor.consume(1000, STORY)  # Overdraws the bucket by 975 bytes: 9.75 s at 100 B/s.
+    granted = []
+    stop_event = threading.Event()
+    thread = start_transfer(governor, STORY, granted, stop_event)
+
+    wait_for(lambda: waiting(governor, STORY))
+    clock.advance(1)
+    time.sleep(0.05)
+    assert not granted
+
+    # At the new limit, the remaining debt takes less than 10 ms.
+    governor.set_rate(100 * 1000)
+    clock.advance(0.01)
+    wait_for(lambda: granted)
+
+    # Turning the limit off releases a waiting transfer at once.
+    wait_for(lambda: waiting(governor, STORY))
+    governor.set_rate(None)
+    wait_for(lambda: len(granted) > 10)
+    stop_event.set()
+    thread.join(5)
+    assert governor.rate is None
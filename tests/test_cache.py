@@ -0,0 +1,85 @@
+from benchmarks.fake_instagram import Account
+from cache import FEED, PROFILE, ResponseCache
+from listing import fetch_profile, fetch_story_reel
+from session import DownloadSession
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_response_is_fresh_until_its_ttl(tmp_path):
+    clock = Clock()
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), ttls={FEED: 60}, clock=clock)
+
+    assert cache.lookup(FEED, "1:") is None
+    cache.store(FEED, "1:", {"items": [1]})
+    clock.now += 59
+    assert cache.lookup(FEED, "1:").fresh
+    clock.now += 1
+    cached = cache.lookup(FEED, "1:")
+    assert not cached.fresh and cached.value == {"items": [1]}
+    assert cache.stats()["totals"] == {"hit": 1, "miss": 1, "stale": 1, "revalidated": 0}
+
+
+def test_stale_listing_is_revalidated_with_its_etag(fake_instagram, tmp_path):
+    fake = fake_instagram([Account("alice")], etags=True)
+    clock = Clock()
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), clock=clock)
+    session = DownloadSession()
+    cookies = {"ds_user_id": "1"}
+
+    profile = fetch_profile(session, "alice", cookies, cache)
+    assert fetch_profile(session, "alice", cookies, cache) == profile
+    assert fake.counts["api"] == 1
+
+    clock.now += cache.ttls[PROFILE]
+    assert fetch_profile(session, "alice", cookies, cache) == profile
+    assert fake.counts["api"] == 2
+    assert fake.counts["not_modified"] == 1
+    assert cache.stats()["totals"]["revalidated"] == 1
+    # The 304 renewed the cached copy for another TTL.
+    fetch_profile(session, "alice", cookies, cache)
+    assert fake.counts["api"] == 2
+
+
+def test_cached_listings_are_kept_per_account(fake_instagram, tmp_path):
+    fake = fake_instagram([Account("alice", stories=2)])
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), clock=Clock())
+    session = DownloadSession()
+    first = {"ds_user_id": "1", "sessionid": "first"}
+    other = {"ds_user_id": "2", "sessionid": "other"}
+
+    for cookies in (first, other):
+        fetch_profile(session, "alice", cookies, cache)
+        fetch_story_reel(session, "alice", cookies, cache)
+    assert fake.counts["api"] == 4
+
+    # A new session of the same account shares its cached listings.
+    renewed = {"ds_user_id": "1", "sessionid": "renewed"}
+    fetch_profile(session, "alice", renewed, cache)
+    fetch_story_reel(session, "alice", renewed, cache)
+    assert fake.counts["api"] == 4
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    clock = Clock()
+    body = {"items": ["x" * 100]}
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes=250, clock=clock)
+
+    for key in ("a", "b"):
+        cache.store(FEED, key, body)
+        clock.now += 1
+    cache.lookup(FEED, "a")
+    clock.now += 1
+    cache.store(FEED, "c", body)
+
+    assert cache.lookup(FEED, "b") is None
+    assert cache.lookup(FEED, "a") is not None
+    assert cache.lookup(FEED, "c") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= 250
@@ -0,0 +1,28 @@
+from benchmarks.fake_instagram import Account
+from cancel import CancelToken
+from downloader import CANCELLED, download_media
+from fetcher import MediaFetcher
+
+
+def test_cancelled_phase_is_not_reported_as_done(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=0, stories=6, media_size=1024)], media_latency=0.05)
+    cancel_event = CancelToken()
+    logs = []
+
+    def progress(value):
+        # Cancel as soon as the first story is stored; the others have not started.
+        if value > 0:
+            cancel_event.set()
+
+    fetcher = MediaFetcher(per_account_limit=1)
+    try:
+        statuses = download_media("alice", {"csrftoken": "test"}, str(tmp_path), logs.append, progress,
+                                  cancel_event, fetcher=fetcher)
+    finally:
+        fetcher.close()
+
+    assert statuses == {"stories": CANCELLED}
+    assert logs[-1] == "Download cancelled for @alice."
+    # Stories that were never started were not skipped by the filters.
+    assert not [line for line in logs if line.startswith(("Skipped", "Successfully"))]
+    assert len(list((tmp_path / "alice" / "stories").glob("*.jpg"))) < 6
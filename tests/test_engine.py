@@ -0,0 +1,67 @@
+import os
+
+from benchmarks.fake_instagram import Account
+from cancel import CancelToken
+from engine import DownloadEngine
+from ratelimit import DEFAULT_MAX_RATE, RateLimiter
+
+COOKIES = {"csrftoken": "test"}
+
+
+def run_engine(download_path, usernames, max_workers=4, **options):
+    logs = []
+    # Start at the limiter's top rate; the fake server does not throttle unless asked to.
+    engine = DownloadEngine(max_workers=max_workers, rate_limiter=RateLimiter(rate=DEFAULT_MAX_RATE))
+    results = engine.run(usernames, COOKIES, str(download_path), logs.append, lambda value: None, CancelToken(),
+                         **options)
+    return results, logs
+
+
+def listdir(path):
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def test_concurrent_jobs_write_to_their_own_folders(fake_instagram, tmp_path):
+    accounts = [Account(f"user{i}", posts=15, stories=3, media_size=2048, carousel_every=4, video_every=5)
+                for i in range(6)]
+    fake_instagram(accounts)
+
+    results, _ = run_engine(tmp_path, [account.username for account in accounts], max_workers=4)
+
+    assert results == {account.username: "done" for account in accounts}
+    for account in accounts:
+        user_dir = tmp_path / account.username
+        stories = listdir(user_dir / "stories")
+        posts = listdir(user_dir / "posts")
+        assert (user_dir / "profile.jpg").is_file()
+        assert all(name.startswith(f"9{account.user_id}") for name in stories)
+        assert all(name.startswith(account.user_id) for name in posts)
+        # One sidecar per story and post, one file per media item.
+        assert len([name for name in stories if name.endswith(".json")]) == account.stories
+        assert len([name for name in stories if not name.endswith(".json")]) == account.stories
+        assert len([name for name in posts if name.endswith(".json")]) == 15
+        # 15 posts, every 4th a 3-item carousel (indexes 0, 4, 8, 12).
+        assert len([name for name in posts if not name.endswith(".json")]) == 15 + 4 * 2
+        assert not [name for name in stories + posts if name.endswith((".part", ".tmp"))]
+
+
+def test_user_whose_listings_fail_is_reported_failed(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=3, stories=1, media_size=1024)])
+
+    results, logs = run_engine(tmp_path, ["alice", "ghost"], resume=False)
+
+    assert results == {"alice": "done", "ghost": "failed"}
+    assert any("Could not download posts for @ghost" in message for message in logs)
+
+
+def test_finished_batch_with_a_failed_user_is_not_resumed(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=3, stories=1, media_size=1024),
+                           Account("bob", posts=3, stories=1, media_size=1024)])
+
+    first, _ = run_engine(tmp_path, ["alice", "bob", "ghost"], resume=True)
+    second, logs = run_engine(tmp_path, ["alice", "bob", "ghost"], resume=True)
+
+    assert first == second == {"alice": "done", "bob": "done", "ghost": "failed"}
+    # The first batch ran to the end, so the second one starts over instead of
+    # resuming it to retry ghost alone.
+    assert not any("Resuming" in message for message in logs)
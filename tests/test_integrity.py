@@ -0,0 +1,102 @@
+import os
+import struct
+
+from benchmarks.fake_instagram import media_body
+from integrity import CORRUPT_SUFFIX, IntegrityChecker, verify_file
+from manifest import Manifest
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def test_truncated_and_corrupt_media_is_detected(tmp_path):
+    jpeg = media_body("1", 4096, False)
+    video = media_body("2", 4096, True)
+    files = {
+        "ok.jpg": jpeg,
+        "truncated.jpg": jpeg[:2000],
+        "ok.mp4": video,
+        "truncated.mp4": video[:3000],
+        "corrupt.mp4": media_body("3", 4096, True, corrupt=True),
+        "html.jpg": b"<html>Rate limited</html>",
+        "empty.jpg": b"",
+    }
+    errors = {name: verify_file(write(tmp_path / name, data))["error"] for name, data in files.items()}
+
+    assert errors["ok.jpg"] is None and errors["ok.mp4"] is None
+    assert "truncated" in errors["truncated.jpg"]
+    assert "truncated" in errors["truncated.mp4"]
+    assert "truncated" in errors["corrupt.mp4"]
+    assert errors["html.jpg"] == "not a JPEG file"
+    assert errors["empty.jpg"] == "empty file"
+
+
+def test_format_is_detected_from_the_content(tmp_path):
+    webp = b"RIFF" + struct.pack("<I", 12) + b"WEBP" + b"VP8 " + b"\0" * 4
+    heic = box(b"ftyp", b"heic\0\0\0\0mif1") + box(b"meta", b"\0" * 8) + box(b"mdat", b"x")
+
+    assert verify_file(write(tmp_path / "webp.jpg", webp))["error"] is None
+    assert verify_file(write(tmp_path / "heic.jpg", heic))["error"] is None
+    assert "truncated" in verify_file(write(tmp_path / "short.jpg", heic[:-3]))["error"]
+    assert "truncated" in verify_file(write(tmp_path / "short_webp.jpg", webp[:-2]))["error"]
+
+
+def test_corrupt_file_is_quarantined_and_forgotten(tmp_path):
+    path = write(tmp_path / "alice" / "posts" / "1.jpg", media_body("1", 4096, False)[:1000])
+    manifest = Manifest.for_download_path(str(tmp_path))
+    manifest.record("alice", "1", "post", path, 1000)
+    checker = IntegrityChecker(str(tmp_path), processes=1, manifest=manifest)
+
+    summary = checker.check()
+
+    assert (summary["checked"], summary["corrupt"]) == (1, 1)
+    assert not os.path.exists(path) and os.path.exists(path + CORRUPT_SUFFIX)
+    assert not manifest.known_ids("alice", "post")
+    checker.close()
+    manifest.close()
+
+
+def test_duplicates_are_hardlinked_and_orphans_pruned(tmp_path):
+    body = media_body("1", 8192, False)
+    first = write(tmp_path / "alice" / "posts" / "1.jpg", body)
+    second = write(tmp_path / "bob" / "posts" / "2.jpg", body)
+    other = write(tmp_path / "bob" / "posts" / "3.jpg", media_body("3", 8192, False))
+    checker = IntegrityChecker(str(tmp_path), processes=1)
+
+    summary = checker.check()
+
+    assert (summary["checked"], summary["ok"], summary["duplicates"]) == (3, 3, 1)
+    assert summary["bytes_saved"] == len(body)
+    assert os.path.samefile(first, second)
+    assert os.stat(first).st_nlink == 3  # Both copies and the stored object.
+    assert open(second, "rb").read() == body
+    # Unchanged files are not checked again.
+    assert checker.check()["checked"] == 0
+
+    os.remove(first)
+    assert checker.prune_objects() == 0
+    os.remove(second)
+    os.remove(other)
+    assert checker.prune_objects() == 2
+    assert not [name for _, _, names in os.walk(checker.objects_path) for name in names]
+    checker.close()
+
+
+def test_dedup_can_be_turned_off(tmp_path):
+    body = media_body("1", 8192, False)
+    first = write(tmp_path / "a.jpg", body)
+    second = write(tmp_path / "b.jpg", body)
+    checker = IntegrityChecker(str(tmp_path), processes=1, dedup=False)
+
+    assert checker.check()["duplicates"] == 0
+    assert not os.path.samefile(first, second)
+    assert not os.path.exists(checker.objects_path)
+    checker.close()
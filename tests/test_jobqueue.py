@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+import time
+
+from benchmarks.fake_instagram import Account
+from cancel import CancelToken
+from jobqueue import JobQueue, QueueWorker
+
+
+def test_job_whose_listings_fail_is_retried_and_then_failed(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=3, stories=1, media_size=1024)])
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    batch = queue.enqueue(["alice", "ghost"], max_attempts=2)
+    logs = []
+
+    worker = QueueWorker(queue, {"csrftoken": "test"}, str(tmp_path / "media"), logs.append, CancelToken(),
+                         max_workers=2)
+    worker.run()
+
+    summary = queue.summary(batch)
+    queue.close()
+    assert summary["jobs"] == {"done": 1, "failed": 1}
+    assert sum("@ghost (batch" in message for message in logs) == 2
+
+
+def test_expired_lease_is_handed_to_another_worker(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    batch = queue.enqueue(["alice"], max_attempts=2)
+
+    first = queue.claim("worker-a", lease=0.05)
+    assert queue.claim("worker-b", lease=0.05) is None
+    time.sleep(0.1)
+    second = queue.claim("worker-b", lease=60)
+
+    assert (second.id, second.attempts) == (first.id, 2)
+    # worker-a lost the job: its heartbeats and its result are refused.
+    assert not queue.heartbeat(first.id, "worker-a")
+    assert not queue.complete(first.id, "worker-a", "done")
+    assert queue.heartbeat(second.id, "worker-b")
+    assert queue.complete(second.id, "worker-b", "done")
+    assert queue.summary(batch)["jobs"] == {"done": 1}
+    queue.close()
+
+
+def test_lease_expiring_after_the_last_attempt_fails_the_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    batch = queue.enqueue(["alice"], max_attempts=1)
+
+    queue.claim("worker-a", lease=0.05)
+    time.sleep(0.1)
+
+    assert queue.claim("worker-b") is None
+    assert queue.summary(batch)["jobs"] == {"failed": 1}
+    queue.close()
+
+
+def test_heartbeat_survives_a_locked_database(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    queue.enqueue(["alice"])
+    job = queue.claim("worker-a", lease=0.4)
+    logs = []
+    worker = QueueWorker(queue, {}, str(tmp_path / "media"), logs.append, CancelToken(), worker_id="worker-a",
+                         lease=0.4)
+    worker._running[job.id] = job
+    calls = []
+    heartbeat = queue.heartbeat
+
+    def flaky_heartbeat(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return heartbeat(*args)
+    monkeypatch.setattr(queue, "heartbeat", flaky_heartbeat)
+
+    done = threading.Event()
+    thread = threading.Thread(target=worker._heartbeat_loop, args=(done,), daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    done.set()
+    thread.join()
+
+    assert len(calls) >= 2
+    assert any("Could not renew the lease on @alice" in message for message in logs)
+    assert not job.cancel_event.is_set()
+    queue.close()
+
+
+def test_enqueued_filters_are_applied_by_the_worker(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=6, media_size=1024, video_every=3)])
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    queue.enqueue(["alice"], download_stories=False, filters={"media_types": "image"})
+
+    QueueWorker(queue, {"csrftoken": "test"}, str(tmp_path / "media"), lambda message: None, CancelToken()).run()
+    queue.close()
+
+    posts = os.listdir(tmp_path / "media" / "alice" / "posts")
+    assert len([name for name in posts if name.endswith(".jpg")]) == 4
+    assert not [name for name in posts if name.endswith(".mp4")]
@@ -0,0 +1,109 @@
+from journal import DONE, FAILED, PENDING, RUNNING, BatchJournal
+
+PHASES = ["stories", "posts"]
+
+
+def open_journal(tmp_path, **kwargs):
+    return BatchJournal(str(tmp_path / "journal.sqlite3"), **kwargs)
+
+
+def run_unit(batch, username, phase, state):
+    batch.mark(username, phase, RUNNING)
+    batch.mark(username, phase, state)
+
+
+def test_plan_sorts_users_by_what_is_left(tmp_path):
+    journal = open_journal(tmp_path, max_attempts=2)
+    batch = journal.begin(["alice", "bob", "carol", "dave"], PHASES)
+    for phase in PHASES:
+        run_unit(batch, "alice", phase, DONE)
+        run_unit(batch, "carol", phase, DONE)
+    run_unit(batch, "bob", "stories", DONE)
+    run_unit(batch, "bob", "posts", FAILED)
+    run_unit(batch, "carol", "posts", FAILED)
+    run_unit(batch, "carol", "posts", FAILED)
+
+    todo, finished, exhausted = batch.plan()
+
+    assert todo == ["bob", "dave"]
+    assert finished == ["alice"]
+    assert exhausted == ["carol"]
+    assert batch.should_run("bob", "posts") and not batch.should_run("bob", "stories")
+    assert not batch.should_run("carol", "posts")
+    journal.close()
+
+
+def test_interrupted_batch_is_resumed(tmp_path):
+    journal = open_journal(tmp_path)
+    batch = journal.begin(["alice", "bob"], PHASES)
+    run_unit(batch, "alice", "stories", DONE)
+    batch.mark("alice", "posts", RUNNING)  # The process died here.
+
+    resumed = journal.begin(["bob", "alice"], PHASES)
+
+    assert resumed.resumed and resumed.id == batch.id
+    assert resumed.plan() == (["alice", "bob"], [], [])
+    assert resumed.should_run("alice", "posts") and not resumed.should_run("alice", "stories")
+    journal.close()
+
+
+def test_cancelled_batch_is_resumed(tmp_path):
+    journal = open_journal(tmp_path)
+    batch = journal.begin(["alice", "bob"], PHASES)
+    for phase in PHASES:
+        run_unit(batch, "alice", phase, DONE)
+    run_unit(batch, "bob", "stories", PENDING)  # Cancelled units go back to pending.
+
+    assert journal.begin(["alice", "bob"], PHASES).resumed
+    journal.close()
+
+
+def test_batch_that_ran_to_the_end_is_not_resumed(tmp_path):
+    journal = open_journal(tmp_path)
+    batch = journal.begin(["alice", "ghost"], PHASES)
+    for phase in PHASES:
+        run_unit(batch, "alice", phase, DONE)
+        run_unit(batch, "ghost", phase, FAILED)
+    batch.finish()
+
+    again = journal.begin(["alice", "ghost"], PHASES)
+
+    assert not again.resumed and again.id != batch.id
+    assert again.plan() == (["alice", "ghost"], [], [])
+    journal.close()
+
+
+def test_unclosed_batch_with_only_failures_is_not_resumed(tmp_path):
+    journal = open_journal(tmp_path)
+    batch = journal.begin(["alice", "ghost"], PHASES)
+    for phase in PHASES:
+        run_unit(batch, "alice", phase, DONE)
+        run_unit(batch, "ghost", phase, FAILED)
+
+    assert not journal.begin(["alice", "ghost"], PHASES).resumed
+    journal.close()
+
+
+def test_old_interrupted_batch_is_not_resumed(tmp_path):
+    journal = open_journal(tmp_path, max_age=-1)
+    batch = journal.begin(["alice"], PHASES)
+    batch.mark("alice", "stories", RUNNING)
+
+    again = journal.begin(["alice"], PHASES)
+
+    assert not again.resumed
+    # The stale batch was closed, so it is not picked up later either.
+    journal.max_age = 3600
+    assert journal.begin(["alice"], PHASES).id == again.id
+    journal.close()
+
+
+def test_other_selection_starts_its_own_batch(tmp_path):
+    journal = open_journal(tmp_path)
+    batch = journal.begin(["alice"], PHASES)
+    batch.mark("alice", "stories", RUNNING)
+
+    assert not journal.begin(["alice"], ["posts"]).resumed
+    assert not journal.begin(["alice", "bob"], PHASES).resumed
+    assert journal.begin(["alice"], PHASES).resumed
+    journal.close()
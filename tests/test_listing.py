@@ -0,0 +1,24 @@
+import socket
+import time
+
+import pytest
+import requests
+
+import listing
+from session import DownloadSession
+
+
+def test_stalled_listing_request_times_out(monkeypatch):
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    monkeypatch.setattr(listing, "INSTAGRAM_URL", f"http://127.0.0.1:{server.getsockname()[1]}")
+    monkeypatch.setattr(listing, "TIMEOUT", (1, 0.5))
+
+    started = time.monotonic()
+    try:
+        with pytest.raises(requests.Timeout):
+            listing.fetch_profile(DownloadSession(), "alice", {})
+    finally:
+        server.close()
+    assert time.monotonic() - started < 5
@@ -0,0 +1,54 @@
+import time
+
+from benchmarks.fake_instagram import Account
+from listing import fetch_profile
+from ratelimit import RateLimiter, parse_retry_after
+from session import DownloadSession
+
+
+def test_rate_grows_additively_and_halves_on_throttling():
+    limiter = RateLimiter(rate=4.0, min_rate=0.5, max_rate=5.0)
+
+    limiter.record_success("api")
+    assert limiter.rates()["api"] == 4.25  # One extra request per second every `rate` successes.
+    for _ in range(10):
+        limiter.record_success("api")
+    assert limiter.rates()["api"] == 5.0
+
+    limiter.record_throttle("api", 429)
+    assert limiter.rates()["api"] == 2.5
+    for _ in range(5):
+        limiter.record_throttle("api", 429)
+    assert limiter.rates()["api"] == 0.5
+    assert limiter.stats()["throttled"] == 6
+    # Hosts are limited separately.
+    assert "cdn" not in limiter.rates()
+
+
+def test_retry_after_is_parsed_and_never_shortened():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    http_date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 30))
+    assert 25 < parse_retry_after(http_date) <= 30
+
+    limiter = RateLimiter(backoff_base=0.01, backoff_cap=0.02)
+    assert limiter.backoff(0, retry_after=2.0) == 2.0
+    assert limiter.backoff(5) <= 0.02
+
+
+def test_throttled_request_waits_for_retry_after(fake_instagram):
+    fake_instagram([Account("alice")], api_rate_limit=1, retry_after=1)
+    limiter = RateLimiter(rate=50, backoff_base=0.01)
+    session = DownloadSession(rate_limiter=limiter)
+    cookies = {"sessionid": "a"}
+
+    started = time.monotonic()
+    fetch_profile(session, "alice", cookies)
+    fetch_profile(session, "alice", cookies)
+
+    assert time.monotonic() - started >= 1.0
+    assert limiter.stats()["throttled"] == 1
+    assert limiter.stats()["retries"] == 1
+    # The 429 halved the API host's rate.
+    assert list(limiter.rates().values())[0] < 26
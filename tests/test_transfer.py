@@ -0,0 +1,105 @@
+import os
+
+import pytest
+import requests
+
+from benchmarks.fake_instagram import Account, media_body
+from session import DownloadSession
+from transfer import _ReportedBytes, part_path_for, stream_to_file
+
+MEDIA_ID = "1000000001"
+MEDIA_SIZE = 300 * 1024
+
+
+def start_cdn(fake_instagram, **kwargs):
+    fake = fake_instagram([Account("alice", media_size=MEDIA_SIZE)], **kwargs)
+    return fake, f"{fake.cdn_url}/media/alice/{MEDIA_ID}.jpg", media_body(MEDIA_ID, MEDIA_SIZE, False)
+
+
+def write_part(local_path, data):
+    with open(part_path_for(local_path), "wb") as f:
+        f.write(data)
+
+
+def test_part_file_is_resumed_with_a_range_request(fake_instagram, tmp_path):
+    fake, url, body = start_cdn(fake_instagram)
+    local_path = str(tmp_path / "media.jpg")
+    write_part(local_path, body[:100000])
+    counted = []
+
+    size = stream_to_file(DownloadSession(), url, local_path, on_bytes=counted.append)
+
+    assert size == len(body)
+    assert open(local_path, "rb").read() == body
+    assert fake.counts["media_bytes"] == len(body) - 100000
+    assert sum(counted) == len(body) - 100000
+    assert not os.path.exists(part_path_for(local_path))
+
+
+def test_server_ignoring_range_restarts_the_file(fake_instagram, tmp_path):
+    fake, url, body = start_cdn(fake_instagram, ignore_range=True)
+    local_path = str(tmp_path / "media.jpg")
+    write_part(local_path, body[:100000])
+    counted = []
+
+    stream_to_file(DownloadSession(), url, local_path, on_bytes=counted.append)
+
+    assert open(local_path, "rb").read() == body
+    # The partial bytes came from an earlier run, so this run received the whole file once.
+    assert sum(counted) == fake.counts["media_bytes"] == len(body)
+
+
+def test_resent_bytes_are_reported_once():
+    counted = []
+    reported = _ReportedBytes(counted.append, 0)
+
+    reported.written(0, 50)
+    # The connection dropped; the server ignored the Range request and sent everything again.
+    reported.written(0, 30)
+    reported.written(30, 40)
+
+    assert sum(counted) == 70
+
+
+def test_bytes_before_a_resumed_offset_are_reported_when_resent():
+    counted = []
+    reported = _ReportedBytes(counted.append, 100)
+
+    reported.written(100, 50)
+    reported.written(0, 120)
+    reported.written(120, 60)
+
+    # 50 new bytes, then 100 resent from before the offset and 30 beyond the first 150.
+    assert sum(counted) == 180
+
+
+def test_complete_part_file_is_finished_on_416(fake_instagram, tmp_path):
+    fake, url, body = start_cdn(fake_instagram)
+    local_path = str(tmp_path / "media.jpg")
+    write_part(local_path, body)
+
+    assert stream_to_file(DownloadSession(), url, local_path) == len(body)
+    assert open(local_path, "rb").read() == body
+    assert fake.counts["media_bytes"] == 0
+
+
+def test_oversized_part_file_is_downloaded_again_on_416(fake_instagram, tmp_path):
+    _, url, body = start_cdn(fake_instagram)
+    local_path = str(tmp_path / "media.jpg")
+    write_part(local_path, body + b"garbage")
+
+    stream_to_file(DownloadSession(), url, local_path)
+
+    assert open(local_path, "rb").read() == body
+
+
+def test_part_file_is_removed_on_http_error(fake_instagram, tmp_path):
+    fake, _, _ = start_cdn(fake_instagram)
+    local_path = str(tmp_path / "media.jpg")
+    write_part(local_path, b"partial")
+
+    with pytest.raises(requests.HTTPError):
+        stream_to_file(DownloadSession(), f"{fake.cdn_url}/media/nobody/1.jpg", local_path, keep_partial=True)
+
+    assert not os.path.exists(part_path_for(local_path))
+    assert not os.path.exists(local_path)
@@ -0,0 +1,60 @@
+import threading
+import time
+
+from benchmarks.fake_instagram import Account
+from cancel import CancelToken
+from filters import MediaFilter
+from watch import POST_INTERVALS, Watcher
+
+
+class SteppingClock:
+    """A wall clock that moves on a day every time it is read, so every poll is due at once."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        self.now += 24 * 3600
+        return self.now
+
+
+def watch_until(watcher, stop_event, polls, timeout=30):
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while watcher.polls < polls and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop_event.set()
+    thread.join(timeout)
+    assert not thread.is_alive()
+
+
+def test_filtered_media_does_not_count_as_new(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=6, media_size=1024, video_every=3)])
+    stop_event = CancelToken()
+    logs = []
+    watcher = Watcher(["alice"], {"csrftoken": "test"}, str(tmp_path), logs.append, stop_event,
+                      download_stories=False, max_workers=1, media_filter=MediaFilter(media_types=("image",)),
+                      clock=SteppingClock())
+
+    watch_until(watcher, stop_event, polls=4)
+
+    # The first poll downloads the 4 images; the 2 videos are never "new" again.
+    assert watcher.downloads == 1
+    assert len(list((tmp_path / "alice" / "posts").glob("*.jpg"))) == 4
+    schedule = watcher.schedules[0]
+    assert schedule.interval > POST_INTERVALS[0]
+
+
+def test_interval_follows_what_was_stored(fake_instagram, tmp_path):
+    fake_instagram([Account("alice", posts=3, media_size=4096)])
+    stop_event = CancelToken()
+    # The size is only known from the media response, so every poll sees new media.
+    watcher = Watcher(["alice"], {"csrftoken": "test"}, str(tmp_path), lambda message: None, stop_event,
+                      download_stories=False, max_workers=1, media_filter=MediaFilter(max_size=1024),
+                      clock=SteppingClock())
+
+    watch_until(watcher, stop_event, polls=4)
+
+    assert watcher.downloads >= 4
+    assert watcher.schedules[0].interval == POST_INTERVALS[2]
@@ -0,0 +1,257 @@
+import os
+import re
+
+import requests
+
+from session import TIMEOUT, RequestCancelled
+
+CHUNK_SIZE = 256 * 1024
+# How many times an interrupted transfer is resumed before giving up.
+RESUME_ATTEMPTS = 3
+
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+class TransferCancelled(Exception):
+    """Raised when cancel_event is set while a file is being transferred."""
+
+
+def _cancelled(cancel_event):
+    return cancel_event is not None and cancel_event.is_set()
+
+
+class IncompleteTransfer(IOError):
+    """Raised when the server sent fewer bytes than announced."""
+
+
+class MediaTooLarge(Exception):
+    """Raised when a file is larger than the max_bytes passed to stream_to_file."""
+
+
+class _ReportedBytes:
+    """
+    Passes the bytes written to a .part file on to on_bytes, except those at offsets
+    that were already reported: a server that ignores a Range request sends the file
+    from the start again, and progress must not count those bytes twice.
+    """
+
+    def __init__(self, on_bytes, offset):
+        self.on_bytes = on_bytes
+        self.start = self.end = offset
+
+    def written(self, position, nbytes):
+        end = position + nbytes
+        fresh = nbytes - max(0, min(end, self.end) - max(position, self.start))
+        if position <= self.end < end:
+            self.end = end
+        if fresh and self.on_bytes is not None:
+            self.on_bytes(fresh)
+
+
+def part_path_for(local_path):
+    return f"{local_path}.part"
+
+
+def _expected_size(response, offset):
+    content_range = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+    if content_range and content_range.group(3) != "*":
+        return int(content_range.group(3))
+    length = response.headers.get("Content-Length")
+    if length is not None and response.status_code == 200:
+        return int(length)
+    if length is not None and response.status_code == 206:
+        return offset + int(length)
+    return None
+
+
+def _transfer_once(session, url, local_path, cancel_event, chunk_size, reported, max_bytes=None):
+    part_path = part_path_for(local_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if offset and response.status_code == 416:
+            # The .part file already holds the whole body.
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit() and int(total) == offset:
+                return offset
+            offset = 0
+            os.remove(part_path)
+            return _transfer_once(session, url, local_path, cancel_event, chunk_size, reported, max_bytes)
+        response.raise_for_status()
+
+        if offset and response.status_code == 206:
+            content_range = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+            if not content_range or int(content_range.group(1)) != offset:
+                raise IncompleteTransfer(f"Unexpected Content-Range for {url}")
+            mode = 'ab'
+        else:
+            # The server ignored the Range header, start over.
+            offset = 0
+            mode = 'wb'
+
+        expected = _expected_size(response, offset)
+        if max_bytes is not None and expected is not None and expected > max_bytes:
+            raise MediaTooLarge(expected)
+        written = offset
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise TransferCancelled(url)
+                if max_bytes is not None and written + len(chunk) > max_bytes:
+                    # No Content-Length to check up front.
+                    raise MediaTooLarge(written + len(chunk))
+                f.write(chunk)
+                reported.written(written, len(chunk))
+                written += len(chunk)
+
+    if expected is not None and written != expected:
+        raise IncompleteTransfer(f"Received {written} of {expected} bytes for {url}")
+    return written
+
+
+def stream_to_file(session, url, local_path, cancel_event=None, chunk_size=CHUNK_SIZE, on_bytes=None, max_bytes=None,
+                   keep_partial=True):
+    """
+    Streams a URL to disk in fixed-size chunks, resuming a previous partial download.
+
+    The body is written to "<local_path>.part" and renamed to local_path only once it
+    is complete, so memory use is bounded by chunk_size and a reader never sees a
+    half-written file. An existing .part file is continued with an HTTP Range request;
+    media URLs point at immutable content, so the existing bytes stay valid even if
+    the signed URL changed between runs. A dropped connection is resumed the same way,
+    up to RESUME_ATTEMPTS times.
+
+    Args:
+        session (requests.Session): The HTTP session to use.
+        url (str): The media URL.
+        local_path (str): The final path of the file.
+        cancel_event (threading.Event): Optional, checked between chunks. With a
+            CancelToken as the session's current cancel event (see cancel.cancel_scope),
+            a blocked read is interrupted as soon as it is set.
+        chunk_size (int): Bytes read and written per chunk.
+        on_bytes (function): Optional, called with the size of every chunk written.
+        max_bytes (int): Optional, raise MediaTooLarge instead of downloading a larger
+            file. The announced size is checked before any of the body is read.
+        keep_partial (bool): Whether a transfer that was cancelled or kept failing
+            leaves its .part file for the next run to resume, or removes it. A .part
+            file is always removed when the server answers with an HTTP error.
+
+    Returns:
+        int: The size of the completed file in bytes.
+    """
+    part_path = part_path_for(local_path)
+    reported = _ReportedBytes(on_bytes, os.path.getsize(part_path) if os.path.exists(part_path) else 0)
+    attempt = 0
+    while True:
+        try:
+            size = _transfer_once(session, url, local_path, cancel_event, chunk_size, reported, max_bytes)
+            break
+        except MediaTooLarge:
+            _remove_part(local_path)
+            raise
+        except (TransferCancelled, RequestCancelled) as e:
+            if not keep_partial:
+                _remove_part(local_path)
+            if isinstance(e, TransferCancelled):
+                raise
+            raise TransferCancelled(url) from e
+        except requests.HTTPError:
+            # The media is gone or the signed URL expired; nothing to resume.
+            _remove_part(local_path)
+            raise
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.Timeout, IncompleteTransfer) as e:
+            if _cancelled(cancel_event):
+                # The read failed because cancelling shut the socket down.
+                if not keep_partial:
+                    _remove_part(local_path)
+                raise TransferCancelled(url) from e
+            attempt += 1
+            if attempt > RESUME_ATTEMPTS:
+                if not keep_partial:
+                    _remove_part(local_path)
+                raise
+    os.replace(part_path, local_path)
+    return size
+
+
+def _remove_part(local_path):
+    part_path = part_path_for(local_path)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+
+def open_media_stream(session, url, cancel_event=None, chunk_size=CHUNK_SIZE, max_bytes=None):
+    """
+    Opens a media URL for streaming into something other than a file of its own,
+    e.g. an archive.
+
+    A dropped connection is resumed with an HTTP Range request from the last byte
+    received, up to RESUME_ATTEMPTS times, so the consumer sees one uninterrupted
+    sequence of chunks.
+
+    Args:
+        session (requests.Session): The HTTP session to use.
+        url (str): The media URL.
+        cancel_event (threading.Event): Optional, checked between chunks.
+        chunk_size (int): Bytes per chunk.
+        max_bytes (int): Optional, raise MediaTooLarge for a larger file.
+
+    Returns:
+        tuple: (size, chunks) where size is the announced size in bytes (None if the
+        server did not send one) and chunks an iterator over the body. Iterating
+        raises TransferCancelled, IncompleteTransfer or MediaTooLarge.
+    """
+    try:
+        response = session.get(url, stream=True, timeout=TIMEOUT)
+    except RequestCancelled as e:
+        raise TransferCancelled(url) from e
+    try:
+        response.raise_for_status()
+        size = _expected_size(response, 0)
+        if max_bytes is not None and size is not None and size > max_bytes:
+            raise MediaTooLarge(size)
+    except BaseException:
+        response.close()
+        raise
+
+    def chunks(response):
+        received = 0
+        attempt = 0
+        try:
+            while True:
+                try:
+                    for chunk in response.iter_content(chunk_size):
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise TransferCancelled(url)
+                        received += len(chunk)
+                        if max_bytes is not None and received > max_bytes:
+                            raise MediaTooLarge(received)
+                        yield chunk
+                    break
+                except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.Timeout) as e:
+                    if _cancelled(cancel_event):
+                        raise TransferCancelled(url) from e
+                    attempt += 1
+                    if attempt > RESUME_ATTEMPTS or size is None:
+                        raise
+                    response.close()
+                    try:
+                        response = session.get(url, headers={"Range": f"bytes={received}-"}, stream=True,
+                                               timeout=TIMEOUT)
+                    except RequestCancelled as e:
+                        raise TransferCancelled(url) from e
+                    response.raise_for_status()
+                    content_range = _CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+                    if response.status_code != 206 or not content_range or int(content_range.group(1)) != received:
+                        raise IncompleteTransfer(f"Could not resume {url} at byte {received}")
+        finally:
+            response.close()
+        if _cancelled(cancel_event):
+            raise TransferCancelled(url)
+        if size is not None and received != size:
+            raise IncompleteTransfer(f"Received {received} of {size} bytes for {url}")
+
+    return size, chunks(response)
+
@@ -0,0 +1,131 @@
+from bisect import bisect_left
+
+
+def read_usernames(lines):
+    """
+    Reads usernames, one per line. Blank lines and lines starting with '#' are
+    ignored, and a leading '@' is stripped. Duplicates keep their first position.
+    """
+    usernames = []
+    for line in lines:
+        username = line.strip().lstrip('@')
+        if username and not username.startswith('#'):
+            usernames.append(username)
+    return list(dict.fromkeys(usernames))
+
+
+def _key(username):
+    return username.lower()
+
+
+class UserList:
+    """
+    The saved usernames, kept sorted and de-duplicated, with the selection held in
+    a separate set.
+
+    Lookups are O(1), adding one username is a single bisect insert and bulk adds
+    or removals rebuild the list once, so a watch list of tens of thousands of
+    accounts stays cheap to edit. Nothing here touches Tk; the GUI only renders
+    the rows that are currently visible.
+    """
+
+    def __init__(self, usernames=()):
+        self._members = set()
+        self._names = []
+        self._keys = []
+        self.selected = set()
+        self._version = 0
+        self._filter_cache = (None, None, None)
+        self._rebuild(usernames)
+
+    def _rebuild(self, usernames):
+        self._members = set(usernames)
+        self._names = sorted(self._members, key=_key)
+        self._keys = [_key(username) for username in self._names]
+        self.selected &= self._members
+        self._version += 1
+
+    @property
+    def names(self):
+        """The usernames in display order. Do not modify the returned list."""
+        return self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, username):
+        return username in self._members
+
+    def add(self, username):
+        """Adds one username. Returns False if it was already saved."""
+        if username in self._members:
+            return False
+        key = _key(username)
+        index = bisect_left(self._keys, key)
+        self._names.insert(index, username)
+        self._keys.insert(index, key)
+        self._members.add(username)
+        self._version += 1
+        return True
+
+    def add_many(self, usernames):
+        """Adds several usernames at once. Returns how many were new."""
+        new = set(usernames) - self._members
+        if len(new) == 1:
+            self.add(new.pop())
+            return 1
+        if new:
+            self._rebuild(self._members | new)
+        return len(new)
+
+    def remove_many(self, usernames):
+        """Removes several usernames at once (and deselects them). Returns how many were removed."""
+        removed = self._members.intersection(usernames)
+        if removed:
+            self._rebuild(self._members - removed)
+        return len(removed)
+
+    def toggle(self, username):
+        if username in self.selected:
+            self.selected.discard(username)
+        elif username in self._members:
+            self.selected.add(username)
+
+    def select(self, usernames, selected=True):
+        if selected:
+            self.selected.update(username for username in usernames if username in self._members)
+        else:
+            self.selected.difference_update(usernames)
+
+    def selected_names(self):
+        """The selected usernames in display order."""
+        return sorted(self.selected, key=_key)
+
+    def filter(self, query):
+        """
+        Returns the usernames matching query (case-insensitive, a leading '@' is ignored).
+
+        Prefix matches are found by bisecting the sorted keys and come first; other
+        substring matches follow. When the query only extends the previous one, just
+        the previous results are searched, so typing into the search box narrows the
+        list without rescanning every username.
+        """
+        query = query.strip().lstrip('@').lower()
+        if not query:
+            return self._names
+
+        cached_version, cached_query, cached_matches = self._filter_cache
+        if cached_version == self._version and cached_query and query.startswith(cached_query):
+            matches = [username for username in cached_matches if query in _key(username)]
+            prefix = [username for username in matches if _key(username).startswith(query)]
+            matches = prefix + [username for username in matches if not _key(username).startswith(query)]
+        else:
+            start = bisect_left(self._keys, query)
+            end = bisect_left(self._keys, query + "\uffff", start)
+            matches = self._names[start:end] + [
+                username for key, username in zip(self._keys, self._names)
+                if query in key and not key.startswith(query)
+            ]
+
+        self._filter_cache = (self._version, query, matches)
+        return matches
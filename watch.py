@@ -0,0 +1,260 @@
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cache import ResponseCache
+from cancel import cancel_scope
+from downloader import download_media
+from engine import DEFAULT_MAX_WORKERS
+from fetcher import MediaFetcher
+from listing import ListingError, fetch_story_reel, iter_post_pages, media_entries, resolve_user_id
+from manifest import Manifest
+from metrics import MetricsRegistry
+from progress import ProgressTracker
+from ratelimit import RateLimiter
+from session import DownloadSession
+
+STORY_LIFETIME = 24 * 3600
+# Stories are polled at least this long before the oldest story that may be unseen expires.
+EXPIRY_MARGIN = 2 * 3600
+# (minimum, initial, maximum) polling interval in seconds.
+STORY_INTERVALS = (15 * 60, 60 * 60, 6 * 3600)
+POST_INTERVALS = (30 * 60, 6 * 3600, 24 * 3600)
+# Interval multipliers after a poll that found new media, and after one that found nothing.
+SPEEDUP = 0.5
+SLOWDOWN = 1.5
+# Seconds before a poll that failed is retried.
+ERROR_RETRY = 5 * 60
+# Longest sleep of the scheduler loop, so stop_event is noticed quickly.
+WAKEUP_INTERVAL = 1.0
+
+
+class _Schedule:
+    """Polling state of one account and kind ("stories" or "posts")."""
+
+    def __init__(self, username, kind, intervals, state=None):
+        self.username = username
+        self.kind = kind
+        self.min_interval, initial, self.max_interval = intervals
+        state = state or {}
+        self.interval = min(self.max_interval, max(self.min_interval, state.get("interval", initial)))
+        self.last_poll = state.get("last_poll")
+        self.next_due = state.get("next_due", 0.0)
+        self.running = False
+
+    def deadline(self):
+        """
+        When the oldest story that may be unseen expires. A story posted right after
+        the last poll is the oldest one we cannot have seen, so that is last_poll plus
+        the story lifetime. Posts never expire.
+        """
+        if self.kind != "stories":
+            return math.inf
+        return (self.last_poll or 0.0) + STORY_LIFETIME
+
+    def polled(self, now, new_items):
+        """Adapts the interval to how often the account actually posts and schedules the next poll."""
+        factor = SPEEDUP if new_items else SLOWDOWN
+        self.interval = min(self.max_interval, max(self.min_interval, self.interval * factor))
+        self.last_poll = now
+        self.next_due = now + self.interval
+        if self.kind == "stories":
+            self.next_due = min(self.next_due, self.deadline() - EXPIRY_MARGIN)
+
+    def failed(self, now):
+        self.next_due = now + min(ERROR_RETRY, self.interval)
+
+    def state(self):
+        return {"interval": round(self.interval, 1), "last_poll": self.last_poll, "next_due": self.next_due}
+
+
+class Watcher:
+    """
+    Long-running scheduler that keeps a set of accounts downloaded without anyone
+    pressing Start.
+
+    Every account's stories and posts are polled on their own interval. The interval
+    halves after a poll that found new media and grows by half after one that found
+    nothing, between the bounds of STORY_INTERVALS and POST_INTERVALS, so it follows
+    how often the account actually posts. Stories are also always polled EXPIRY_MARGIN
+    before the oldest story that may be unseen expires, and when more polls are due
+    than there are workers, the accounts whose stories expire first go first.
+
+    A poll fetches the newest listing (and, on the first posts poll, the profile for
+    the user ID) and compares the media the media filter admits against the manifest;
+    download_media only runs when that leaves media that has not been fetched yet.
+    The interval then follows what the download actually stored, so media that can
+    never be stored (too large, expired) does not keep an account at its shortest
+    interval.
+    """
+
+    def __init__(self, usernames, cookies, download_path, log_callback, stop_event, download_stories=True,
+                 download_posts=True, max_workers=DEFAULT_MAX_WORKERS, store=None, cookie_pool=None, media_filter=None,
+                 governor=None, archive_format=None, use_cache=True, clock=time.time):
+        """
+        Args:
+            usernames (list): The accounts to watch.
+            cookies (dict): The cookies for authentication. Ignored when cookie_pool is given.
+            download_path (str): The root directory to save the downloaded media.
+            log_callback (function): A function to call for logging progress.
+            stop_event (threading.Event): Stops the watcher (and cancels running downloads) when set.
+            download_stories (bool): Whether to watch stories.
+            download_posts (bool): Whether to watch posts.
+            max_workers (int): How many polls and downloads run at the same time.
+            store (StateStore): Optional, persists the polling intervals per account so
+                a restarted watcher keeps its schedule.
+            cookie_pool (CookiePool): Optional, several sessions to spread the polls across.
+            media_filter (MediaFilter): Optional, applied to every download.
+            governor (BandwidthGovernor): Optional, the bandwidth budget of the downloads.
+            archive_format (str): Optional, "tar" or "zip" to write daily archives per account.
+            use_cache (bool): Keep listings in the download directory's ResponseCache, so the
+                download after a poll reuses the poll's listing, and a stale listing is
+                revalidated instead of fetched again where the server supports it.
+            clock (function): Wall-clock time source.
+        """
+        self.cookies = cookies
+        self.download_path = download_path
+        self.log_callback = log_callback
+        self.stop_event = stop_event
+        self.max_workers = max(1, int(max_workers))
+        self.store = store
+        self.cookie_pool = cookie_pool
+        self.media_filter = media_filter
+        self.governor = governor
+        self.archive_format = archive_format
+        self.use_cache = use_cache
+        self.clock = clock
+        self.tracker = ProgressTracker()
+        self.metrics = MetricsRegistry()
+        self.polls = 0
+        self.downloads = 0
+        self._user_ids = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+        kinds = [(kind, intervals) for kind, intervals, enabled in
+                 (("stories", STORY_INTERVALS, download_stories), ("posts", POST_INTERVALS, download_posts)) if enabled]
+        self.schedules = []
+        for username in dict.fromkeys(usernames):
+            account = store.account(username) if store is not None else None
+            settings = account["settings"] if account else {}
+            if settings.get("user_id"):
+                self._user_ids[username] = settings["user_id"]
+            for kind, intervals in kinds:
+                self.schedules.append(_Schedule(username, kind, intervals, settings.get(f"watch_{kind}")))
+
+    def _due(self, now):
+        """The schedules due now, most urgent story deadline first."""
+        due = [schedule for schedule in self.schedules if not schedule.running and schedule.next_due <= now]
+        due.sort(key=lambda schedule: (schedule.deadline(), schedule.next_due))
+        return due
+
+    def run(self):
+        """Polls until stop_event is set. Blocks the calling thread."""
+        self.log_callback(f"Watching {len(self.schedules)} feed(s) of "
+                          f"{len({schedule.username for schedule in self.schedules})} account(s)...")
+        self.manifest = Manifest.for_download_path(self.download_path)
+        self.fetcher = MediaFetcher()
+        self.cache = ResponseCache.for_download_path(self.download_path, metrics=self.metrics) if self.use_cache else None
+        self.session = None
+        if self.cookie_pool is not None:
+            self.cookie_pool.open(self.metrics, self.log_callback)
+        else:
+            self.session = DownloadSession(rate_limiter=RateLimiter(), metrics=self.metrics)
+        running = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="insta-watch") as executor:
+                while not self.stop_event.is_set():
+                    now = self.clock()
+                    with self._lock:
+                        running = sum(1 for schedule in self.schedules if schedule.running)
+                        for schedule in self._due(now)[:self.max_workers - running]:
+                            schedule.running = True
+                            executor.submit(self._poll, schedule)
+                        waiting = [schedule.next_due for schedule in self.schedules if not schedule.running]
+                    delay = min([WAKEUP_INTERVAL] + [max(0.0, due - now) for due in waiting])
+                    self._wakeup.wait(delay)
+                    self._wakeup.clear()
+        finally:
+            self.fetcher.close()
+            if self.session is not None:
+                self.session.close()
+            if self.cookie_pool is not None:
+                self.cookie_pool.close()
+            self.manifest.close()
+            if self.cache is not None:
+                self.cache.close()
+        self.log_callback(f"Stopped watching after {self.polls} poll(s) and {self.downloads} download(s).")
+
+    def _poll(self, schedule):
+        pooled = None
+        try:
+            if self.cookie_pool is not None:
+                pooled = self.cookie_pool.acquire(self.stop_event)
+                if pooled is None:
+                    return
+                cookies, session = pooled.cookies, pooled.session
+            else:
+                cookies, session = self.cookies, self.session
+            with cancel_scope(self.stop_event):
+                new_items = self._check(schedule, session, cookies)
+            fetched = 0
+            if new_items and not self.stop_event.is_set():
+                self.log_callback(f"@{schedule.username} has {new_items} new {schedule.kind} item(s), downloading...")
+                counts = {}
+                download_media(schedule.username, cookies, self.download_path, self.log_callback, lambda value: None,
+                               self.stop_event, schedule.kind == "stories", schedule.kind == "posts",
+                               manifest=self.manifest, session=session, fetcher=self.fetcher,
+                               tracker=self.tracker, metrics=self.metrics, media_filter=self.media_filter,
+                               governor=self.governor, archive_format=self.archive_format, cache=self.cache,
+                               counts=counts)
+                fetched = counts.get(schedule.kind, 0)
+                with self._lock:
+                    self.downloads += 1
+            with self._lock:
+                self.polls += 1
+                schedule.polled(self.clock(), fetched)
+        except Exception as e:
+            if not isinstance(e, (ListingError, requests.RequestException)):
+                self.log_callback(f"Unexpected error while polling @{schedule.username}: {e!r}")
+            else:
+                self.log_callback(f"Could not poll {schedule.kind} of @{schedule.username}: {e}")
+            with self._lock:
+                schedule.failed(self.clock())
+        finally:
+            if pooled is not None:
+                self.cookie_pool.release(pooled)
+            with self._lock:
+                schedule.running = False
+            if self.store is not None:
+                self.store.update_account_settings(schedule.username, **{f"watch_{schedule.kind}": schedule.state()})
+            self._wakeup.set()
+
+    def _check(self, schedule, session, cookies):
+        """
+        Returns how many media items in the current listing pass the media filter and
+        are not in the manifest yet.
+        """
+        if schedule.kind == "stories":
+            reel = fetch_story_reel(session, schedule.username, cookies, self.cache)
+            items = reel.get('items', []) if reel else []
+            known = self.manifest.known_ids(schedule.username, "story")
+        else:
+            user_id = self._user_ids.get(schedule.username)
+            if user_id is None:
+                user_id = resolve_user_id(session, schedule.username, cookies, self.cache)
+                self._user_ids[schedule.username] = user_id
+                if self.store is not None:
+                    self.store.update_account_settings(schedule.username, user_id=user_id)
+            items = next(iter_post_pages(session, user_id, cookies, self.cache), [])
+            known = self.manifest.known_ids(schedule.username, "post")
+        entries = [entry for item in items for entry in media_entries(item)]
+        if self.media_filter is not None:
+            if schedule.kind == "stories":
+                # The reel lists the oldest story first; the download caps the newest ones.
+                entries.sort(key=lambda entry: entry['taken_at'] or 0, reverse=True)
+            entries = self.media_filter.select(entries)
+        return sum(1 for entry in entries if entry['id'] not in known)